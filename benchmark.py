@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+"""
+Throughput benchmarks for reading LHE files.
+Example usage:
+  python benchmark.py scan filename.lhe
+  python benchmark.py parse filename.lhe --lhefileclass LHEFile_Hwithdecay
+  python benchmark.py decompress filename.lhe.gz
+  python benchmark.py generate h4l synthetic.lhe --nevents 10000
+  python benchmark.py suite --baseline baseline.json         #fails if anything got slower than the baseline
+  python benchmark.py suite --baseline baseline.json --save-baseline
+The suite runs each LHEFile_* reader and each lhe2root mode on synthetic events in a separate process,
+with the MELA stub from stubmela.py unless --real-mela is given, and reports events/s and peak RSS.
+"""
+import argparse
+import functools
+import gzip
+import json
+import math
+import os
+import random
+import re
+import resource
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers(dest="command")
+  scanparser = subparsers.add_parser("scan", help="split the file into events with the old line loop and with scanevents")
+  scanparser.add_argument("lhefile")
+  scanparser.add_argument("--compression", choices=("gzip", "xz", "zstd", "bz2"), help="default: detect from the magic bytes")
+  scanparser.add_argument("--blocksize", type=int, default=1<<22)
+  scanparser.add_argument("--repeat", type=int, default=3)
+  parseparser = subparsers.add_parser("parse", help="parse the events into LHEEvent objects and with the columnar reader")
+  parseparser.add_argument("lhefile")
+  parseparser.add_argument("--lhefileclass", default="LHEFile_Hwithdecay")
+  parseparser.add_argument("--compression", choices=("gzip", "xz", "zstd", "bz2"), help="default: detect from the magic bytes")
+  parseparser.add_argument("--chunksize", type=int, default=100000)
+  parseparser.add_argument("--not-isgen", dest="isgen", action="store_false")
+  parseparser.add_argument("--repeat", type=int, default=3)
+  decompressparser = subparsers.add_parser("decompress", help="scan a compressed file with gzip.GzipFile and with DecompressedFile, with and without parallel decoding")
+  decompressparser.add_argument("lhefile")
+  decompressparser.add_argument("--blocksize", type=int, default=1<<22)
+  decompressparser.add_argument("--threads", type=int, default=4, help="threads for the parallel decoding of BGZF and zstd files")
+  decompressparser.add_argument("--repeat", type=int, default=3)
+  generateparser = subparsers.add_parser("generate", help="write a synthetic LHE file")
+  generateparser.add_argument("topology", choices=("h4l", "mg", "vbf", "vh", "vhdecay", "zhhawk", "tth"))
+  generateparser.add_argument("outputfile")
+  generateparser.add_argument("--nevents", type=int, default=10000)
+  generateparser.add_argument("--nweights", type=int, default=200, help="number of reweighting points for the mg topology")
+  generateparser.add_argument("--seed", type=int, default=1)
+  suiteparser = subparsers.add_parser("suite", help="time the readers and lhe2root on synthetic files and compare to a baseline")
+  suiteparser.add_argument("--nevents", type=int, default=5000)
+  suiteparser.add_argument("--nweights", type=int, default=200)
+  suiteparser.add_argument("--seed", type=int, default=1)
+  suiteparser.add_argument("--repeat", type=int, default=3, help="each case is run this many times, the best run counts")
+  suiteparser.add_argument("--cases", help="regex, only run the cases whose name matches")
+  suiteparser.add_argument("--baseline", help="json file with the results to compare to")
+  suiteparser.add_argument("--save-baseline", action="store_true", help="write the results to --baseline instead of comparing")
+  suiteparser.add_argument("--tolerance", type=float, default=0.2, help="fail if events/s drops or peak RSS grows by more than this fraction")
+  suiteparser.add_argument("--workdir", help="keep the synthetic files here, default: a temporary directory")
+  suiteparser.add_argument("--real-mela", action="store_true", help="use the installed mela instead of the stub")
+  caseparser = subparsers.add_parser("case", help="used by suite: run one case in this process and print the result as json")
+  caseparser.add_argument("kind", choices=("reader", "lhe2root"))
+  caseparser.add_argument("lhefile")
+  caseparser.add_argument("name", help="LHEFile_* class or lhe2root options, separated by spaces (after -- if they start with -)")
+  caseparser.add_argument("--weights", action="store_true", help="also parse the reweighting weights")
+  caseparser.add_argument("--real-mela", action="store_true")
+  args = parser.parse_args()
+  #the suite itself only needs mela to import lhefile, the cases run in their own processes
+  if args.command in ("generate", "suite") or args.command == "case" and not args.real_mela:
+    import stubmela
+    stubmela.install()
+
+import lhefile
+from lhefile import detectcompression, openlhefile, parsecolumns, scanevents
+
+def linebylineevents(f):
+  """the event loop that LHEFileBase.__iter__ used before scanevents, kept as the reference"""
+  event = ""
+  for linenumber, line in enumerate(f, start=1):
+    if "<event>" not in line and not event:
+      continue
+    event += line
+    if "</event>" in line:
+      yield linenumber, event
+      event = ""
+
+def timeevents(function, openfile, repeat, **kwargs):
+  """returns (number of events, best time in seconds) out of repeat passes over the file returned by openfile()"""
+  best = None
+  for _ in range(repeat):
+    with openfile() as f:
+      start = time.time()
+      nevents = sum(1 for _ in function(f, **kwargs))
+      elapsed = time.time() - start
+    if best is None or elapsed < best: best = elapsed
+  return nevents, best
+
+def printresult(name, nevents, elapsed):
+  print "{:15} {:10d} events {:8.3f} s {:12.0f} events/s".format(name, nevents, elapsed, nevents / elapsed if elapsed else float("inf"))
+
+def benchmarkscan(filename, compression=None, blocksize=1<<22, repeat=3):
+  results = []
+  for name, function, kwargs in (
+    ("line by line", linebylineevents, {}),
+    ("scanevents", scanevents, {"blocksize": blocksize}),
+  ):
+    nevents, elapsed = timeevents(function, functools.partial(openlhefile, filename, compression), repeat, **kwargs)
+    results.append((name, nevents, elapsed))
+    printresult(name, nevents, elapsed)
+  if len({nevents for name, nevents, elapsed in results}) != 1:
+    raise RuntimeError("The event loops found different numbers of events!")
+  return results
+
+def lheeventobjects(f, lheeventclass, isgen=True):
+  for offset, linenumber, event in scanevents(f):
+    yield lheeventclass(event, isgen)
+
+def columnchunks(f, lheeventclass, isgen=True, chunksize=100000):
+  """yields one item per event, so that timeevents counts events, but parses them in chunks"""
+  events = []
+  for offset, linenumber, event in scanevents(f):
+    events.append(event)
+    if len(events) == chunksize:
+      for _ in parsecolumns(events, lheeventclass, isgen).weight: yield _
+      events = []
+  if events:
+    for _ in parsecolumns(events, lheeventclass, isgen).weight: yield _
+
+def benchmarkparse(filename, lhefileclass, compression=None, isgen=True, chunksize=100000, repeat=3):
+  lheeventclass = getattr(lhefile, lhefileclass).lheeventclass
+  results = []
+  for name, function, kwargs in (
+    ("LHEEvent", lheeventobjects, {"lheeventclass": lheeventclass, "isgen": isgen}),
+    ("columns", columnchunks, {"lheeventclass": lheeventclass, "isgen": isgen, "chunksize": chunksize}),
+  ):
+    nevents, elapsed = timeevents(function, functools.partial(openlhefile, filename, compression), repeat, **kwargs)
+    results.append((name, nevents, elapsed))
+    printresult(name, nevents, elapsed)
+  print "speedup: {:.1f}x".format(results[0][2] / results[1][2])
+  return results
+
+def benchmarkdecompress(filename, blocksize=1<<22, threads=4, repeat=3):
+  compression = detectcompression(filename)
+  if compression is None: raise ValueError(filename+" isn't compressed")
+  openers = []
+  if compression == "gzip":
+    openers.append(("gzip.GzipFile", functools.partial(gzip.GzipFile, filename)))
+  openers.append(("1 thread", functools.partial(openlhefile, filename, compression, threads=1)))
+  if threads > 1:
+    openers.append(("{} threads".format(threads), functools.partial(openlhefile, filename, compression, threads=threads)))
+  results = []
+  for name, openfile in openers:
+    nevents, elapsed = timeevents(scanevents, openfile, repeat, blocksize=blocksize)
+    results.append((name, nevents, elapsed))
+    printresult(name, nevents, elapsed)
+  if len({nevents for name, nevents, elapsed in results}) != 1:
+    raise RuntimeError("The readers found different numbers of events!")
+  return results
+
+#synthetic events
+
+MH, MZ, MW, MT = 125., 91.1876, 80.379, 173.
+PARTICLELINE = "{:>4d} {:>2d} {:>2d} {:>2d} {:>3d} {:>3d} {:+.10e} {:+.10e} {:+.10e} {:.10e} {:.10e} 0. 9.\n"
+
+def boost(p, beta):
+  """boosts the four-vector p = (E, px, py, pz) by the velocity beta"""
+  b2 = sum(_**2 for _ in beta)
+  if not b2: return p
+  gamma = 1 / math.sqrt(1 - b2)
+  bp = sum(b*_ for b, _ in zip(beta, p[1:]))
+  factor = (gamma - 1) * bp / b2 + gamma * p[0]
+  return (gamma * (p[0] + bp),) + tuple(_ + factor*b for _, b in zip(p[1:], beta))
+
+def twobody(parent, m1, m2, rng):
+  """isotropic decay of parent = (E, px, py, pz) into two particles with masses m1 and m2"""
+  m = math.sqrt(max(parent[0]**2 - sum(_**2 for _ in parent[1:]), 0))
+  p = math.sqrt(max((m**2 - (m1+m2)**2) * (m**2 - (m1-m2)**2), 0)) / (2*m)
+  costheta, phi = rng.uniform(-1, 1), rng.uniform(0, 2*math.pi)
+  sintheta = math.sqrt(1 - costheta**2)
+  direction = (sintheta*math.cos(phi), sintheta*math.sin(phi), costheta)
+  beta = tuple(_ / parent[0] for _ in parent[1:])
+  return (
+    boost((math.sqrt(p**2 + m1**2),) + tuple(p*_ for _ in direction), beta),
+    boost((math.sqrt(p**2 + m2**2),) + tuple(-p*_ for _ in direction), beta),
+  )
+
+def atrest(m, pz=0.):
+  return (math.sqrt(m**2 + pz**2), 0., 0., pz)
+
+class SyntheticEvent(object):
+  """particles of one event as (id, status, mother1, mother2, momentum, mass), with 1-based mothers like in the file"""
+  def __init__(self):
+    self.particles = []
+    self.weights = []
+
+  def add(self, id, status, momentum, mass=0., mothers=(0, 0)):
+    self.particles.append((id, status, mothers[0], mothers[1], momentum, mass))
+    return len(self.particles)
+
+  def incoming(self, final, ids=(21, 21)):
+    """adds the two incoming partons along the beam axis that make the final state four-vector"""
+    energy, pz = final[0], final[3]
+    self.add(ids[0], -1, ((energy+pz)/2, 0., 0., (energy+pz)/2))
+    self.add(ids[1], -1, ((energy-pz)/2, 0., 0., -(energy-pz)/2))
+    return (1, 2)
+
+  def text(self):
+    lines = ["<event>\n", " {} 1 {:+.7e} {:.8e} 7.8e-03 1.1e-01\n".format(len(self.particles), 1., MH)]
+    for id, status, mother1, mother2, (energy, px, py, pz), mass in self.particles:
+      color = 501 if 1 <= abs(id) <= 6 or id == 21 else 0
+      lines.append(PARTICLELINE.format(id, status, mother1, mother2, color, 0, px, py, pz, energy, mass))
+    if self.weights:
+      lines.append("<rwgt>\n")
+      lines += ["<wgt id='rwgt_{}'>{:+.5e}</wgt>\n".format(i, weight) for i, weight in enumerate(self.weights, start=1)]
+      lines.append("</rwgt>\n")
+    lines.append("</event>\n")
+    return "".join(lines)
+
+def zmass(rng, low=12.):
+  return min(max(rng.gauss(MZ, 2.5), low), MH - low - 1)
+
+def addh4l(event, h, hindex, rng):
+  """H -> ZZ -> 4l, with one on shell and one off shell Z"""
+  mz1 = zmass(rng)
+  mz2 = rng.uniform(12., MH - mz1 - 1)
+  for z, mz in zip(twobody(h, mz1, mz2, rng), (mz1, mz2)):
+    zindex = event.add(23, 2, z, mz, (hindex, hindex))
+    lepton = rng.choice((11, 13))
+    for id, p in zip((lepton, -lepton), twobody(z, 0, 0, rng)):
+      event.add(id, 1, p, 0, (zindex, zindex))
+
+def addvdecay(event, v, vindex, rng, leptons=False, photon=False):
+  id = rng.choice((11, 13)) if leptons else rng.choice((1, 2, 3, 4))
+  decay = twobody(v, 0, 0, rng)
+  if photon:
+    #a collinear FSR photon that takes a fraction of the lepton momentum
+    fraction = rng.uniform(0.01, 0.3)
+    photonmomentum = tuple(fraction*_ for _ in decay[0])
+    decay = (tuple((1-fraction)*_ for _ in decay[0]), decay[1])
+  for daughterid, p in zip((id, -id), decay):
+    event.add(daughterid, 1, p, 0, (vindex, vindex))
+  if photon:
+    event.add(22, 1, photonmomentum, 0, (vindex, vindex))
+
+def jet(rng, pt=None):
+  pt = pt if pt is not None else rng.uniform(20, 200)
+  eta, phi = rng.uniform(-4.5, 4.5), rng.uniform(0, 2*math.pi)
+  return (pt*math.cosh(eta), pt*math.cos(phi), pt*math.sin(phi), pt*math.sinh(eta))
+
+def syntheticevent(topology, rng, nweights=0):
+  """
+  h4l: gg -> H -> ZZ -> 4l, mg: the same with nweights reweighting weights,
+  vbf: qq -> qqH with a stable H, vh: qq -> ZH with Z -> qq and a stable H, vhdecay: the same with H -> 4l,
+  zhhawk: qq -> ZH with Z -> ll + an FSR photon, tth: gg -> ttH with t -> bW, W -> qq and a stable H
+  """
+  event = SyntheticEvent()
+  if topology in ("h4l", "mg"):
+    h = atrest(MH, rng.gauss(0, 300))
+    event.incoming(h)
+    addh4l(event, h, event.add(25, 2, h, MH, (1, 2)), rng)
+    if topology == "mg":
+      event.weights = [rng.uniform(0, 1) for _ in range(nweights)]
+  elif topology == "vbf":
+    jets = [jet(rng), jet(rng)]
+    pxh, pyh = -jets[0][1]-jets[1][1], -jets[0][2]-jets[1][2]
+    pzh = rng.gauss(0, 300)
+    h = (math.sqrt(MH**2 + pxh**2 + pyh**2 + pzh**2), pxh, pyh, pzh)
+    final = tuple(sum(_) for _ in zip(h, *jets))
+    ids = (rng.choice((1, 2, -1, -2)), rng.choice((1, 2, 3, -1, -2, -3)))
+    mothers = event.incoming(final, ids)
+    event.add(25, 1, h, MH, mothers)
+    for id, p in zip(ids, jets):
+      event.add(id, 1, p, 0, mothers)
+  elif topology in ("vh", "vhdecay", "zhhawk"):
+    system = atrest(rng.uniform(MH+MZ+10, 800), rng.gauss(0, 300))
+    mothers = event.incoming(system, (2, -2))
+    z, h = twobody(system, MZ, MH, rng)
+    zindex = event.add(23, 2, z, MZ, mothers)
+    if topology == "vhdecay":
+      addh4l(event, h, event.add(25, 2, h, MH, mothers), rng)
+    else:
+      event.add(25, 1, h, MH, mothers)
+    addvdecay(event, z, zindex, rng, leptons=(topology == "zhhawk"), photon=(topology == "zhhawk"))
+  elif topology == "tth":
+    m = rng.uniform(2*MT+MH+10, 1500)
+    system = atrest(m, rng.gauss(0, 300))
+    mothers = event.incoming(system)
+    mtt = rng.uniform(2*MT+1, m-MH-1)
+    tt, h = twobody(system, mtt, MH, rng)
+    event.add(25, 1, h, MH, mothers)
+    for tid, t in zip((6, -6), twobody(tt, MT, MT, rng)):
+      tindex = event.add(tid, 2, t, MT, mothers)
+      b, w = twobody(t, 4.7, MW, rng)
+      sign = 1 if tid > 0 else -1
+      event.add(5*sign, 1, b, 4.7, (tindex, tindex))
+      windex = event.add(24*sign, 2, w, MW, (tindex, tindex))
+      for id, p in zip((2*sign, -1*sign), twobody(w, 0, 0, rng)):
+        event.add(id, 1, p, 0, (windex, windex))
+  else:
+    raise ValueError("Unknown topology " + topology)
+  return event
+
+def writesyntheticfile(filename, topology, nevents, seed=1, nweights=200):
+  """writes nevents synthetic events, the file only depends on the arguments"""
+  rng = random.Random(seed)
+  with open(filename, "w") as f:
+    f.write('<LesHouchesEvents version="3.0">\n<header>\n')
+    if topology == "mg":
+      f.write("<initrwgt>\n<weightgroup name='mg_reweighting' weight_name_strategy='includeIdInWeightName'>\n")
+      for i in range(1, nweights+1):
+        f.write('<weight id="rwgt_{0}"> set param_card {0} </weight>\n'.format(i))
+      f.write("</weightgroup>\n</initrwgt>\n")
+    f.write("</header>\n<init>\n2212 2212 6.5e3 6.5e3 0 0 247000 247000 3 1\n1.0e1 1.0e-2 1.0 1\n</init>\n")
+    for _ in range(nevents):
+      f.write(syntheticevent(topology, rng, nweights).text())
+    f.write("</LesHouchesEvents>\n")
+
+#the benchmark suite
+
+#(case name, kind, LHEFile_* class or lhe2root options, topology)
+suitecases = (
+  ("reader LHEFile_Hwithdecay", "reader", "LHEFile_Hwithdecay", "h4l"),
+  ("reader LHEFile_HwithdecayOnly", "reader", "LHEFile_HwithdecayOnly", "h4l"),
+  ("reader LHEFile_Offshell4l", "reader", "LHEFile_Offshell4l", "h4l"),
+  ("reader LHEFile_Hwithdecay weights", "reader", "LHEFile_Hwithdecay", "mg"),
+  ("reader LHEFile_StableHiggs", "reader", "LHEFile_StableHiggs", "vbf"),
+  ("reader LHEFile_JHUGenVBFVH", "reader", "LHEFile_JHUGenVBFVH", "vbf"),
+  ("reader LHEFile_VHHiggsdecay", "reader", "LHEFile_VHHiggsdecay", "vhdecay"),
+  ("reader LHEFile_StableHiggsZHHAWK", "reader", "LHEFile_StableHiggsZHHAWK", "zhhawk"),
+  ("reader LHEFile_JHUGenttH", "reader", "LHEFile_JHUGenttH", "tth"),
+  ("lhe2root --ggH4l", "lhe2root", "--ggH4l", "h4l"),
+  ("lhe2root --ggH4l --calc_decayprob", "lhe2root", "--ggH4l --calc_decayprob", "h4l"),
+  ("lhe2root --ggH4lMG", "lhe2root", "--ggH4lMG --schema-version 2", "mg"),
+  ("lhe2root --vbf", "lhe2root", "--vbf", "vbf"),
+  ("lhe2root --vbf --calc_prodprob", "lhe2root", "--vbf --calc_prodprob", "vbf"),
+  ("lhe2root --zh --use-flavor", "lhe2root", "--zh --use-flavor", "vh"),
+  ("lhe2root --zh_withdecay", "lhe2root", "--zh_withdecay", "vhdecay"),
+  ("lhe2root --zh_lep_hawk", "lhe2root", "--zh_lep_hawk", "zhhawk"),
+)
+
+def peakrss():
+  """peak resident memory of this process in MB"""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def runreader(lhefileclass, filename, weights=False):
+  """iterates through filename with the LHEFile_* class, returns the number of events and the time"""
+  nevents = 0
+  start = time.time()
+  with getattr(lhefile, lhefileclass)(filename) as f:
+    for event in f:
+      if weights: f.weightarray
+      nevents += 1
+  return nevents, time.time() - start
+
+def runlhe2root(options, filename):
+  """runs lhe2root.py with options in this process, returns the number of events and the time from its --profile"""
+  tmpdir = tempfile.mkdtemp()
+  try:
+    profilefile = os.path.join(tmpdir, "profile.json")
+    argv = sys.argv
+    sys.argv = ["lhe2root.py", os.path.join(tmpdir, "out.root"), filename, "--profile", profilefile] + options.split()
+    try:
+      runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "lhe2root.py"), run_name="__main__")
+    finally:
+      sys.argv = argv
+    with open(profilefile) as f:
+      profile = json.load(f)
+    return profile["nevents"], profile["wall"]
+  finally:
+    shutil.rmtree(tmpdir)
+
+def runcase(kind, name, filename, weights=False, real_mela=False):
+  """runs one case in a new process, returns {"nevents", "seconds", "eventspersecond", "peakrss"}"""
+  command = [sys.executable, os.path.abspath(__file__), "case", kind, filename]
+  if weights: command.append("--weights")
+  if real_mela: command.append("--real-mela")
+  command += ["--", name]
+  process = subprocess.Popen(command, stdout=subprocess.PIPE)
+  output = process.communicate()[0]
+  if process.returncode: raise RuntimeError("{} failed:\n{}".format(" ".join(command), output))
+  return json.loads(output.strip().split("\n")[-1])
+
+def benchmarksuite(nevents=5000, nweights=200, seed=1, repeat=3, cases=None, baseline=None, savebaseline=False, tolerance=0.2, workdir=None, real_mela=False):
+  """
+  runs the suite cases whose names match the regex cases, returns the results and the list of regressions with respect to baseline
+  """
+  config = {"nevents": nevents, "nweights": nweights, "seed": seed, "mela": "real" if real_mela else "stub"}
+  reference = None
+  if baseline is not None and not savebaseline:
+    with open(baseline) as f:
+      reference = json.load(f)
+    if reference["config"] != config:
+      raise ValueError("The baseline {} was made with {}, not {}".format(baseline, reference["config"], config))
+
+  tmpdir = workdir or tempfile.mkdtemp()
+  results = {}
+  regressions = []
+  try:
+    for casename, kind, name, topology in suitecases:
+      if cases is not None and not re.search(cases, casename): continue
+      filename = os.path.join(tmpdir, "synthetic_{}_{}_{}_{}.lhe".format(topology, nevents, nweights, seed))
+      if not os.path.exists(filename):
+        writesyntheticfile(filename, topology, nevents, seed, nweights)
+      runs = [runcase(kind, name, filename, weights=(topology == "mg"), real_mela=real_mela) for _ in range(repeat)]
+      result = {"nevents": runs[0]["nevents"], "eventspersecond": max(_["eventspersecond"] for _ in runs), "peakrss": min(_["peakrss"] for _ in runs)}
+      results[casename] = result
+      line = "{:40} {:8d} events {:12.0f} events/s {:8.1f} MB peak RSS".format(casename, result["nevents"], result["eventspersecond"], result["peakrss"])
+      if reference is not None and casename in reference["results"]:
+        old = reference["results"][casename]
+        ratio = result["eventspersecond"] / old["eventspersecond"]
+        line += " {:+6.1%} speed, {:+6.1%} memory".format(ratio - 1, result["peakrss"] / old["peakrss"] - 1)
+        if ratio < 1 - tolerance:
+          regressions.append("{}: {:.0f} events/s, baseline {:.0f}".format(casename, result["eventspersecond"], old["eventspersecond"]))
+        if result["peakrss"] > old["peakrss"] * (1 + tolerance):
+          regressions.append("{}: {:.1f} MB peak RSS, baseline {:.1f}".format(casename, result["peakrss"], old["peakrss"]))
+      print line
+  finally:
+    if workdir is None: shutil.rmtree(tmpdir)
+
+  if savebaseline:
+    with open(baseline, "w") as f:
+      json.dump({"config": config, "results": results}, f, indent=2, sort_keys=True)
+    print "Wrote the baseline to", baseline
+  return results, regressions
+
+if __name__ == "__main__":
+  if args.command == "generate":
+    writesyntheticfile(args.outputfile, args.topology, args.nevents, args.seed, args.nweights)
+  if args.command == "case":
+    if args.kind == "reader":
+      nevents, elapsed = runreader(args.name, args.lhefile, weights=args.weights)
+    else:
+      nevents, elapsed = runlhe2root(args.name, args.lhefile)
+    print json.dumps({"nevents": nevents, "seconds": elapsed, "eventspersecond": nevents / elapsed if elapsed else float("inf"), "peakrss": peakrss()})
+  if args.command == "suite":
+    if args.save_baseline and not args.baseline: raise ValueError("--save-baseline needs --baseline")
+    results, regressions = benchmarksuite(
+      args.nevents, args.nweights, args.seed, args.repeat, args.cases, args.baseline, args.save_baseline, args.tolerance, args.workdir, args.real_mela,
+    )
+    if regressions:
+      print
+      print "PERFORMANCE REGRESSIONS (more than {:.0%} worse than {}):".format(args.tolerance, args.baseline)
+      for _ in regressions:
+        print "  " + _
+      sys.exit(1)
+  if args.command == "scan":
+    benchmarkscan(args.lhefile, compression=args.compression, blocksize=args.blocksize, repeat=args.repeat)
+  if args.command == "parse":
+    benchmarkparse(args.lhefile, args.lhefileclass, compression=args.compression, isgen=args.isgen, chunksize=args.chunksize, repeat=args.repeat)
+  if args.command == "decompress":
+    benchmarkdecompress(args.lhefile, blocksize=args.blocksize, threads=args.threads, repeat=args.repeat)
@@ -0,0 +1,306 @@
+"""
+Writers for columnar output files, which take blocks of events as numpy structured arrays
+and write each block as one row group, so that the memory use is bounded by the block size.
+Scalar fields become columns, array fields (e.g. weights) become fixed size list columns,
+or 2D datasets in HDF5.  metadata, a dict of strings, is stored in the schema (parquet, arrow)
+or as attributes of the file (hdf5).
+pyarrow (for parquet and arrow) and h5py (for hdf5) are only imported when they're used.
+"""
+
+import abc
+import collections
+import os
+
+import numpy
+
+#what readinfo returns: the fields as (name, numpy type, shape), where the shape of an array field is None
+#if the file has no events to tell its length, the metadata, the number of events and the compression
+ColumnFileInfo = collections.namedtuple("ColumnFileInfo", "fields metadata nevents compression compressionlevel")
+
+class ColumnWriterBase(object):
+  """
+  Example usage:
+    writer = ParquetWriter("out.parquet", block.dtype)
+    for block in blocks:
+      writer.write(block)
+    writer.close()
+  """
+  __metaclass__ = abc.ABCMeta
+
+  def __init__(self, filename, dtype, compression=None, compressionlevel=None, metadata=None):
+    self.filename = filename
+    self.metadata = dict(metadata or {})
+    self.dtype = numpy.dtype(dtype)
+    self.compression = compression
+    self.compressionlevel = compressionlevel
+    self.nbytes = 0
+
+  def write(self, block):
+    """writes the events in the structured array block as one row group"""
+    if not len(block): return
+    self.nbytes += block.nbytes
+    self.writeblock(block)
+
+  @abc.abstractmethod
+  def writeblock(self, block):
+    """writes one non-empty block"""
+
+  @abc.abstractmethod
+  def close(self):
+    """finishes the file"""
+
+  @classmethod
+  def concatenate(cls, filenames, outputfile, dtype, compression=None, compressionlevel=None, metadata=None):
+    """copies the row groups of filenames, in order, into a new file outputfile"""
+    writer = cls(outputfile, dtype, compression, compressionlevel, metadata)
+    for filename in filenames:
+      for block in cls.readblocks(filename, dtype):
+        writer.write(block)
+    writer.close()
+
+  @abc.abstractmethod
+  def readblocks(cls, filename, dtype):
+    """has to be a classmethod that yields the row groups of filename as structured arrays"""
+
+  @abc.abstractmethod
+  def readinfo(cls, filename):
+    """has to be a classmethod that returns the ColumnFileInfo of filename, without reading the events"""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *errorinfo):
+    self.close()
+
+class ArrowWriterBase(ColumnWriterBase):
+  def __init__(self, *args, **kwargs):
+    import pyarrow
+    self.pyarrow = pyarrow
+    super(ArrowWriterBase, self).__init__(*args, **kwargs)
+    self.schema = pyarrow.schema([self.arrowfield(name) for name in self.dtype.names], metadata=self.metadata or None)
+
+  def arrowfield(self, name):
+    fieldtype, shape = self.dtype.fields[name][0].base, self.dtype.fields[name][0].shape
+    arrowtype = self.pyarrow.from_numpy_dtype(fieldtype)
+    if shape:
+      arrowtype = self.pyarrow.list_(arrowtype)
+    return self.pyarrow.field(name, arrowtype)
+
+  def arrowcolumn(self, block, name):
+    column = block[name]
+    if column.ndim == 1:
+      return self.pyarrow.array(column)
+    length = column.shape[1]
+    offsets = numpy.arange(0, (len(column)+1)*length, length, dtype=numpy.int32)
+    return self.pyarrow.ListArray.from_arrays(self.pyarrow.array(offsets), self.pyarrow.array(column.ravel()))
+
+  def recordbatch(self, block):
+    return self.pyarrow.RecordBatch.from_arrays([self.arrowcolumn(block, name) for name in self.dtype.names], schema=self.schema)
+
+  def writetable(self, table):
+    """writes an arrow table with the same fields, e.g. a row group read with readtables"""
+    if not table.num_rows: return
+    self.nbytes += table.num_rows * self.dtype.itemsize
+    self.writetableblock(table)
+
+  @abc.abstractmethod
+  def writetableblock(self, table):
+    """writes one non-empty arrow table"""
+
+  @classmethod
+  def concatenate(cls, filenames, outputfile, dtype, compression=None, compressionlevel=None, metadata=None):
+    """copies the row groups of filenames, in order, into a new file outputfile, as arrow tables without converting them to numpy"""
+    writer = cls(outputfile, dtype, compression, compressionlevel, metadata)
+    for filename in filenames:
+      for table in cls.readtables(filename):
+        writer.writetable(table)
+    writer.close()
+
+  @abc.abstractmethod
+  def readtables(cls, filename, columns=None):
+    """has to be a classmethod that yields the row groups of filename as arrow tables, with only columns if given (where the format can read them separately)"""
+
+  @classmethod
+  def readblocks(cls, filename, dtype):
+    dtype = numpy.dtype(dtype)
+    for table in cls.readtables(filename, dtype.names):
+      yield cls.blockfromtable(table, dtype)
+
+  @staticmethod
+  def usermetadata(schema):
+    """the metadata of an arrow schema, without the entries that pyarrow adds itself"""
+    return {name: value for name, value in (schema.metadata or {}).iteritems() if not name.startswith("ARROW:")}
+
+  @classmethod
+  def fieldsfromschema(cls, schema, table):
+    """the fields of readinfo from an arrow schema, with the lengths of the list fields from the first row of table (None if there's no table)"""
+    import pyarrow
+    fields = []
+    for field in schema:
+      if not pyarrow.types.is_list(field.type):
+        fields.append((field.name, numpy.dtype(field.type.to_pandas_dtype()).str, ()))
+        continue
+      shape = None
+      if table is not None and table.num_rows:
+        first = table.column(field.name).chunks[0]
+        shape = (len(first.flatten()) // len(first),)
+      fields.append((field.name, numpy.dtype(field.type.value_type.to_pandas_dtype()).str, shape))
+    return tuple(fields)
+
+  @classmethod
+  def blockfromtable(cls, table, dtype):
+    block = numpy.zeros(table.num_rows, dtype=dtype)
+    for name in dtype.names:
+      column = table.column(name)
+      if dtype.fields[name][0].shape:
+        block[name] = numpy.concatenate([chunk.flatten().to_numpy() for chunk in column.chunks]).reshape(block[name].shape)
+      else:
+        block[name] = numpy.concatenate([chunk.to_numpy() for chunk in column.chunks])
+    return block
+
+class ParquetWriter(ArrowWriterBase):
+  compressions = {None: "NONE", "zlib": "GZIP", "zstd": "ZSTD", "lz4": "LZ4", "snappy": "SNAPPY"}
+
+  def __init__(self, *args, **kwargs):
+    super(ParquetWriter, self).__init__(*args, **kwargs)
+    import pyarrow.parquet
+    if self.compression not in self.compressions:
+      raise ValueError("parquet doesn't support {} compression".format(self.compression))
+    self.writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema, compression=self.compressions[self.compression], compression_level=self.compressionlevel)
+
+  def writeblock(self, block):
+    self.writer.write_table(self.pyarrow.Table.from_batches([self.recordbatch(block)]))
+
+  def writetableblock(self, table):
+    self.writer.write_table(table)
+
+  def close(self):
+    self.writer.close()
+
+  @classmethod
+  def readtables(cls, filename, columns=None):
+    import pyarrow.parquet
+    f = pyarrow.parquet.ParquetFile(filename)
+    for i in range(f.num_row_groups):
+      yield f.read_row_group(i, columns=list(columns) if columns is not None else None)
+
+  @classmethod
+  def readinfo(cls, filename):
+    import pyarrow
+    import pyarrow.parquet
+    f = pyarrow.parquet.ParquetFile(filename)
+    schema = f.schema.to_arrow_schema()
+    compression = None
+    if f.num_row_groups:
+      codec = f.metadata.row_group(0).column(0).compression
+      names = {parquetname: name for name, parquetname in cls.compressions.iteritems()}
+      names["UNCOMPRESSED"] = None
+      if codec not in names: raise ValueError("{} has {} compression, which isn't supported".format(filename, codec))
+      compression = names[codec]
+    #only the list fields of the first row group are read, for their lengths
+    listfields = [field.name for field in schema if pyarrow.types.is_list(field.type)]
+    first = f.read_row_group(0, columns=listfields) if f.num_row_groups and listfields else None
+    #parquet doesn't store the compression level
+    return ColumnFileInfo(cls.fieldsfromschema(schema, first), cls.usermetadata(schema), f.metadata.num_rows, compression, None)
+
+class ArrowWriter(ArrowWriterBase):
+  def __init__(self, *args, **kwargs):
+    super(ArrowWriter, self).__init__(*args, **kwargs)
+    if self.compression is not None:
+      raise ValueError("compression isn't supported for arrow output")
+    self.sink = self.pyarrow.OSFile(self.filename, "wb")
+    self.writer = self.pyarrow.RecordBatchFileWriter(self.sink, self.schema)
+
+  def writeblock(self, block):
+    self.writer.write_batch(self.recordbatch(block))
+
+  def writetableblock(self, table):
+    for batch in table.to_batches():
+      self.writer.write_batch(batch)
+
+  def close(self):
+    self.writer.close()
+    self.sink.close()
+
+  @classmethod
+  def readtables(cls, filename, columns=None):
+    import pyarrow
+    with pyarrow.OSFile(filename, "rb") as f:
+      reader = pyarrow.RecordBatchFileReader(f)
+      for i in range(reader.num_record_batches):
+        yield pyarrow.Table.from_batches([reader.get_batch(i)])
+
+  @classmethod
+  def readinfo(cls, filename):
+    import pyarrow
+    with pyarrow.memory_map(filename) as f:
+      reader = pyarrow.RecordBatchFileReader(f)
+      first = pyarrow.Table.from_batches([reader.get_batch(0)]) if reader.num_record_batches else None
+      nevents = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+      return ColumnFileInfo(cls.fieldsfromschema(reader.schema, first), cls.usermetadata(reader.schema), nevents, None, None)
+
+class HDF5Writer(ColumnWriterBase):
+  """one dataset per field in the group "tree", chunked by the row group size"""
+  compressions = {None: None, "zlib": "gzip"}
+
+  def __init__(self, *args, **kwargs):
+    import h5py
+    super(HDF5Writer, self).__init__(*args, **kwargs)
+    if self.compression not in self.compressions:
+      raise ValueError("hdf5 doesn't support {} compression".format(self.compression))
+    self.file = h5py.File(self.filename, "w")
+    self.group = self.file.create_group("tree")
+    for name, value in self.metadata.iteritems():
+      self.file.attrs[name] = value
+    self.nevents = 0
+
+  def writeblock(self, block):
+    if not self.nevents:
+      for name in self.dtype.names:
+        fieldtype, shape = self.dtype.fields[name][0].base, self.dtype.fields[name][0].shape
+        self.group.create_dataset(
+          name, shape=(0,)+shape, maxshape=(None,)+shape, dtype=fieldtype, chunks=(len(block),)+shape,
+          compression=self.compressions[self.compression],
+          compression_opts=self.compressionlevel if self.compression is not None else None,
+        )
+    for name in self.dtype.names:
+      dataset = self.group[name]
+      dataset.resize(self.nevents+len(block), axis=0)
+      dataset[self.nevents:] = block[name]
+    self.nevents += len(block)
+
+  def close(self):
+    self.file.close()
+
+  @classmethod
+  def readblocks(cls, filename, dtype):
+    import h5py
+    dtype = numpy.dtype(dtype)
+    with h5py.File(filename, "r") as f:
+      group = f["tree"]
+      if not dtype.names or dtype.names[0] not in group: return
+      first = group[dtype.names[0]]
+      chunksize = first.chunks[0] if first.chunks else len(first)
+      for start in range(0, len(first), chunksize):
+        block = numpy.zeros(min(chunksize, len(first)-start), dtype=dtype)
+        for name in dtype.names:
+          block[name] = group[name][start:start+len(block)]
+        yield block
+
+  @classmethod
+  def readinfo(cls, filename):
+    import h5py
+    with h5py.File(filename, "r") as f:
+      group = f["tree"]
+      #the datasets are only created with the first block, so a file without events has no fields
+      fields = tuple((name, group[name].dtype.str, group[name].shape[1:]) for name in group)
+      first = group[fields[0][0]] if fields else None
+      compression = {hdf5name: name for name, hdf5name in cls.compressions.iteritems()}[first.compression] if first is not None else None
+      return ColumnFileInfo(fields, dict(f.attrs), len(first) if first is not None else 0, compression, first.compression_opts if compression else None)
+
+writers = {"parquet": ParquetWriter, "arrow": ArrowWriter, "hdf5": HDF5Writer}
+extensions = {".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow", ".h5": "hdf5", ".hdf5": "hdf5"}
+
+def outputformat(filename):
+  """guesses the format from the extension, returns "root" for anything that isn't a columnar format"""
+  return extensions.get(os.path.splitext(filename)[1].lower(), "root")
@@ -0,0 +1,204 @@
+"""
+Four-vector arithmetic on numpy arrays, for the kinematics of whole chunks of events at once
+(see LHEColumns in lhefile.py), instead of one TLorentzVector at a time.
+A four-vector is a tuple of arrays (E, px, py, pz) with one entry per event.
+The formulas are the ones TLorentzVector uses, so the results agree with it to rounding.
+Example usage:
+  c = parsecolumns(events, LHEEvent_Hwithdecay)
+  pH = sumbyevent(c, c.role == DAUGHTER)
+  rapH = rapidity(pH)
+"""
+
+import numpy
+
+def particle(c, indices):
+  """the four-vectors of the particles at indices; where an index is -1 (see nth), the result is 0"""
+  valid = indices >= 0
+  safe = numpy.where(valid, indices, 0)
+  return tuple(numpy.where(valid, component[safe], 0.) for component in (c.E, c.px, c.py, c.pz))
+
+def sumbyevent(c, mask):
+  """sum of the particles in mask for each event of the columns c, added in the order of the file"""
+  nevents = len(c.eventoffset) - 1
+  return tuple(numpy.bincount(c.event[mask], weights=component[mask], minlength=nevents) for component in (c.E, c.px, c.py, c.pz))
+
+def add(*vectors):
+  """sum of the four-vectors, added from left to right"""
+  result = vectors[0]
+  for vector in vectors[1:]:
+    result = tuple(a + b for a, b in zip(result, vector))
+  return result
+
+def rank(c, mask):
+  """for each particle in mask, how many particles in mask come before it in its event; -1 for the others"""
+  cumulative = numpy.cumsum(mask)
+  before = numpy.concatenate(([0], cumulative))[c.eventoffset[:-1]]
+  return numpy.where(mask, cumulative - 1 - before[c.event], -1)
+
+def nth(c, mask, n, ranks=None):
+  """
+  index of the n'th particle (starting from 0) in mask in each event, or -1 if the event has fewer.
+  n can also be an array with one entry per particle, to pick a different one in each event.
+  """
+  if ranks is None: ranks = rank(c, mask)
+  result = numpy.full(len(c.eventoffset) - 1, -1, dtype=numpy.int64)
+  selected = numpy.flatnonzero((ranks == n) & (ranks >= 0))
+  result[c.event[selected]] = selected
+  return result
+
+def last(c, mask, ranks=None):
+  """index of the last particle in mask in each event, or -1 if it has none"""
+  return nth(c, mask, (count(c, mask) - 1)[c.event], ranks)
+
+def count(c, mask):
+  """number of particles in mask in each event"""
+  return numpy.bincount(c.event[mask], minlength=len(c.eventoffset) - 1)
+
+def minbyevent(c, mask, values):
+  """smallest of the values (one per particle) of the particles in mask in each event, nan if it has none"""
+  result = numpy.full(len(c.eventoffset) - 1, numpy.inf)
+  numpy.minimum.at(result, c.event[mask], values[mask])
+  return numpy.where(count(c, mask) > 0, result, numpy.nan)
+
+def maxbyevent(c, mask, values):
+  """largest of the values (one per particle) of the particles in mask in each event, nan if it has none"""
+  result = numpy.full(len(c.eventoffset) - 1, -numpy.inf)
+  numpy.maximum.at(result, c.event[mask], values[mask])
+  return numpy.where(count(c, mask) > 0, result, numpy.nan)
+
+def pt(p):
+  return numpy.sqrt(p[1]**2 + p[2]**2)
+
+def phi(p):
+  """like TVector3::Phi, 0 for a vector along the z axis"""
+  return numpy.where((p[1] == 0) & (p[2] == 0), 0., numpy.arctan2(p[2], p[1]))
+
+def eta(p):
+  """pseudorapidity, like TVector3::PseudoRapidity, +-10e10 along the z axis"""
+  magnitude = numpy.sqrt(p[1]**2 + p[2]**2 + p[3]**2)
+  with numpy.errstate(divide="ignore", invalid="ignore"):
+    costheta = numpy.where(magnitude == 0, 1., p[3] / magnitude)
+    result = -0.5 * numpy.log((1 - costheta) / (1 + costheta))
+  alongz = costheta**2 >= 1
+  return numpy.where(alongz, numpy.sign(p[3]) * 10e10, result)
+
+def rapidity(p):
+  with numpy.errstate(divide="ignore", invalid="ignore"):
+    return 0.5 * numpy.log((p[0] + p[3]) / (p[0] - p[3]))
+
+def mass(p):
+  """invariant mass, negative for spacelike vectors like TLorentzVector::M"""
+  m2 = p[0]**2 - (p[1]**2 + p[2]**2 + p[3]**2)
+  return numpy.where(m2 < 0, -numpy.sqrt(numpy.abs(m2)), numpy.sqrt(numpy.abs(m2)))
+
+def deltaphi(p1, p2):
+  """phi(p1) - phi(p2) in [-pi, pi), like TLorentzVector::DeltaPhi"""
+  difference = phi(p1) - phi(p2)
+  difference = numpy.where(difference >= numpy.pi, difference - 2*numpy.pi, difference)
+  return numpy.where(difference < -numpy.pi, difference + 2*numpy.pi, difference)
+
+def deltar(p1, p2):
+  return numpy.sqrt((eta(p1) - eta(p2))**2 + deltaphi(p1, p2)**2)
+
+def pairs(c, mask1, mask2):
+  """
+  all the pairs (i1, i2) of a particle in mask1 and a particle in mask2 in the same event,
+  as two index arrays, grouped by i1 and in the order of the file within each group
+  """
+  first, second = numpy.flatnonzero(mask1), numpy.flatnonzero(mask2)
+  n2 = count(c, mask2)
+  start2 = numpy.cumsum(n2) - n2
+  repeats = n2[c.event[first]]
+  i1 = numpy.repeat(first, repeats)
+  within = numpy.arange(len(i1)) - numpy.repeat(numpy.cumsum(repeats) - repeats, repeats)
+  i2 = second[numpy.repeat(start2[c.event[first]], repeats) + within]
+  return i1, i2
+
+def recombine(c, photons, leptons, cone=None):
+  """
+  adds the momentum of each particle in photons to the particle in leptons of the same event that is closest to it in deltar,
+  if that's within cone (None for any distance).  All the photons are matched to the leptons before any of them are added.
+  Returns the columns with the new momenta and masses, and the mask of the photons that were added.
+  """
+  photonindex, leptonindex = pairs(c, photons, leptons)
+  distance = deltar(particle(c, photonindex), particle(c, leptonindex))
+  #the closest lepton for each photon, the first one in the file if several are equally close
+  order = numpy.lexsort((distance, photonindex))
+  first = numpy.ones(len(order), dtype=bool)
+  first[1:] = photonindex[order][1:] != photonindex[order][:-1]
+  closest = order[first]
+  if cone is not None:
+    closest = closest[distance[closest] <= cone]
+  photonindex, leptonindex = photonindex[closest], leptonindex[closest]
+
+  momenta = [component.copy() for component in (c.E, c.px, c.py, c.pz)]
+  for component in momenta:
+    numpy.add.at(component, leptonindex, component[photonindex])
+  m = c.m.copy()
+  m[leptonindex] = mass(tuple(component[leptonindex] for component in momenta))
+  merged = numpy.zeros(len(c.id), dtype=bool)
+  merged[photonindex] = True
+  E, px, py, pz = momenta
+  return c._replace(E=E, px=px, py=py, pz=pz, m=m), merged
+
+if __name__ == "__main__":
+  import math
+  import sys
+  import unittest
+  import stubmela
+  stubmela.install()
+  from lhefile import ASSOCIATED, DAUGHTER, LHEEvent_HwithdecayOnly, parsecolumns
+
+  def masslessevent(particles):
+    """the text of an event with the massless particles (id, pt, eta, phi), which parsecolumns classifies with LHEEvent_HwithdecayOnly"""
+    lines = ["<event>", " {} 1 1.0 125.0 0.0078 0.11".format(len(particles))]
+    for id, particlept, particleeta, particlephi in particles:
+      px, py, pz = particlept*math.cos(particlephi), particlept*math.sin(particlephi), particlept*math.sinh(particleeta)
+      lines.append("{} 1 1 2 0 0 {!r} {!r} {!r} {!r} 0. 0. 9.".format(id, px, py, pz, math.sqrt(px**2 + py**2 + pz**2)))
+    return "\n".join(lines + ["</event>", ""])
+
+  class TestRecombine(unittest.TestCase):
+    def recombine(self, events, cone=None):
+      c = parsecolumns([masslessevent(_) for _ in events], LHEEvent_HwithdecayOnly)
+      photons, leptons = (c.role == ASSOCIATED) & (c.id == 22), c.role == DAUGHTER
+      result, merged = recombine(c, photons, leptons, cone)
+      return c, result, merged
+
+    def assertMerged(self, c, result, lepton, photons):
+      """the lepton at index lepton of the columns c has the momentum of itself and the photons in result, and the mass of that"""
+      expected = [sum(component[[lepton] + list(photons)]) for component in (c.E, c.px, c.py, c.pz)]
+      numpy.testing.assert_allclose([component[lepton] for component in (result.E, result.px, result.py, result.pz)], expected)
+      self.assertAlmostEqual(result.m[lepton], mass(tuple(numpy.array([_]) for _ in expected))[0])
+
+    def testOutsideCone(self):
+      #the photon is 0.5 away from the lepton
+      event = [(11, 50., 0., 0.), (-11, 40., 1., 2.), (22, 10., 0., 0.5)]
+      c, result, merged = self.recombine([event], cone=0.3)
+      self.assertFalse(merged.any())
+      for component in "E", "px", "py", "pz", "m":
+        numpy.testing.assert_array_equal(getattr(result, component), getattr(c, component))
+      for cone in 0.6, None:
+        c, result, merged = self.recombine([event], cone=cone)
+        self.assertEqual(list(merged), [False, False, True])
+        self.assertMerged(c, result, 0, [2])
+
+    def testEquidistant(self):
+      #the photon is between the two leptons, it goes to the first one in the file
+      event = [(13, 50., 0., 0.3), (-13, 50., 0., -0.3), (22, 10., 0., 0.)]
+      c, result, merged = self.recombine([event])
+      self.assertEqual(list(merged), [False, False, True])
+      self.assertMerged(c, result, 0, [2])
+      self.assertEqual(result.px[1], c.px[1])
+
+    def testSeveralPhotons(self):
+      #the first two photons go to the first lepton, the third is 0.52 from the first lepton and 0.48 from the second one.
+      #All the photons are matched before any of them are added, otherwise the first lepton would move to 0.39 from it.
+      event = [(11, 50., 0., 0.), (-11, 50., 0., 1.), (22, 40., 0., 0.3), (22, 5., 0., 0.1), (22, 10., 0., 0.52)]
+      c, result, merged = self.recombine([event, [(11, 50., 0., 0.), (22, 5., 0., 3.)]])
+      self.assertEqual(list(merged), [False, False, True, True, True, False, True])
+      self.assertMerged(c, result, 0, [2, 3])
+      self.assertMerged(c, result, 1, [4])
+      #photons are only matched to the leptons of the same event
+      self.assertMerged(c, result, 5, [6])
+
+  unittest.main(argv=sys.argv)
@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 import abc
 import collections
-import re
-import argparse, os
+import argparse, json, os
+
+import columnwriters
+
+def quarantinefilename(outputfile):
+  """the default --quarantine-file, also used for the quarantine files of the shards"""
+  return os.path.splitext(outputfile)[0] + ".quarantine.lhe"
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
@@ -21,581 +26,1277 @@ if __name__ == "__main__":
   g.add_argument("--ggH4l", action="store_true") # for ggH 4l JHUGen and prophecy  
   g.add_argument("--ggH4lMG", action="store_true") # for ggH4l Madgraph with weights
   parser.add_argument("--use-flavor", action="store_true")
+  parser.add_argument("--schema-version", type=int, choices=(1, 2), default=1, help="1: flavdau* are floats and --ggH4lMG writes weights[30] in the sorted order of the reweighting ids, as lhe2root always did, 2: flavdau* are ints and --ggH4lMG writes weights[nweights] in the order of the header.  The version is stored in the output metadata as schemaversion.")
   parser.add_argument("--merge_photon", action="store_true") # for ggH 4l JHUGen and prophecy
+  parser.add_argument("--photon-cone", type=float, help="with --merge_photon or --zh_lep_hawk, only merge a photon into the closest lepton if their deltaR is at most this, default: any deltaR.  With --zh_lep_hawk, the photons outside the cone are dropped from the event, like the merged ones are removed from the associated particles.")
   parser.add_argument("--calc_prodprob", action="store_true")
   parser.add_argument("--calc_decayprob", action="store_true")
   parser.add_argument("--CJLST", action="store_true")
   parser.add_argument("--reweight-to", choices="fa3-0.5")
+  parser.add_argument("--jobs", type=int, default=1, help="number of worker processes, each converting byte ranges of the input files with its own Mela")
+  parser.add_argument("--max-events", type=int, help="read at most this many events in total (before the bad events and the --cut events are left out)")
+  parser.add_argument("--skip-events", type=int, default=0, help="leave out the first N events of each input file")
+  parser.add_argument("--every", type=int, default=1, help="only read every N'th event of each input file, starting with the first one after --skip-events")
+  parser.add_argument("--sample-fraction", type=float, help="read a random subsample of this fraction of the events, which is the same for the same --seed")
+  parser.add_argument("--unweight", action="store_true", help="accept-reject unweighting on the event weight: keep each event with probability |weight| / the largest |weight| in its file, with the event weight set to +-that maximum")
+  parser.add_argument("--unweight-id", help="like --unweight, on the weight with this reweighting id")
+  parser.add_argument("--unweight-max", type=float, help="the maximum |weight| for --unweight, default: the largest one in each input file")
+  parser.add_argument("--seed", type=int, default=0, help="seed for --sample-fraction and --unweight")
+  parser.add_argument("--augment", help="an existing output of lhe2root from the same input files with the same event selection options: only compute the branches of this mode that it doesn't have, and write them to outputfile as a friend tree, after checking that the events are the same")
+  parser.add_argument("--cut", action="append", default=[], help="pre-selection on the kinematics before mela, e.g. \"M4L > 105 and njets >= 2\", can be given several times, see selection.py for the variables. Only the events that pass all the cuts are written, and the efficiency of each cut is printed at the end.")
+  parser.add_argument("--pipeline", action="store_true", help="convert in a pipeline: a reader thread that reads and decompresses the input, --jobs worker processes that parse the events and compute the branches, and this process writing a single output file in input order, instead of converting shards and merging them")
+  parser.add_argument("--pipeline-depth", type=int, help="with --pipeline, the maximum number of chunks of --chunk-size events that are read but not written yet, default: 4 per job")
+  parser.add_argument("--bad-events", choices=("fail", "skip", "quarantine"), default="fail", help="what to do with events that can't be parsed or classified: fail the conversion, skip them, or skip them and write them to --quarantine-file. The skipped events are counted by reason at the end.")
+  parser.add_argument("--quarantine-file", help="LHE file for the events skipped by --bad-events quarantine, with the reason and the line number of each, default: outputfile with the extension .quarantine.lhe")
+  parser.add_argument("--checkpoint-every", type=int, help="convert the input in shards of this many events, and record each finished shard in outputfile.checkpoint, so that --resume can continue after a failure")
+  parser.add_argument("--resume", action="store_true", help="continue a --checkpoint-every conversion (with the same options) from outputfile.checkpoint")
+  parser.add_argument("--mela-cache", help="sqlite file to cache the MELA probabilities in, so that reruns on the same events skip the computation")
+  parser.add_argument("--mela-cache-size", type=int, default=10000000, help="maximum number of probabilities in the cache")
+  parser.add_argument("--mela-cache-version", help="the cache is cleared when this changes, default: determined from the mela module and the mela libraries that are loaded")
+  parser.add_argument("--compression-algorithm", choices=("zlib", "lzma", "lz4", "zstd"), help="default: ROOT's default")
+  parser.add_argument("--compression-level", type=int, help="0-9, default: ROOT's default, or 4 if --compression-algorithm is given")
+  parser.add_argument("--basket-size", type=int, help="basket size in bytes for all branches")
+  parser.add_argument("--autoflush", type=int, help="TTree::SetAutoFlush: >0 flushes the baskets every N entries, <0 every -N bytes")
+  parser.add_argument("--autosave", type=int, help="TTree::SetAutoSave: >0 saves the tree header every N entries, <0 every -N bytes")
+  parser.add_argument("--chunk-size", type=int, default=1000, help="number of events to parse and compute the kinematics of together")
+  parser.add_argument("--fill-block", type=int, default=1000, help="number of events to buffer and fill into the tree together")
+  parser.add_argument("--output-format", choices=("root", "parquet", "arrow", "hdf5"), help="default: from the extension of the output file (.parquet, .arrow/.feather, .h5/.hdf5), otherwise root")
+  parser.add_argument("--row-group-size", type=int, default=100000, help="number of events per row group for the parquet, arrow and hdf5 outputs")
+  parser.add_argument("--profile", help="write the wall and CPU time of each stage and MELA hypothesis to this file, as json, or as csv if it ends with .csv")
+  parser.add_argument("--profile-sample-every", type=int, default=1000, help="keep the per stage times of every N'th event in the --profile output")
+  parser.add_argument("--profile-slowest", type=int, default=20, help="keep the per stage times of the N slowest events in the --profile output")
   args = parser.parse_args()
+  if args.output_format is None: args.output_format = columnwriters.outputformat(args.outputfile)
+  #a compressed file can only be split into byte ranges by decompressing everything before each range
+  from lhefile import detectcompression
+  compressed = [_ for _ in args.inputfile if os.path.exists(_) and detectcompression(_)]
+  if compressed and args.checkpoint_every:
+    print "Warning: {} {} compressed, so each --checkpoint-every shard decompresses {} from the beginning up to the shard".format(", ".join(compressed), "is" if len(compressed) == 1 else "are", "it" if len(compressed) == 1 else "them")
+  elif compressed and args.jobs > 1 and not args.pipeline:
+    print "{} {} compressed, so instead of splitting the input into shards, it's converted with --pipeline: one reader and {} worker processes".format(", ".join(compressed), "is" if len(compressed) == 1 else "are", args.jobs)
+    args.pipeline = True
+  if args.resume and not args.checkpoint_every: parser.error("--resume needs --checkpoint-every")
+  if args.pipeline and args.checkpoint_every: parser.error("--pipeline can't be used with --checkpoint-every")
+  if args.pipeline_depth is None: args.pipeline_depth = 4*args.jobs
+  if args.max_events is not None and (args.jobs > 1 or args.checkpoint_every) and not args.pipeline: parser.error("--max-events can't be used with --checkpoint-every, or with --jobs without --pipeline, because the shards are converted separately")
+  if args.augment and (args.checkpoint_every or (args.jobs > 1 and not args.pipeline)): parser.error("--augment can't be used with --checkpoint-every, or with --jobs without --pipeline, because the events are checked against the existing output in order")
+  if args.augment and columnwriters.outputformat(args.augment) != args.output_format: parser.error("--augment: the output format has to be the same as the format of "+args.augment)
+  if args.quarantine_file is None: args.quarantine_file = quarantinefilename(args.outputfile)
 
   if os.path.exists(args.outputfile): raise IOError(args.outputfile+" already exists")
+  if args.bad_events == "quarantine" and os.path.exists(args.quarantine_file): raise IOError(args.quarantine_file+" already exists")
   for _ in args.inputfile:
     if not os.path.exists(_) and not args.CJLST: raise IOError(_+" doesn't exist")
+  if args.augment and not os.path.exists(args.augment): raise IOError(args.augment+" doesn't exist")
 
-from array import array
 import itertools
+import multiprocessing
+import Queue
+import shutil
+import threading
+import time
+import traceback
+
+import numpy
 
 import ROOT
 
-from lhefile import LHEFile_JHUGenVBFVH, LHEFile_Hwithdecay, LHEFile_VHHiggsdecay,LHEFile_HwithdecayOnly, LHEFile_Offshell4l,LHEFile_StableHiggs,LHEFile_StableHiggsZHHAWK
+import fourvectors
+from lhefile import ASSOCIATED, DAUGHTER, NOROLE, BadEventHandler, EventSampler, failonbadevents, openlhefile, parsechunk, scanevents, LHEFile_JHUGenVBFVH, LHEFile_Hwithdecay, LHEFile_VHHiggsdecay,LHEFile_HwithdecayOnly, LHEFile_Offshell4l,LHEFile_StableHiggs,LHEFile_StableHiggsZHHAWK, LHEHeader, LHEIndex, readweightids
 from mela import Mela, SimpleParticle_t, SimpleParticleCollection_t, TVar
 from pythonmelautils import MultiDimensionalCppArray, SelfDParameter, SelfDCoupling
 
+from melacache import MelaCache, printreport
+from melahypotheses import HypothesisEngine
+from melapool import melapool
+from mergeoutputs import readinfo, rootcompressionsettings
+from profiler import nullprofiler, Profiler
+from selection import Selection
+
 
 def tlvfromptetaphim(pt, eta, phi, m):
   result = ROOT.TLorentzVector()
   result.SetPtEtaPhiM(pt, eta, phi, m)
   return result
 
-class Event(object):
-  doneinit = False
-  def __init__(self, mela, daughters, associated, mothers, isgen, weight=1):
-    self.daughters = daughters
-    self.associated = associated
-    self.mothers = mothers
-    self.isgen = isgen
-    self.weight = weight
-    self.mela = mela
-    self.mela.setInputEvent(daughters, associated, mothers, isgen)
-    self.doneinit = True
+def isVH(args):
+  return args.zh or args.wh or args.zh_lep or args.wh_lep or args.zh_lep_hawk
+
+def isVHwithdecay(args):
+  return args.zh_withdecay or args.wh_withdecay
+
+vhanglebranches = ("mV", "mVstar", "costheta1", "costheta2", "Phi", "costhetastar", "Phi1")
+vbfanglebranches = ("q2V1", "q2V2", "costheta1", "costheta2", "Phi", "costhetastar", "Phi1")
+decayanglebranches = ("M4L", "MZ1", "MZ2", "costheta1d", "costheta2d", "Phid", "costhetastard", "Phi1d")
+probabilitybranches = ("pg1", "pg4", "pg2", "pg1g2", "pg1g4", "pg2za", "pg4za", "pg1g2za", "pg1g4za", "D0minus", "D0hplus", "DCP", "Dint", "D0minus_za", "D0hplus_za", "Dint_za", "DCP_za")
+daughterbranches = tuple(tuple("{}dau{}".format(variable, i) for variable in ("pt", "px", "py", "pz", "E", "flav")) for i in range(1, 5))
+
+#groups of output branches: names, type ("f" or "i"), array length (None for a scalar,
+#(count branch, maximum length) for a variable length array, or a function of args that returns one of those)
+#and which modes fill them, so that each mode only allocates the branches it fills.
+#--schema-version 1 is the layout of the older outputs, which downstream code expects by default
+branchschema = (
+  (("costheta1", "costheta2", "Phi1", "costhetastar", "Phi"), "f", None,
+    lambda args: isVH(args) or isVHwithdecay(args) or args.vbf or args.vbf_withdecay),
+  (decayanglebranches, "f", None,
+    lambda args: isVHwithdecay(args) or args.vbf_withdecay or args.ggH4l or args.ggH4lMG),
+  (probabilitybranches, "f", None,
+    lambda args: args.calc_prodprob or args.calc_decayprob),
+  (("mV", "mVstar"), "f", None,
+    lambda args: isVH(args) or isVHwithdecay(args)),
+  (("q2V1", "q2V2", "HJJpz"), "f", None,
+    lambda args: args.vbf or args.vbf_withdecay),
+  (("Dphijj",), "f", None,
+    lambda args: args.vbf),
+  (("ptH", "pxH", "pyH", "pzH", "EH", "rapH"), "f", None,
+    lambda args: not args.ggH4l),
+  (("pxj1", "pyj1", "pzj1", "Ej1", "pxj2", "pyj2", "pzj2", "Ej2", "rapHJJ"), "f", None,
+    lambda args: args.vbf or args.zh or args.wh or args.zh_lep_hawk),
+  (("pxph1", "pyph1", "pzph1", "Eph1"), "f", None,
+    lambda args: args.ggH4l),
+  (("weight",), "f", None,
+    lambda args: not args.ggH4lMG),
+  (("nweights",), "i", None,
+    lambda args: args.ggH4lMG and args.schema_version >= 2),
+  (("weights",), "f", lambda args: ("nweights", len(args.weightids)) if args.schema_version >= 2 else legacynweights,
+    lambda args: args.ggH4lMG),
+  (tuple(name for names in daughterbranches for name in names if not name.startswith("flav")), "f", None,
+    lambda args: not (args.vbf or isVH(args))),
+  (tuple(names[-1] for names in daughterbranches), "f", None,
+    lambda args: not (args.vbf or isVH(args)) and args.schema_version < 2),
+  (tuple(names[-1] for names in daughterbranches), "i", None,
+    lambda args: not (args.vbf or isVH(args)) and args.schema_version >= 2),
+)
+
+#the fixed length of the weights branch in --schema-version 1
+legacynweights = 30
+
+#branches that are computed without mela and identify an event, which --augment compares with the existing output
+alignmentbranches = ("weight", "nweights", "weights", "pzH", "pzdau1", "pzj1")
+
+def activebranches(args):
+  """
+  returns (name, type, length) of the branches that are filled with these arguments,
+  with --augment only the ones that are added to the existing output (args.newbranches) and its alignmentbranches
+  """
+  result = [(name, type, length(args) if callable(length) else length) for names, type, length, condition in branchschema if condition(args) for name in names]
+  if args.augment:
+    result = [_ for _ in result if _[0] in args.newbranches or _[0] in args.alignmentbranches]
+  return result
 
-  def __getattr__(self, attr):
-    return getattr(self.mela, attr)
+def writtenbranches(args):
+  """the activebranches that are written to the output, which leaves out the alignmentbranches with --augment"""
+  return [_ for _ in activebranches(args) if not args.augment or _[0] in args.newbranches]
+
+def augmentbranches(args):
+  """
+  for --augment, returns the branches of this mode that the existing output doesn't have and the alignmentbranches that it does have.
+  A group of branches that are computed together (see branchschema) is added whole if any of them is missing.
+  """
+  info = readinfo(args.augment)
+  if info.metadata.get("schemaversion", "1") != str(args.schema_version):
+    raise ValueError("{} has schema version {}, not {} (see --schema-version)".format(args.augment, info.metadata.get("schemaversion", "1"), args.schema_version))
+  existing = dict(info.branches)
+  newbranches = [name for names, type, length, condition in branchschema if condition(args) and any(name not in existing for name in names) for name in names]
+  if not newbranches: raise ValueError(args.augment+" already has all the branches of this mode")
+  alignment = [name for name in alignmentbranches if name in existing and name not in newbranches]
+  if not alignment: raise ValueError("{} doesn't have any of the branches {}, which are needed to check that the events are the same".format(args.augment, ", ".join(alignmentbranches)))
+  return tuple(newbranches), tuple(alignment)
+
+class EventRecord(object):
+  """
+  The output branches of one event, stored in a single numpy record that all the branches point into.
+  record[name][0] = value sets a scalar branch, record[name][i] = value an element of an array branch,
+  and record.set(names, values) copies several scalar branches at once, leaving out the ones that aren't in the record.
+  A variable length array is allocated with its maximum length, and its count branch has to be set too.
+  If t is None, the record isn't connected to a tree (for the columnar outputs).
+  """
+  numpytypes = {"f": numpy.float32, "i": numpy.int32}
+  leaftypes = {"f": "F", "i": "I"}
+
+  def __init__(self, t, branches):
+    self.buffer = numpy.zeros(1, dtype=[(name, self.numpytypes[type], (self.maxlength(length),) if length else ()) for name, type, length in branches])
+    self.views = {}
+    self.multiviews = {}
+    for name, type, length in branches:
+      #for a scalar this is an array of length 1, for an array branch it's the array itself
+      self.views[name] = self.buffer[name] if not length else self.buffer[name][0]
+      if t is None: continue
+      leaf = name + ("[{}]".format(length[0] if isinstance(length, tuple) else length) if length else "") + "/" + self.leaftypes[type]
+      t.Branch(name, self.views[name], leaf)
+
+  @staticmethod
+  def maxlength(length):
+    return length[1] if isinstance(length, tuple) else length
+
+  def __getitem__(self, name):
+    return self.views[name]
+
+  def __contains__(self, name):
+    return name in self.views
+
+  def wants(self, names):
+    """whether any of the branches names are in the record, so that they have to be computed"""
+    return any(name in self.views for name in names)
+
+  def set(self, names, values):
+    """names is a tuple of scalar branches, values the corresponding values"""
+    #field by field through the views of each branch: indexing the buffer with a list of fields gives a copy before numpy 1.16
+    try:
+      present = self.multiviews[names]
+    except KeyError:
+      present = self.multiviews[names] = [(k, self.views[name]) for k, name in enumerate(names) if name in self.views]
+    for k, view in present:
+      view[0] = values[k]
+
+def setupbranches(t, args):
+  """creates the output branches that this mode writes on the tree t and returns their EventRecord"""
+  return EventRecord(t, writtenbranches(args))
+
+
+def compressionsettings(args):
+  """returns ROOT's compression settings, 100*algorithm + level, or None to use ROOT's default"""
+  return rootcompressionsettings(args.compression_algorithm, args.compression_level)
+
+class BlockWriter(object):
+  """
+  Base class of the output writers.
+  The events are filled through record (the EventRecord of the branches): set the branches, then call fill().
+  fill() copies the event into a block of blocksize events, and the full block is written at once,
+  so the conversion and the writing each run in tight loops.
+  With --augment, each block goes through the EventAligner before it's written.
+  Example usage:
+    writer = outputwriter(args, "out.root")
+    for event in events:
+      writer.record["M4L"][0] = ...
+      writer.fill()
+    writer.close()
+    printwritereport("out.root", writer.stats)
+  """
+  __metaclass__ = abc.ABCMeta
 
-  def __setattr__(self, attr, value):
-    if self.doneinit:
-      return setattr(self.mela, attr, value)
-    return super(Event, self).__setattr__(attr, value)
+  def __init__(self, record, blocksize, aligner=None):
+    self.record = record
+    self.aligner = aligner
+    self.block = numpy.zeros(max(blocksize, 1), dtype=self.record.buffer.dtype)
+    self.nblock = 0
+    self.nevents = 0
+    self.writetime = 0
+
+  def fill(self):
+    self.block[self.nblock] = self.record.buffer[0]
+    self.nblock += 1
+    self.nevents += 1
+    if self.nblock == len(self.block):
+      self.flush()
+
+  def fillblock(self, events):
+    """fills an array of events with the dtype of record.buffer, e.g. converted in another process"""
+    start = 0
+    while start < len(events):
+      n = min(len(self.block) - self.nblock, len(events) - start)
+      self.block[self.nblock:self.nblock+n] = events[start:start+n]
+      self.nblock += n
+      self.nevents += n
+      start += n
+      if self.nblock == len(self.block):
+        self.flush()
+
+  def flush(self):
+    """writes the buffered events"""
+    block = self.block[:self.nblock]
+    if self.aligner is not None: block = self.aligner.align(block)
+    start = time.time()
+    self.writeblock(block)
+    self.nblock = 0
+    self.writetime += time.time() - start
 
+  @abc.abstractmethod
+  def writeblock(self, block):
+    pass
 
+  def close(self):
+    self.flush()
+    if self.aligner is not None: self.aligner.close()
+    start = time.time()
+    self.stats = self.finish()
+    self.writetime += time.time() - start
+    self.stats.update(nevents=self.nevents, writetime=self.writetime)
 
-class LHEEvent(object):
-  __metaclass__ = abc.ABCMeta
-  def __init__(self, event, isgen):
-    lines = event.split("\n")
-
-    self.weights = {}
-    for line in lines:
-      if "<wgt" not in line: continue
-      match = re.match("<wgt id='(.*)'>([0-9+Ee.-]*)</wgt>", line)
-      if match: self.weights[match.group(1)] = float(match.group(2))
-    lines = [line for line in lines if not ("<" in line or ">" in line or not line.split("#")[0].strip())]
-    nparticles, _, weight, _, _, _ = lines[0].split()
-
-    nparticles = int(nparticles)
-    self.weight = float(weight)
-    if nparticles != len(lines)-1:
-      raise ValueError("Wrong number of particles! Should be {}, have {}".format(nparticles, len(lines)-1))
-
-    daughters, associated, mothers = (SimpleParticleCollection_t(_) for _ in self.extracteventparticles(lines[1:], isgen))
-    if not list(mothers): mothers = None
-    self.daughters, self.associated, self.mothers, self.isgen = self.inputevent = InputEvent(daughters, associated, mothers, isgen)
+  @abc.abstractmethod
+  def finish(self):
+    """closes the file and returns the dict of totbytes (uncompressed) and zipbytes (compressed)"""
 
   @abc.abstractmethod
-  def extracteventparticles(cls, lines, isgen): "has to be a classmethod that returns daughters, associated, mothers"
+  def merge(cls, args, filenames, outputfile, metadata=None):
+    """has to be a classmethod that concatenates the files written by several writers, in order, and stores metadata in the result"""
 
-  def __iter__(self):
-    return iter(self.inputevent)
+  @abc.abstractmethod
+  def readblocks(cls, args, filename, branches, blocksize):
+    """has to be a classmethod that yields the branches ((name, type, length) as in activebranches) of an existing output in blocks of about blocksize events"""
+
+class TreeWriter(BlockWriter):
+  """
+  Creates the output file and tree with the compression, basket size and auto-flush/save settings from args.
+  The tree is filled from the block of --fill-block events.
+  With --augment, the events are converted in their own record, because the tree doesn't have the alignmentbranches.
+  """
+  def __init__(self, args, filename, metadata=None, aligner=None):
+    self.filename = filename
+    self.metadata = metadata
+    settings = compressionsettings(args)
+    if settings is None:
+      self.file = ROOT.TFile(filename, "RECREATE")
+    else:
+      self.file = ROOT.TFile(filename, "RECREATE", "", settings)
+    self.tree = ROOT.TTree("tree", "tree")
+    self.treerecord = setupbranches(self.tree, args)
+    super(TreeWriter, self).__init__(EventRecord(None, activebranches(args)) if args.augment else self.treerecord, args.fill_block, aligner)
+    if args.basket_size is not None: self.tree.SetBasketSize("*", args.basket_size)
+    if args.autoflush is not None: self.tree.SetAutoFlush(args.autoflush)
+    if args.autosave is not None: self.tree.SetAutoSave(args.autosave)
+
+  def writeblock(self, block):
+    buffer, tree = self.treerecord.buffer, self.tree
+    for event in block:
+      buffer[0] = event
+      tree.Fill()
+    #the last event in the block is the current one, so the record is unchanged
+
+  def finish(self):
+    self.file.Write()
+    writemetadata(self.file, self.metadata)
+    stats = {"totbytes": self.tree.GetTotBytes(), "zipbytes": self.tree.GetZipBytes()}
+    self.file.Close()
+    return stats
 
+  @classmethod
+  def merge(cls, args, filenames, outputfile, metadata=None):
+    merger = ROOT.TFileMerger(False)
+    settings = compressionsettings(args)
+    if settings is None:
+      merger.OutputFile(outputfile, "RECREATE")
+    else:
+      merger.OutputFile(outputfile, "RECREATE", settings)
+    for filename in filenames:
+      merger.AddFile(filename)
+    if not merger.Merge():
+      raise RuntimeError("Failed to merge the shards into "+outputfile)
+    if metadata:
+      f = ROOT.TFile(outputfile, "UPDATE")
+      writemetadata(f, metadata)
+      f.Close()
 
-class LHEEvent_Offshell4l(LHEEvent):
   @classmethod
-  def extracteventparticles(cls, lines, isgen):
-    daughters, mothers, associated = [], [], []
-
-    for line in lines:
-      id, status, mother1, mother2 = (int(_) for _ in line.split()[0:4])
-      if (1 <= abs(id) <= 6 or abs(id) == 21) and not isgen:
-        line = line.replace(str(id), "0", 1)  #replace the first instance of the jet id with 0, which means unknown jet
-      if status == -1:
-        mothers.append(line)
-
-      if ( abs(id) in ( 25) or abs(id) in (25)  ) and status == 1:
-        daughters.append(line)
-        print "added daught"
-        flav4l = flav4l*abs(id)
-
-        #      if ( abs(id) in (11, 12, 13, 14, 15, 16) or abs(id) in (1, 2, 3, 4, 5)  ) and status == 1:
-        #       daughters.append(line)
-        #       flav4l = flav4l*abs(id)
-      #if abs(id) in (0, 1, 2, 3, 4, 5, 21) and status == 1:
-      #  associated.append(line)
-      #if abs(id) in (0, 1, 2, 3, 4, 5, 21) and status == 1:
-      #  associated.append(line)
-
-    #if len(daughters) == 4:
-      #print "flavour comp:",flav4l
-    #if len(daughters) != 4:
-    #  raise ValueError("Wrong number of daughters (expected {}, found {})\n\n".format(4, len(daughters))+"\n".join(lines))
-    if cls.nassociatedparticles is not None and len(associated) != cls.nassociatedparticles:
-      raise ValueError("Wrong number of associated particles (expected {}, found {})\n\n".format(cls.nassociatedparticles, len(associated))+"\n".join(lines))
-    if len(mothers) != 2:
-      raise ValueError("{} mothers in the event??\n\n".format(len(mothers))+"\n".join(lines))
-
-    if not isgen: mothers = None
-    return daughters, associated, mothers
-
-  nassociatedparticles = None
-
-
-
-bad = False
-
-
-try:
-  newf = ROOT.TFile(args.outputfile, "RECREATE")
-  t = ROOT.TTree("tree", "tree")
-
-  branchnames_float = "costheta1", "costheta2", "Phi1", "costhetastar", "Phi", "HJJpz","M4L","MZ1","MZ2","costheta1d","costheta2d","Phid","costhetastard","Phi1d"
-  if args.calc_prodprob or args.calc_decayprob :
-    branchnames_float += ("pg1", "pg4","pg2","pg1g2","pg1g4","pg2za","pg4za","pg1g2za","pg1g4za","D0minus","D0hplus", "DCP", "Dint","D0minus_za","D0hplus_za","Dint_za","DCP_za")
-  if args.zh or args.wh or args.zh_withdecay or args.wh_withdecay or args.zh_lep or args.wh_lep or args.zh_lep_hawk:
-    branchnames_float += ("mV", "mVstar",    "pxj1", "pyj1", "pzj1", "Ej1",
-    "pxj2", "pyj2", "pzj2", "Ej2")
-    
-  if args.ggH4lMG:
-    branchnames_float_array=("weights",)
-    num_weights=30
-  if args.vbf or args.vbf_withdecay:
-    branchnames_float += ("q2V1", "q2V2","Dphijj")
-  branchnames_float += (
-    
-    "ptH", "pxH",  "pyH",  "pzH",  "EH","rapH","rapHJJ","decayMode","qfl1","qfl2","qfl1mom","qfl2mom",
-    "pxj1", "pyj1", "pzj1", "Ej1",
-    "pxj2", "pyj2", "pzj2", "Ej2",
-    "pxph1","pyph1","pzph1","Eph1",
-    "weight",
-    "ptdau1","pxdau1","pydau1","pzdau1","Edau1","flavdau1", 
-    "ptdau2","pxdau2","pydau2","pzdau2","Edau2","flavdau2",
-    "ptdau3","pxdau3","pydau3","pzdau3","Edau3","flavdau3",
-    "ptdau4","pxdau4","pydau4","pzdau4","Edau4","flavdau4",
+  def readblocks(cls, args, filename, branches, blocksize):
+    f = ROOT.TFile.Open(filename)
+    if not f or f.IsZombie(): raise IOError("Can't open "+filename)
+    try:
+      tree = f.Get("tree")
+      record = EventRecord(None, branches)
+      #only the branches that are read, and the count branches of the variable length arrays
+      tree.SetBranchStatus("*", 0)
+      for name, type, length in branches:
+        if isinstance(length, tuple): tree.SetBranchStatus(length[0], 1)
+        tree.SetBranchStatus(name, 1)
+        tree.SetBranchAddress(name, record[name])
+      nevents = tree.GetEntries()
+      for start in range(0, nevents, blocksize):
+        block = numpy.zeros(min(blocksize, nevents-start), dtype=record.buffer.dtype)
+        for i in range(len(block)):
+          tree.GetEntry(start+i)
+          block[i] = record.buffer[0]
+        yield block
+    finally:
+      f.Close()
+
+class ColumnWriter(BlockWriter):
+  """
+  Writes the same branches as columns of a parquet, arrow or hdf5 file (see columnwriters.py),
+  one row group per block of --row-group-size events, so the memory use doesn't grow with the number of events.
+  """
+  def __init__(self, args, filename, metadata=None, aligner=None):
+    self.filename = filename
+    super(ColumnWriter, self).__init__(EventRecord(None, activebranches(args)), args.row_group_size, aligner)
+    dtype = EventRecord(None, writtenbranches(args)).buffer.dtype
+    self.writer = columnwriters.writers[args.output_format](filename, dtype, args.compression_algorithm, args.compression_level, metadata)
+
+  def writeblock(self, block):
+    self.writer.write(block)
+
+  def finish(self):
+    self.writer.close()
+    return {"totbytes": self.writer.nbytes, "zipbytes": os.path.getsize(self.filename)}
+
+  @classmethod
+  def merge(cls, args, filenames, outputfile, metadata=None):
+    dtype = EventRecord(None, writtenbranches(args)).buffer.dtype
+    columnwriters.writers[args.output_format].concatenate(filenames, outputfile, dtype, args.compression_algorithm, args.compression_level, metadata)
+
+  @classmethod
+  def readblocks(cls, args, filename, branches, blocksize):
+    #in the row groups of the file
+    return columnwriters.writers[args.output_format].readblocks(filename, EventRecord(None, branches).buffer.dtype)
+
+def outputwriter(args, filename, metadata=None):
+  """
+  returns the writer for --output-format, which stores metadata (a dict of strings, see lhemetadata) in the file,
+  with --augment with an EventAligner that checks the events against the existing output
+  """
+  writerclass = TreeWriter if args.output_format == "root" else ColumnWriter
+  aligner = None
+  if args.augment:
+    alignment = [_ for _ in activebranches(args) if _[0] in args.alignmentbranches]
+    aligner = EventAligner(args.augment, writerclass.readblocks(args, args.augment, alignment, args.fill_block), EventRecord(None, writtenbranches(args)).buffer.dtype)
+  return writerclass(args, filename, metadata, aligner)
+
+class EventAligner(object):
+  """
+  For --augment: checks that the converted events are the events of the existing output, in the same order,
+  by comparing the alignmentbranches with the blocks of the existing output to the relative tolerance rtol,
+  and returns the converted blocks with only the branches in dtype, the ones that are written.
+  The branches are float32, and an output from an older lhe2root, which computed them one event at a time
+  with TLorentzVector instead of per chunk with fourvectors, only agrees to rounding, so they can differ by a few ulps.
+  The default of 1e-5 allows about 100 float32 ulps, and is still far below the differences between two events.
+  """
+  def __init__(self, filename, existingblocks, dtype, rtol=1e-5):
+    self.filename = filename
+    self.existingblocks = existingblocks
+    self.dtype = dtype
+    self.rtol = rtol
+    self.pending = []
+    self.nevents = 0
+
+  def existing(self, n):
+    """the next n events of the existing output, fewer at its end"""
+    pieces, have = [], 0
+    while have < n:
+      if not self.pending:
+        block = next(self.existingblocks, None)
+        if block is None: break
+        self.pending = [block]
+      piece = self.pending[0][:n-have]
+      self.pending = [self.pending[0][n-have:]] if len(self.pending[0]) > n-have else []
+      pieces.append(piece)
+      have += len(piece)
+    return pieces
+
+  def align(self, block):
+    pieces = self.existing(len(block))
+    nexisting = sum(len(_) for _ in pieces)
+    if nexisting < len(block):
+      raise ValueError("There are more events than the {} in {}, which has to be converted from the same input files with the same options".format(self.nevents + nexisting, self.filename))
+    existing = numpy.concatenate(pieces) if pieces else block[:0]
+    for name in existing.dtype.names:
+      same = numpy.isclose(block[name], existing[name], rtol=self.rtol, atol=0, equal_nan=True)
+      if same.ndim > 1: same = same.all(axis=1)
+      if not same.all():
+        k = numpy.flatnonzero(~same)[0]
+        raise ValueError("Event {} is different from the one in {}: {} is {} instead of {}, it has to be converted from the same input files with the same options".format(
+          self.nevents + k, self.filename, name, block[name][k], existing[name][k]))
+    self.nevents += len(block)
+    result = numpy.zeros(len(block), dtype=self.dtype)
+    for name in self.dtype.names:
+      result[name] = block[name]
+    return result
+
+  def close(self):
+    if self.existing(1):
+      raise ValueError("{} has more than the {} events that were converted, which have to be from the same input files with the same options".format(self.filename, self.nevents))
+
+def writemetadata(rootfile, metadata):
+  """writes each entry of metadata to rootfile as a TNamed, with the value as its title"""
+  for name, value in (metadata or {}).iteritems():
+    rootfile.WriteTObject(ROOT.TNamed(name, value), name)
+
+def lhemetadata(inputfiles):
+  """
+  the headers of the input files (see LHEHeader.asdict), for the output file:
+  {"lhemetadata": json list with one entry per input file}
+  Only the beginning of each file, before the first event, is read.
+  """
+  return {"lhemetadata": json.dumps([
+    collections.OrderedDict([("filename", inputfile)] + LHEHeader.read(inputfile).asdict().items())
+    for inputfile in inputfiles if os.path.exists(inputfile)
+  ])}
+
+def printwritereport(filename, stats):
+  """prints the write throughput and compression ratio, stats can be summed over several TreeWriter objects"""
+  megabytes = stats["totbytes"] / 1e6
+  print "Wrote {} events to {}: {:.1f} MB uncompressed, {:.1f} MB on disk, compression ratio {:.2f}, {:.1f} MB/s in {:.1f} s of filling and writing".format(
+    stats["nevents"], filename, megabytes, os.path.getsize(filename) / 1e6,
+    float(stats["totbytes"]) / stats["zipbytes"] if stats["zipbytes"] else 0,
+    megabytes / stats["writetime"] if stats["writetime"] else 0, stats["writetime"],
   )
 
-  branchnames_int = ()
-
-  branches = {name: array("f", [0]) for name in branchnames_float}
-  branches_int = {name: array("i", [0]) for name in branchnames_int}
-  if args.ggH4lMG:
-    branches_float = {name: array("f",[0]*num_weights) for name in branchnames_float_array}
-    print branches_float,branchnames_float_array,"here"
-    for name in branches_float:
-      t.Branch(name, branches_float[name], name+"[30]/F")
-    branches.update(branches_float)
-  for name in branchnames_float:
-    t.Branch(name, branches[name], name+"/F")
-  for name in branchnames_int:
-    t.Branch(name, branches_int[names], name+"/I")
-
-  branches.update(branches_int)
-  g4 = 0
-  if args.zh:
-    g4 = 0.144057
-  if args.wh:
-    g4 = 0.1236136
-  if args.vbf:
-    g4 = 0.297979
-  
-  
-  for inputfile in args.inputfile:
-    print inputfile
-    inputfclass = LHEFile_Hwithdecay(inputfile,isgen=args.use_flavor)
-    if args.ggH4l : 
-      inputfclass = LHEFile_HwithdecayOnly(inputfile,isgen=args.use_flavor)
-    if args.vbf or args.zh or args.wh or args.zh_lep or args.wh_lep  :
-      inputfclass = LHEFile_StableHiggs(inputfile,isgen=args.use_flavor)
-    if args.zh_withdecay or args.wh_withdecay  :
-      inputfclass = LHEFile_VHHiggsdecay(inputfile,isgen=args.use_flavor)
-    if args.zh_lep_hawk :
-      print ("Algorithm will automaticaly merge associated FSR photons to the leptons")
-      inputfclass = LHEFile_StableHiggsZHHAWK(inputfile,isgen=args.use_flavor)
-
-    #inputfclass = LHEFile_Hwithdecay(inputfile,isgen=args.use_flavor)
-    
-    with inputfclass  as f:
-      for i, event in enumerate(f):
-        print "here"
-        #debugging purposes
-        if i > 10000 : 
-          break
-        
-        #if( i % 100 == 0): 
-        #  print ("Processed", i, " events",end="\r")
-        
-        
-	### Automatically detect Had or Lep associated for VH production###
-        associated_flavor = 0
-        for a in event.associated:
-          associated_flavor=abs(a.first)
-          print associated_flavor
-        if associated_flavor in [1,2,3,4,5,6]:
-          if args.zh or args.zh_withdecay:
-            process = TVar.Had_ZH
-          elif args.wh or args.wh_withdecay:
-            process = TVar.Had_WH
-        if associated_flavor in [11,12,13,14,15,16]:
-          if args.zh or args.zh_withdecay:
-            process = TVar.Lep_ZH
-          elif args.wh or args.wh_withdecay:
-            process = TVar.Lep_WH
-        if args.vbf or args.vbf_withdecay:
-          process = TVar.JJVBF
-        if args.zh_lep or args.zh_lep_hawk :
-          process = TVar.Lep_ZH
-        if args.wh_lep :
-          process = TVar.Lep_WH
-        if args.ggH4l :
-          process = TVar.ZZGG
-
-        #print i,"---- 1st -----------------------------"
-        #for ll in event.daughters :
-        #  print ll.second.Pt(), ll.second.Eta()
-
-        flav4l = 1;
-        for d in event.daughters: 
-          flav4l = flav4l*d.first
-          #print "init :",d.first,d.second.Px(),d.second.Py(),d.second.Pz(),d.second.E()
-        # this section merges the EW emitted photon to the closest lepton and updates the daugthers collection for Prophecy
-        # and associated for HAWK ZH, before the calculation of angles and probabilities for decay by MELA. The photon is
-        #still stored in  the associated collection for references for Prophecy. For HAWK it is deleted.  
-
-
-        if (args.zh_lep_hawk)  :   
-
-          for ipho, p in enumerate(event.associated):
-
-            if not (  p.first == 22)  :
-              continue
-            k = p.second
-            mindr = 9999
-            newlep = ROOT.TLorentzVector()
-
-            photonvector = ROOT.TLorentzVector()
-            lepp = ROOT.TLorentzVector()
-            photonvector.SetPtEtaPhiM(k.Pt(), k.Eta(),k.Phi(), k.M())
-            #print "photon:",p.first,p.second.Px(),p.second.Py(),p.second.Pz(),p.second.E()
-            i_newlep = 0        
-            for ilep, d in enumerate(event.associated):
-              if not( d.first == 22 )  : 
-                lep = d.second
-                d_lor = ROOT.TLorentzVector()            
-                d_lor.SetPtEtaPhiM(lep.Pt(), lep.Eta(),lep.Phi(), lep.M())
-                dr =  k.DeltaR(d_lor)
-                if dr < mindr :
-                  lepp.SetPtEtaPhiM(lep.Pt(), lep.Eta(),lep.Phi(), lep.M())
-                  mindr = dr
-                  i_newlep = ilep                  
-            newlep = lepp  + photonvector 
-            event.associated.pop_back()
-            event.associated[i_newlep].second = newlep
-            # re-initiate the event with the new associated particles  this only works for HAWK events!!!
-            eventt = event
-            event.mela.setInputEvent(eventt.daughters, eventt.associated, eventt.mothers)
-
-
-
-
-        if (args.merge_photon and args.ggH4l)  :   
-
-          for p in event.associated:
-
-            if not (  p.first == 22)  :
-              continue
-            k = p.second
-            mindr = 9999
-            newlep = ROOT.TLorentzVector()
-
-            photonvector = ROOT.TLorentzVector()
-            lepp = ROOT.TLorentzVector()
-            photonvector.SetPtEtaPhiM(k.Pt(), k.Eta(),k.Phi(), k.M())
-            #print "photon:",p.first,p.second.Px(),p.second.Py(),p.second.Pz(),p.second.E()
-            i_newlep = 0        
-            for ilep, d in enumerate(event.daughters): 
-              lep = d.second
-              d_lor = ROOT.TLorentzVector()            
-              d_lor.SetPtEtaPhiM(lep.Pt(), lep.Eta(),lep.Phi(), lep.M())
-              dr =  k.DeltaR(d_lor)
-              if dr < mindr :
-                lepp.SetPtEtaPhiM(lep.Pt(), lep.Eta(),lep.Phi(), lep.M())
-                mindr = dr
-                i_newlep = ilep  
-
-            newlep = lepp  + photonvector 
-            event.daughters[i_newlep].second = newlep
-            # re-initiate the event with the new daughters this only works for Prophecy events!!!
-            eventt = event
-            event.mela.setInputEvent(eventt.daughters, eventt.associated, eventt.mothers)
-  
-                
-        #Probabilities
-        #event.setProcess(TVar. HSMHiggs,TVar.JHUGen,process)
-        if args.calc_decayprob : 
-          # decayP works only for the process below 
-          #everytime you call a compute Prob function all the couplings
-          #are reset and have to be redefined. 
-
-          process = TVar.ZZINDEPENDENT
-          event.setProcess(TVar.SelfDefine_spin0,TVar.JHUGen,process)
-          event.ghz2 = 1
-          branches["pg2"][0] = event.computeP()
-                  
-          event.setProcess(TVar.HSMHiggs,TVar.JHUGen,process)
-          event.ghz1 = 2      
-          branches["pg1"][0] = event.computeP()
-        
-          event.setProcess(TVar.SelfDefine_spin0,TVar.JHUGen,process)
-          event.ghz4 = 1
-          branches["pg4"][0] = event.computeP()
-                            
-          event.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, process)
-          event.ghz1 = 1
-          event.ghz4 = 1
-          branches["pg1g4"][0] = event.computeP() - branches["pg1"][0] - branches["pg4"][0]
-        
-          event.setProcess(TVar.SelfDefine_spin0,TVar.JHUGen,process)
-          event.ghz1 = 1
-          event.ghz2 = 1        
-          branches["pg1g2"][0] = event.computeP() - branches["pg1"][0] - branches["pg2"][0]
-
-
-          
-
-          
-          c_0hplus = 1
-          c_0minus = 1 
-          if ( process ==  TVar.ZZINDEPENDENT  ) : 
-            c_0minus = 2.55497301342
-            c_0hplus = 1.66326995046
-
-
-            
-          branches["D0minus"][0] = branches["pg1"][0] / (branches["pg1"][0] + c_0minus*c_0minus*branches["pg4"][0])
-          branches["D0hplus"][0] = branches["pg1"][0] / (branches["pg1"][0] + c_0hplus*c_0hplus*branches["pg2"][0])
-          branches["DCP"][0] = branches["pg1g4"][0] / (2 * (branches["pg1"][0] * branches["pg4"][0]) ** 0.5)
-          branches["Dint"][0] = branches["pg1g2"][0] / (2 * (branches["pg1"][0] * branches["pg2"][0]) ** 0.5)
-          #branches["DCP_old"][0] = branches["pg1g4"][0] / (branches["pg1"][0] + branches["pg4"][0])
-
-        if args.calc_prodprob :
-          
-          event.setProcess(TVar.SelfDefine_spin0,TVar.JHUGen,process)
-          event.ghz1 = 0
-          event.ghz2 = 1
-          branches["pg2"][0] = event.computeProdP()
-          #print "g2 :",event.ghz2,branches["pg2"][0]
-          
-          
-          event.setProcess(TVar. HSMHiggs,TVar.JHUGen,process)
-          event.ghz1 = 1
-          branches["pg1"][0] = event.computeProdP()
-          #print "g1 :",branches["pg1"][0]
-
-          event.setProcess(TVar.SelfDefine_spin0,TVar.JHUGen,process)
-          event.ghz4 = 1
-          branches["pg4"][0] = event.computeProdP()
-          #print "g4 :",branches["pg4"][0]
-
-                    
-          event.setProcess(TVar.SelfDefine_spin0, TVar.JHUGen, process)
-          event.ghz1 = 1
-          event.ghz4 = 1
-          branches["pg1g4"][0] = event.computeProdP() - branches["pg1"][0] - branches["pg4"][0]
-          #print "g1g4 :",branches["pg1g4"][0]
-
-          event.setProcess(TVar.SelfDefine_spin0,TVar.JHUGen,process)
-          event.ghz1 = 1
-          event.ghz2 = 1        
-          branches["pg1g2"][0] = event.computeProdP() - branches["pg1"][0] - branches["pg2"][0]
-          #print "g1g2 :",branches["pg1g2"][0]
-
-          #added zgamma discr Prod
-          '''
-          event.setProcess(TVar.SelfDefine_spin0,TVar.JHUGen,process)
-          event.ghz1 = 0
-          event.ghza2 = 1        
-          branches["pg2za"][0] = event.computeProdP()
-
-          event.setProcess(TVar.SelfDefine_spin0,TVar.JHUGen,process)
-          event.ghz1 = 0
-          event.ghza4 = 1        
-          branches["pg4za"][0] = event.computeProdP()
-          
-
-          
-          event.setProcess(TVar.SelfDefine_spin0,TVar.JHUGen,process)
-          event.ghz1 = 1
-          event.ghza2 = 1        
-          branches["pg1g2za"][0] = event.computeProdP() - branches["pg1"][0] - branches["pg2za"][0]
-          
-
-          event.setProcess(TVar.SelfDefine_spin0,TVar.JHUGen,process)
-          event.ghz1 = 1
-          event.ghza4 = 1        
-          branches["pg1g4za"][0] = event.computeProdP() - branches["pg1"][0] - branches["pg4za"][0]
-          '''
-
-
-
-          c_0hplus = 1
-          c_0minus = 1 
-          if ( process == TVar.Had_ZH ) :
-            c_0hplus = 0.130395173298
-            c_0minus = 0.104503154335
-            c_0hplusza = 0.130395173298
-            c_0minusza = 0.104503154335
-          if ( process == TVar.JJVBF  ) :   
-            c_0minus = 0.297979440554
-            c_0hplus = 0.271880048944
-          if ( process ==  TVar.ZZGG  ) : 
-            c_0minus = 2.55497301342
-            c_0hplus = 1.66326995046
-
-
-            
-          branches["D0minus"][0] = branches["pg1"][0] / (branches["pg1"][0] + c_0minus*c_0minus*branches["pg4"][0])
-          branches["D0hplus"][0] = branches["pg1"][0] / (branches["pg1"][0] + c_0hplus*c_0hplus*branches["pg2"][0])
-          branches["DCP"][0] = branches["pg1g4"][0] / (2 * (branches["pg1"][0] * branches["pg4"][0]) ** 0.5)
-          branches["Dint"][0] = branches["pg1g2"][0] / (2 * (branches["pg1"][0] * branches["pg2"][0]) ** 0.5)
-
-          '''
-          branches["D0minus_za"][0] = branches["pg1"][0] / (branches["pg1"][0] + c_0minusza*c_0minusza*branches["pg4za"][0])
-          branches["D0hplus_za"][0] = branches["pg1"][0] / (branches["pg1"][0] + c_0hplusza*c_0hplusza*branches["pg2za"][0])
-          branches["DCP_za"][0] = branches["pg1g4za"][0] / (2 * (branches["pg1"][0] * branches["pg4za"][0]) ** 0.5)
-          branches["Dint_za"][0] = branches["pg1g2za"][0] / (2 * (branches["pg1"][0] * branches["pg2za"][0]) ** 0.5)
-          ''' 
-
-
-          #branches["DCP_old"][0] = branches["pg1g4"][0] / (branches["pg1"][0] + branches["pg4"][0])
-  
-
-
-
-
-
-          
-        if args.zh or args.wh or args.zh_lep or args.wh_lep or args.zh_lep_hawk:
-          branches["mV"][0], branches["mVstar"][0], branches["costheta1"][0], branches["costheta2"][0], branches["Phi"][0], branches["costhetastar"][0], branches["Phi1"][0]= event.computeVHAngles(process)
-        elif args.zh_withdecay or args.wh_withdecay :
-          branches["mV"][0], branches["mVstar"][0], branches["costheta1"][0], branches["costheta2"][0], branches["Phi"][0], branches["costhetastar"][0], branches["Phi1"][0]= event.computeVHAngles(process)
-          branches["M4L"][0], branches["MZ1"][0], branches["MZ2"][0], branches["costheta1d"][0],branches["costheta2d"][0], branches["Phid"][0], branches["costhetastard"][0], branches["Phi1d"][0]= event.computeDecayAngles()
-          #branches["mV"][0] = sum((particle.second for particle in event.associated), ROOT.TLorentzVector()).M()
-          #branches["mVstar"][0] = sum((particle.second for particle in itertools.chain(event.daughters, event.associated)), ROOT.TLorentzVector()).M()
-        elif args.vbf:
-          branches["q2V1"][0], branches["q2V2"][0], branches["costheta1"][0], branches["costheta2"][0], branches["Phi"][0], branches["costhetastar"][0], branches["Phi1"][0]= event.computeVBFAngles()
-          branches["HJJpz"][0] = sum((particle.second for particle in itertools.chain(event.daughters, event.associated)), ROOT.TLorentzVector()).Pz()
-
-          pj1 = event.associated[0].second
-          pj2 = event.associated[1].second
-          if pj1.Pt() > pj2.Pt() :
-            branches["Dphijj"][0] = pj1.DeltaPhi(pj2)
-          else:
-            branches["Dphijj"][0] = pj2.DeltaPhi(pj1)
-        elif args.vbf_withdecay:
-          branches["q2V1"][0], branches["q2V2"][0], branches["costheta1"][0], branches["costheta2"][0], branches["Phi"][0], branches["costhetastar"][0], branches["Phi1"][0]= event.computeVBFAngles()
-          branches["HJJpz"][0] = sum((particle.second for particle in itertools.chain(event.daughters, event.associated)), ROOT.TLorentzVector()).Pz()
-          branches["M4L"][0], branches["MZ1"][0], branches["MZ2"][0], branches["costheta1d"][0],branches["costheta2d"][0], branches["Phid"][0], branches["costhetastard"][0], branches["Phi1d"][0]= event.computeDecayAngles()
-
-	
-	elif args.ggH4l or args.ggH4lMG:
-	  branches["M4L"][0], branches["MZ1"][0], branches["MZ2"][0], branches["costheta1d"][0],branches["costheta2d"][0], branches["Phid"][0], branches["costhetastard"][0], branches["Phi1d"][0]= event.computeDecayAngles()
-        #print i,branches["M4L"][0], branches["MZ1"][0], branches["MZ2"][0],len(event.associated)
-        pH = sum((particle.second for particle in event.daughters), ROOT.TLorentzVector())
-        if args.ggH4l:
-          if( len(event.associated) > 0):
-            ph1 = event.associated[0].second
-            pHph = pH + ph1 
-            branches["pxph1"][0] = pHph.Px()
-            branches["pyph1"][0] = pHph.Py()
-            branches["pzph1"][0] = pHph.Pz()
-            branches["Eph1"][0]  = pHph.E()
-
-        else:     
-          branches["ptH"][0] = pH.Pt()
-          branches["pxH"][0] = pH.Px()
-          branches["pyH"][0] = pH.Py()
-          branches["pzH"][0] = pH.Pz()
-          branches["EH"][0] = pH.E()
-          branches["rapH"][0] = pH.Rapidity()
-                
-        if not args.vbf and not args.zh and not args.wh and not args.zh_lep and not args.wh_lep and not args.zh_lep_hawk: 
-          pdau1 = event.daughters[0].second
-          branches["ptdau1"][0] = pdau1.Pt()
-          branches["pxdau1"][0] = pdau1.Px()
-          branches["pydau1"][0] = pdau1.Py()
-          branches["pzdau1"][0] = pdau1.Pz()
-          branches["Edau1"][0] = pdau1.E()
-          branches["flavdau1"][0] = event.daughters[0].first
-          
-          
-          pdau2 = event.daughters[1].second
-          branches["ptdau2"][0] = pdau2.Pt()
-          branches["pxdau2"][0] = pdau2.Px()
-          branches["pydau2"][0] = pdau2.Py()
-          branches["pzdau2"][0] = pdau2.Pz()
-          branches["Edau2"][0] = pdau2.E()
-          branches["flavdau2"][0] = event.daughters[1].first
-          
-          pdau3 = event.daughters[2].second
-          branches["ptdau3"][0] = pdau3.Pt()
-          branches["pxdau3"][0] = pdau3.Px()
-          branches["pydau3"][0] = pdau3.Py()
-          branches["pzdau3"][0] = pdau3.Pz()
-          branches["Edau3"][0] = pdau3.E()
-          branches["flavdau3"][0] = event.daughters[2].first
-          
-          
-          pdau4 = event.daughters[3].second
-          branches["ptdau4"][0] = pdau4.Pt()
-          branches["pxdau4"][0] = pdau4.Px()
-          branches["pydau4"][0] = pdau4.Py()
-          branches["pzdau4"][0] = pdau4.Pz()
-          branches["Edau4"][0] = pdau4.E()
-          branches["flavdau4"][0] = event.daughters[3].first
-          
-        
-
-        if args.ggH4l:
-          #add FSR photon to the root file 
-          if( len(event.associated) > 0):
-            ph1 = event.associated[0].second
-            branches["pxph1"][0] = ph1.Px()
-            branches["pyph1"][0] = ph1.Py()
-            branches["pzph1"][0] = ph1.Pz()
-            branches["Eph1"][0] = ph1.E()
-
-        if args.vbf or args.zh or args.wh  or args.zh_lep_hawk:     
-          pj1 = event.associated[0].second
-          branches["pxj1"][0] = pj1.Px()
-          branches["pyj1"][0] = pj1.Py()
-          branches["pzj1"][0] = pj1.Pz()
-          branches["Ej1"][0] = pj1.E()          
-          pj2 = event.associated[1].second
-          branches["pxj2"][0] = pj2.Px()
-          branches["pyj2"][0] = pj2.Py()
-          branches["pzj2"][0] = pj2.Pz()
-          branches["Ej2"][0] = pj2.E()
-          phjj = pH + pj1 + pj2
-          branches["rapHJJ"][0] = phjj.Rapidity()
-        
-	if args.ggH4lMG:
-          key_sorted=sorted(event.weights)
-          list_weights=[]
-          for key in key_sorted:
-            list_weights.append(event.weights.get(key,None))
-          for j in range(len(list_weights)):
-            branches["weights"][j] = list_weights[j]
-          print branches["weights"]
-	else:
-          branches["weight"][0] = event.weight
-              # print "FIlling!"
-        t.Fill()
-      print "Processed", i+1, "events"
-
-  newf.Write()
-except:
-  bad = True
-  raise
-finally:
-  if bad:
+def lhefileclass(args):
+  lhefileclass = LHEFile_Hwithdecay
+  if args.ggH4l :
+    lhefileclass = LHEFile_HwithdecayOnly
+  if args.vbf or args.zh or args.wh or args.zh_lep or args.wh_lep  :
+    lhefileclass = LHEFile_StableHiggs
+  if args.zh_withdecay or args.wh_withdecay  :
+    lhefileclass = LHEFile_VHHiggsdecay
+  if args.zh_lep_hawk :
+    lhefileclass = LHEFile_StableHiggsZHHAWK
+  return lhefileclass
+
+
+#pure and interference terms for the probabilities of --calc_decayprob and --calc_prodprob:
+#pg1 is HSMHiggs as it always was, and the interference terms subtract a SelfDefine evaluation of ghz1=1 (see HypothesisEngine)
+spin0couplings = (("ghz1", "g1"), ("ghz2", "g2"), ("ghz4", "g4"), ("ghza2", "g2za"), ("ghza4", "g4za"))
+spin0interferences = (("ghz1", "ghz4"), ("ghz1", "ghz2"), ("ghz1", "ghza2"), ("ghz1", "ghza4"))
+decayengine = HypothesisEngine(spin0couplings, spin0interferences, TVar.SelfDefine_spin0, TVar.JHUGen, purehypotheses={"ghz1": (TVar.HSMHiggs, {"ghz1": 2})})
+prodengine = HypothesisEngine(spin0couplings, spin0interferences, TVar.SelfDefine_spin0, TVar.JHUGen, purehypotheses={"ghz1": (TVar.HSMHiggs, {"ghz1": 1})})
+
+def computeprobabilities(event, function, hypotheses, process, cache=None, profiler=nullprofiler):
+  """
+  calls event.function (computeP or computeProdP) for each of the hypotheses, or takes the result from the cache,
+  returns a dict name: probability.  Each hypothesis is timed as the profiler stage function:name.
+  The hypotheses go through the MelaState of the event's Mela, so setProcess is only called when the
+  configuration changes, starting with the configuration that the previous event ended with.
+  """
+  probabilities = {}
+  if cache is not None:
+    eventkey = cache.eventkey(event)
+  state = melapool.state(event.mela)
+  with state.lock:
+    for hypothesis in state.order(state.prepare(function, hypotheses, process)):
+      with profiler.stage(function + ":" + hypothesis.name):
+        if cache is None:
+          probabilities[hypothesis.name] = state.compute(event, hypothesis)
+        else:
+          probabilities[hypothesis.name] = cache.compute(event, eventkey, function, *hypothesis.configuration, couplings=hypothesis.couplings, compute=lambda: state.compute(event, hypothesis))
+  return probabilities
+
+
+def filldiscriminants(branches, c_0minus, c_0hplus, c_0minusza, c_0hplusza):
+  """fills the D branches from the p branches"""
+  branches["D0minus"][0] = branches["pg1"][0] / (branches["pg1"][0] + c_0minus*c_0minus*branches["pg4"][0])
+  branches["D0hplus"][0] = branches["pg1"][0] / (branches["pg1"][0] + c_0hplus*c_0hplus*branches["pg2"][0])
+  branches["DCP"][0] = branches["pg1g4"][0] / (2 * (branches["pg1"][0] * branches["pg4"][0]) ** 0.5)
+  branches["Dint"][0] = branches["pg1g2"][0] / (2 * (branches["pg1"][0] * branches["pg2"][0]) ** 0.5)
+  #branches["DCP_old"][0] = branches["pg1g4"][0] / (branches["pg1"][0] + branches["pg4"][0])
+
+  branches["D0minus_za"][0] = branches["pg1"][0] / (branches["pg1"][0] + c_0minusza*c_0minusza*branches["pg4za"][0])
+  branches["D0hplus_za"][0] = branches["pg1"][0] / (branches["pg1"][0] + c_0hplusza*c_0hplusza*branches["pg2za"][0])
+  branches["DCP_za"][0] = branches["pg1g4za"][0] / (2 * (branches["pg1"][0] * branches["pg4za"][0]) ** 0.5)
+  branches["Dint_za"][0] = branches["pg1g2za"][0] / (2 * (branches["pg1"][0] * branches["pg2za"][0]) ** 0.5)
+
+
+class ChunkKinematics(object):
+  """
+  The branches that are computed from the momenta in the LHE file, without mela,
+  computed with fourvectors for a whole chunk of LHEColumns (see LHEFileBase.iterchunks) at once.
+  Each group of branches is (names, values with one row per event), and add sets the values of the events
+  that don't have a group (e.g. no FSR photon, or fewer than 4 daughters) to 0.
+  The events that can't be converted at all are found before, with kinematicsgoodevents.
+  """
+  def __init__(self, args, c):
+    self.groups = []
+    daughters, associated = c.role == DAUGHTER, c.role == ASSOCIATED
+    associatedranks = fourvectors.rank(c, associated)
+    nassociated = fourvectors.count(c, associated)
+    pH = fourvectors.sumbyevent(c, daughters)
+
+    #the flavor of the last associated particle, which decides between hadronic and leptonic VH
+    last = fourvectors.last(c, associated, associatedranks)
+    self.associatedflavor = numpy.where(last >= 0, numpy.abs(c.id[numpy.maximum(last, 0)]), 0)
+
+    if not args.ggH4l:
+      self.add(("ptH", "pxH", "pyH", "pzH", "EH", "rapH"), (fourvectors.pt(pH), pH[1], pH[2], pH[3], pH[0], fourvectors.rapidity(pH)))
+
+    if args.ggH4l:
+      #the FSR photon
+      photon = fourvectors.nth(c, associated, 0, associatedranks)
+      ph1 = fourvectors.particle(c, photon)
+      self.add(("pxph1", "pyph1", "pzph1", "Eph1"), (ph1[1], ph1[2], ph1[3], ph1[0]), photon >= 0)
+
+    if not (args.vbf or isVH(args)):
+      daughterranks = fourvectors.rank(c, daughters)
+      for n, names in enumerate(daughterbranches):
+        daughter = fourvectors.nth(c, daughters, n, daughterranks)
+        pdau = fourvectors.particle(c, daughter)
+        self.add(names, (fourvectors.pt(pdau), pdau[1], pdau[2], pdau[3], pdau[0], c.id[numpy.maximum(daughter, 0)]), daughter >= 0)
+
+    if needsjets(args):
+      #the events without 2 jets are bad events, see kinematicsgoodevents
+      hasjets = nassociated >= 2
+      pj1, pj2 = (fourvectors.particle(c, fourvectors.nth(c, associated, n, associatedranks)) for n in (0, 1))
+      phjj = fourvectors.add(pH, pj1, pj2)
+      self.add(("pxj1", "pyj1", "pzj1", "Ej1", "pxj2", "pyj2", "pzj2", "Ej2", "rapHJJ"), (pj1[1], pj1[2], pj1[3], pj1[0], pj2[1], pj2[2], pj2[3], pj2[0], fourvectors.rapidity(phjj)), hasjets)
+
+    if args.vbf or args.vbf_withdecay:
+      #added in the same order as the sum of TLorentzVectors: the daughters, then the associated particles
+      HJJpz = pH[3].copy()
+      for n in range(nassociated.max() if len(nassociated) else 0):
+        HJJpz += fourvectors.particle(c, fourvectors.nth(c, associated, n, associatedranks))[3]
+      self.add(("HJJpz",), (HJJpz,))
+
+    if args.vbf:
+      #with the higher pt jet first
+      Dphijj = numpy.where(fourvectors.pt(pj1) > fourvectors.pt(pj2), fourvectors.deltaphi(pj1, pj2), fourvectors.deltaphi(pj2, pj1))
+      self.add(("Dphijj",), (Dphijj,), hasjets)
+
+    if not args.ggH4lMG:
+      self.add(("weight",), (c.weight,))
+
+  def add(self, names, columns, present=None):
+    values = numpy.column_stack(columns)
+    if present is not None: values[~present] = 0
+    self.groups.append((names, values))
+
+  def fill(self, branches, i):
+    """sets the branches of event i of the chunk"""
+    for names, values in self.groups:
+      branches.set(names, values[i])
+
+def needsjets(args):
+  return args.vbf or args.zh or args.wh or args.zh_lep_hawk
+
+def kinematicsgoodevents(args, c, events, onbadevent, filename):
+  """
+  returns which events of the chunk c (with the (offset, linenumber, event) of each in events) have the particles
+  that this mode needs, or None if all of them do.  The others are bad events: they're passed to onbadevent
+  (a BadEventHandler or DeferredBadEvents), or if it doesn't leave them out, raise with where the event is in the file.
+  """
+  if not needsjets(args): return None
+  nassociated = fourvectors.count(c, c.role == ASSOCIATED)
+  good = nassociated >= 2
+  for i in numpy.flatnonzero(~good):
+    offset, linenumber, event = events[i]
+    error = ValueError("Event has {} associated particles, need 2 jets".format(nassociated[i]))
+    if onbadevent.handle(filename, offset, linenumber, event, error): continue
+    where = "line {}".format(linenumber) if linenumber is not None else "byte {}".format(offset)
+    raise ValueError("{}: the event starting on {} of {}\n\n{}".format(error, where, filename, event))
+  return good
+
+def recombinephotons(args, c):
+  """
+  merges the FSR photons into the closest lepton (see fourvectors.recombine), before the kinematics and the mela input are made from the columns:
+  for --ggH4l --merge_photon (Prophecy) into the daughters, and the photon stays in the associated particles for reference,
+  for --zh_lep_hawk into the associated leptons, and all the photons are removed from the associated particles,
+  so with --photon-cone, the momentum of the photons that aren't merged is lost.
+  """
+  associatedphotons = (c.role == ASSOCIATED) & (c.id == 22)
+  if args.ggH4l and args.merge_photon:
+    c = fourvectors.recombine(c, associatedphotons, c.role == DAUGHTER, args.photon_cone)[0]
+  elif args.zh_lep_hawk:
+    c = fourvectors.recombine(c, associatedphotons, (c.role == ASSOCIATED) & (c.id != 22), args.photon_cone)[0]
+    role = c.role.copy()
+    role[associatedphotons] = NOROLE
+    c = c._replace(role=role)
+  return c
+
+def selectedevents(c, selection=None, profiler=nullprofiler, good=None):
+  """
+  the indices of the events of the chunk c that pass the --cut selection (see selection.py), all of them if there are no cuts,
+  out of the events where good is true if it's given
+  """
+  if not selection: return range(len(c.eventoffset) - 1) if good is None else numpy.flatnonzero(good)
+  with profiler.stage("selection"):
+    return numpy.flatnonzero(selection.select(c, good))
+
+def iterchunkevents(args, f, profiler=nullprofiler, selection=None):
+  """
+  yields (c, events, kinematics, i) for event i of each chunk of --chunk-size events, with the ChunkKinematics of the chunk,
+  for the events that pass the selection
+  """
+  for c, events in f.iterchunks(args.chunk_size):
+    with profiler.stage("photons"):
+      c = recombinephotons(args, c)
+    selected = selectedevents(c, selection, profiler, kinematicsgoodevents(args, c, events, f.onbadevent, f.filename))
+    if not len(selected): continue
+    with profiler.stage("kinematics"):
+      kinematics = ChunkKinematics(args, c)
+    for i in selected:
+      yield c, events, kinematics, i
+
+def convertevent(args, event, kinematics, j, branches, process=None, cache=None, profiler=nullprofiler):
+  """
+  sets the branches (an EventRecord) for event j of a chunk with the ChunkKinematics kinematics,
+  where event is the LHE file after setchunkevent for that event,
+  returns the mela process, which is kept for the next event if it can't be determined from this one
+  """
+  ### Automatically detect Had or Lep associated for VH production###
+  associated_flavor = kinematics.associatedflavor[j]
+  if associated_flavor in [1,2,3,4,5,6]:
+    if args.zh or args.zh_withdecay:
+      process = TVar.Had_ZH
+    elif args.wh or args.wh_withdecay:
+      process = TVar.Had_WH
+  if associated_flavor in [11,12,13,14,15,16]:
+    if args.zh or args.zh_withdecay:
+      process = TVar.Lep_ZH
+    elif args.wh or args.wh_withdecay:
+      process = TVar.Lep_WH
+  if args.vbf or args.vbf_withdecay:
+    process = TVar.JJVBF
+  if args.zh_lep or args.zh_lep_hawk :
+    process = TVar.Lep_ZH
+  if args.wh_lep :
+    process = TVar.Lep_WH
+  if args.ggH4l :
+    process = TVar.ZZGG
+
+  #Probabilities
+  #event.setProcess(TVar. HSMHiggs,TVar.JHUGen,process)
+  if args.calc_decayprob :
+    # decayP works only for the process below
+    #everytime you call a compute Prob function all the couplings
+    #are reset and have to be redefined.
+
+    process = TVar.ZZINDEPENDENT
+  #with --augment, the probabilities are only computed if they're new, but the process above is also used for the angles
+  if args.calc_decayprob and branches.wants(probabilitybranches):
+    probabilities = computeprobabilities(event, "computeP", decayengine.evaluations, process, cache, profiler)
+    for name, probability in decayengine.terms(probabilities).iteritems():
+      branches[name][0] = probability
+
+    c_0hplus = 1
+    c_0minus = 1
+    c_0hplusza = 1
+    c_0minusza = 1
+    if ( process ==  TVar.ZZINDEPENDENT  ) :
+      c_0minus = 2.55497301342
+      c_0hplus = 1.66326995046
+
+    filldiscriminants(branches, c_0minus, c_0hplus, c_0minusza, c_0hplusza)
+
+  if args.calc_prodprob and branches.wants(probabilitybranches):
+
+    probabilities = computeprobabilities(event, "computeProdP", prodengine.evaluations, process, cache, profiler)
+    for name, probability in prodengine.terms(probabilities).iteritems():
+      branches[name][0] = probability
+
+    c_0hplus = 1
+    c_0minus = 1
+    c_0hplusza = 1
+    c_0minusza = 1
+    if ( process == TVar.Had_ZH ) :
+      c_0hplus = 0.130395173298
+      c_0minus = 0.104503154335
+      c_0hplusza = 0.130395173298
+      c_0minusza = 0.104503154335
+    if ( process == TVar.JJVBF  ) :
+      c_0minus = 0.297979440554
+      c_0hplus = 0.271880048944
+    if ( process ==  TVar.ZZGG  ) :
+      c_0minus = 2.55497301342
+      c_0hplus = 1.66326995046
+
+    filldiscriminants(branches, c_0minus, c_0hplus, c_0minusza, c_0hplusza)
+
+  #with --augment, the angles that the existing output has aren't computed again
+  with profiler.stage("angles"):
+    if args.zh or args.wh or args.zh_lep or args.wh_lep or args.zh_lep_hawk:
+      if branches.wants(vhanglebranches): branches.set(vhanglebranches, event.computeVHAngles(process))
+    elif args.zh_withdecay or args.wh_withdecay :
+      if branches.wants(vhanglebranches): branches.set(vhanglebranches, event.computeVHAngles(process))
+      if branches.wants(decayanglebranches): branches.set(decayanglebranches, event.computeDecayAngles())
+      #branches["mV"][0] = sum((particle.second for particle in event.associated), ROOT.TLorentzVector()).M()
+      #branches["mVstar"][0] = sum((particle.second for particle in itertools.chain(event.daughters, event.associated)), ROOT.TLorentzVector()).M()
+    elif args.vbf:
+      if branches.wants(vbfanglebranches): branches.set(vbfanglebranches, event.computeVBFAngles())
+    elif args.vbf_withdecay:
+      if branches.wants(vbfanglebranches): branches.set(vbfanglebranches, event.computeVBFAngles())
+      if branches.wants(decayanglebranches): branches.set(decayanglebranches, event.computeDecayAngles())
+
+
+    elif args.ggH4l or args.ggH4lMG:
+      if branches.wants(decayanglebranches): branches.set(decayanglebranches, event.computeDecayAngles())
+  with profiler.stage("kinematics"):
+    kinematics.fill(branches, j)
+
+  with profiler.stage("weights"):
+    if args.ggH4lMG and "weights" in branches:
+      weights = event.weightarray
+      if "nweights" in branches: branches["nweights"][0] = len(weights)
+      branches["weights"][:len(weights)] = weights
+  return process
+
+def convertfile(args, writer, inputfile, begin=0, end=None, cache=None, profiler=nullprofiler, badevents=None, selection=None, sampler=None):
+  """
+  converts the events of inputfile whose <event> tag is in the byte range [begin, end) and fills them with writer,
+  returns the number of events.  Only the events that sampler keeps (see opensampler) are read,
+  the bad events are handled by badevents (see openbadevents),
+  and only the events that pass selection (see openselection) are converted.
+  The events are read and parsed in chunks, the kinematic branches are computed for the whole chunk (see ChunkKinematics),
+  and mela is only used one event at a time, for the angles and the probabilities.
+  """
+  branches = writer.record
+  print inputfile
+  inputfclass = lhefileclass(args)(inputfile, isgen=args.use_flavor, reusemela=True, begin=begin, end=end, weightids=args.weightids, profiler=profiler, onbadevent=badevents, sampler=sampler)
+  fillstage = profiler.stage("fill")
+
+  i = -1
+  process = None
+  with inputfclass  as f:
+    for i, (c, events, kinematics, j) in enumerate(iterchunkevents(args, f, profiler, selection)):
+      #reading, parsing and the kinematics of a new chunk happen in iterchunkevents, and aren't counted in this event
+      profiler.startevent()
+      event = f.setchunkevent(c, events, j)
+      process = convertevent(args, event, kinematics, j, branches, process, cache, profiler)
+      with fillstage:
+        writer.fill()
+      profiler.endevent((inputfile, f.offset))
+    print "Processed", i+1, "events"
+  return i+1
+
+
+class DeferredBadEvents(object):
+  """
+  onbadevent for parsechunk in a pipeline worker: collects the bad events of a chunk instead of handling them,
+  so that the writer's BadEventHandler handles them in input order
+  """
+  def __init__(self, policy):
+    self.policy = policy
+    self.events = []
+
+  def handle(self, filename, offset, linenumber, event, error):
+    if self.policy == "fail": return False
+    self.events.append((filename, offset, linenumber, event, str(error)))
+    return True
+
+def convertchunk(args, f, chunk, cache=None, profiler=nullprofiler, badevents=None, selection=None):
+  """
+  parses and converts a chunk of (offset, linenumber, event) from the LHE file f (opened with lhefileclass),
+  returns the events that pass selection as an array with the dtype of EventRecord.buffer.
+  Each chunk starts from an empty record, so the result doesn't depend on which chunks were converted before it.
+  """
+  record = EventRecord(None, activebranches(args))
+  with profiler.stage("parse"):
+    c, events = parsechunk(chunk, f.lheeventclass, f.isgen, badevents, f.filename)
+  if not events: return numpy.zeros(0, dtype=record.buffer.dtype)
+  with profiler.stage("photons"):
+    c = recombinephotons(args, c)
+  selected = selectedevents(c, selection, profiler, kinematicsgoodevents(args, c, events, badevents or failonbadevents, f.filename))
+  block = numpy.zeros(len(selected), dtype=record.buffer.dtype)
+  if not len(selected): return block
+  with profiler.stage("kinematics"):
+    kinematics = ChunkKinematics(args, c)
+  process = None
+  for k, j in enumerate(selected):
+    profiler.startevent()
+    event = f.setchunkevent(c, events, j)
+    process = convertevent(args, event, kinematics, j, record, process, cache, profiler)
+    block[k] = record.buffer[0]
+    profiler.endevent((f.filename, f.offset))
+  return block
+
+def pipelineworker(args, tasks, results):
+  """
+  a worker process of convertpipeline: converts the (sequence, inputfile, chunk) from tasks until it gets None,
+  puts ("chunk", sequence, inputfile, events, bad events) in results for each,
+  and at the end ("done", cache stats, profiler stats, selection counts), or ("error", traceback) if it fails
+  """
+  profiler = openprofiler(args)
+  cache = openmelacache(args)
+  selection = openselection(args)
+  files = {}
+  try:
+    for sequence, inputfile, chunk in iter(tasks.get, None):
+      if inputfile not in files:
+        files[inputfile] = lhefileclass(args)(inputfile, isgen=args.use_flavor, reusemela=True, weightids=args.weightids, profiler=profiler)
+      badevents = DeferredBadEvents(args.bad_events)
+      block = convertchunk(args, files[inputfile], chunk, cache, profiler, badevents, selection)
+      results.put(("chunk", sequence, inputfile, block, badevents.events))
+  except:
+    results.put(("error", traceback.format_exc()))
+    return
+  finally:
+    for f in files.itervalues():
+      f.f.close()
+    if cache is not None: cache.close()
+  results.put(("done", cache.stats if cache is not None else None, profiler.stats if profiler.enabled else None, selection.counts))
+
+def readchunks(args, tasks, results, inflight, stop, sampler=None):
+  """
+  the reader thread of convertpipeline: reads, decompresses and splits the input files into chunks of --chunk-size events,
+  with only the events that sampler keeps,
+  and puts (sequence, inputfile, chunk) in tasks, waiting for the inflight semaphore before each one.
+  At the end it puts ("read", number of chunks) in results and None in tasks for each worker.
+  """
+  sequence = 0
+  try:
+    for inputfile in args.inputfile:
+      print inputfile
+      with openlhefile(inputfile) as f:
+        events = scanevents(f)
+        if sampler: events = sampler.sample(events, inputfile, getattr(f, "compression", None))
+        while True:
+          chunk = list(itertools.islice(events, args.chunk_size))
+          if not chunk: break
+          inflight.acquire()
+          if stop.is_set(): return
+          tasks.put((sequence, inputfile, chunk))
+          sequence += 1
+    results.put(("read", sequence))
+  except:
+    results.put(("error", traceback.format_exc()))
+  finally:
+    for _ in range(args.jobs):
+      tasks.put(None)
+
+def getpipelinemessage(results, workers):
+  """the next message from the reader or the workers, or an error if a worker died without sending one"""
+  while True:
     try:
-      os.remove(args.outputfile)
-    except:
-      pass
+      return results.get(timeout=1)
+    except Queue.Empty:
+      for worker in workers:
+        if worker.exitcode not in (None, 0): raise RuntimeError("Pipeline worker {} exited with code {}".format(worker.pid, worker.exitcode))
+
+def convertpipeline(args, writer, badevents, profiler=nullprofiler, selection=None, sampler=None):
+  """
+  converts all the input files for --pipeline, with a reader thread, --jobs worker processes and this process as the only writer:
+  the reader thread reads, decompresses, samples and splits the input into chunks (readchunks),
+  the workers parse them and compute the branches, each with its own Mela (convertchunk),
+  and the writer fills the converted chunks into writer in input order, and handles their bad events with badevents.
+  At most --pipeline-depth chunks are read but not written yet, so the reader waits when the workers or the writer fall behind,
+  and the throughput is set by the slowest stage.  As with --jobs, the branches that aren't set for an event
+  start from 0 in each chunk instead of keeping the values of the previous event.
+  The time the writer waits for the workers is the profiler stage "wait".
+  The workers' profiler stats and selection counts are added to profiler and selection.
+  Returns the number of events and the cache stats of each worker.
+  """
+  tasks, results = multiprocessing.Queue(), multiprocessing.Queue()
+  inflight, stop = threading.Semaphore(args.pipeline_depth), threading.Event()
+  workers = [multiprocessing.Process(target=pipelineworker, args=(args, tasks, results)) for _ in range(args.jobs)]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+  reader = threading.Thread(target=readchunks, args=(args, tasks, results, inflight, stop, sampler))
+  reader.daemon = True
+  reader.start()
+
+  waitstage, fillstage = profiler.stage("wait"), profiler.stage("fill")
+  pending = {}
+  nextchunk = nevents = 0
+  nchunks = None
+  cachestats = []
+  try:
+    #the workers are done after the reader has sent all the chunks, and each worker's chunks come before its "done"
+    while nchunks is None or len(cachestats) < len(workers):
+      with waitstage:
+        message = getpipelinemessage(results, workers)
+      if message[0] == "error":
+        raise RuntimeError("Error in the conversion pipeline:\n" + message[1])
+      if message[0] == "read":
+        nchunks = message[1]
+        continue
+      if message[0] == "done":
+        cachestats.append(message[1])
+        if message[2] is not None: profiler.add(message[2])
+        if selection is not None: selection.add(message[3])
+        continue
+      pending[message[1]] = message[2:]
+      while nextchunk in pending:
+        inputfile, block, bad = pending.pop(nextchunk)
+        nextchunk += 1
+        for _ in bad:
+          badevents.handle(*_)
+        with fillstage:
+          writer.fillblock(block)
+        nevents += len(block)
+        inflight.release()
+  except:
+    stop.set()
+    inflight.release()
+    for worker in workers:
+      worker.terminate()
+    #the chunks that no worker will read anymore shouldn't keep this process from exiting
+    tasks.cancel_join_thread()
+    results.cancel_join_thread()
+    raise
+  if nextchunk != nchunks: raise RuntimeError("The pipeline wrote {} of {} chunks".format(nextchunk, nchunks))
+  for worker in workers:
+    worker.join()
+  reader.join()
+  return nevents, cachestats
+
+
+def makeshards(inputfiles, nshards, eventspershard=None):
+  """
+  splits the input files into about nshards byte ranges with similar numbers of events,
+  or if eventspershard is given, into byte ranges of eventspershard events, using the event index,
+  returns a list of (inputfile, begin, end) in the order of the events in the input
+  """
+  indices = [LHEIndex.load(_) if os.path.exists(_) else None for _ in inputfiles]
+  if eventspershard is None:
+    nevents = sum(len(_) for _ in indices if _ is not None)
+    eventspershard = max(-(-nevents // nshards), 1)
+  shards = []
+  for inputfile, index in zip(inputfiles, indices):
+    if index is None:
+      shards.append((inputfile, 0, None))
+      continue
+    for start in range(0, len(index), eventspershard):
+      shards.append((inputfile,) + index.byterange(start, start+eventspershard))
+  return shards
+
+
+class Checkpoint(object):
+  """
+  The record of which shards of a --checkpoint-every conversion are finished, in outputfile.checkpoint:
+  json with the options that affect the output, the shards and the results of convertshard for the finished ones.
+  It's rewritten after each shard, and the shard files are kept when the conversion fails,
+  so that --resume only converts the shards that aren't finished.
+  Example usage:
+    checkpoint = Checkpoint.open(args, shards, shardfiles)
+    for shardfile, shard in zip(shardfiles, shards):
+      if shardfile in checkpoint.done: continue
+      ...
+      checkpoint.add(shardfile, result)
+    checkpoint.remove()
+  """
+  version = 2
+  #options that don't change the output, so they can be different when resuming
+  ignoredoptions = ("resume", "jobs", "pipeline", "pipeline_depth", "chunk_size", "fill_block", "profile", "profile_sample_every", "profile_slowest", "mela_cache", "mela_cache_size", "mela_cache_version")
+
+  def __init__(self, filename, state):
+    self.filename, self.state = filename, state
+
+  @staticmethod
+  def checkpointfilename(outputfile):
+    return outputfile + ".checkpoint"
+
+  @classmethod
+  def newstate(cls, args, shards, shardfiles):
+    #through json, so that it compares equal to the state that's read back
+    return json.loads(json.dumps({
+      "version": cls.version,
+      "options": {name: value for name, value in sorted(vars(args).iteritems()) if name not in cls.ignoredoptions},
+      "shards": [[shardfile] + list(shard) for shardfile, shard in zip(shardfiles, shards)],
+      "done": {},
+    }))
+
+  @classmethod
+  def open(cls, args, shards, shardfiles):
+    """starts a new checkpoint, or with --resume, reads the existing one and checks that it's for the same conversion"""
+    filename = cls.checkpointfilename(args.outputfile)
+    state = cls.newstate(args, shards, shardfiles)
+    if not args.resume:
+      if os.path.exists(filename): raise IOError(filename+" already exists, use --resume to continue the conversion or delete it")
+      result = cls(filename, state)
+      result.write()
+      return result
+    if not os.path.exists(filename): raise IOError("--resume: "+filename+" doesn't exist")
+    with open(filename) as f:
+      existing = json.load(f)
+    for key in "version", "options", "shards":
+      if existing.get(key) != state[key]:
+        raise ValueError("--resume: the {} in {} are different from this conversion's".format(key, filename))
+    existing["done"] = {shardfile: result for shardfile, result in existing["done"].iteritems() if os.path.exists(shardfile)}
+    return cls(filename, existing)
+
+  @property
+  def done(self):
+    """{shardfile: result of convertshard} for the finished shards"""
+    return self.state["done"]
+
+  def add(self, shardfile, result):
+    self.done[shardfile] = result
+    self.write()
+
+  def write(self):
+    #write and rename, so that a crash while writing doesn't lose the previous checkpoint
+    with open(self.filename+".tmp", "w") as f:
+      json.dump(self.state, f)
+    os.rename(self.filename+".tmp", self.filename)
+
+  def remove(self):
+    os.remove(self.filename)
+
+
+def weightids(args):
+  """
+  the reweighting ids of all the input files, which set the columns of the weights branch:
+  in the order of their headers, or sorted with --schema-version 1
+  """
+  if not args.ggH4lMG: return None
+  result = tuple(collections.OrderedDict.fromkeys(id for inputfile in args.inputfile for id in readweightids(inputfile)))
+  if args.schema_version < 2:
+    if len(result) > legacynweights: raise ValueError("The input has {} reweighting weights, --schema-version 1 can only store {}, use --schema-version 2".format(len(result), legacynweights))
+    result = tuple(sorted(result))
+  return result
+
+
+def openprofiler(args):
+  if not args.profile: return nullprofiler
+  return Profiler(sampleevery=args.profile_sample_every, nslowest=args.profile_slowest)
+
+
+def openbadevents(args, quarantinefile):
+  return BadEventHandler(args.bad_events, quarantinefile)
+
+def mergequarantinefiles(filenames, quarantinefile):
+  """concatenates the quarantine files of the shards, in order, into quarantinefile, if there are any"""
+  filenames = [_ for _ in filenames if os.path.exists(_)]
+  if not filenames: return
+  with open(quarantinefile, "w") as f:
+    for filename in filenames:
+      with open(filename) as shard:
+        shutil.copyfileobj(shard, f)
+
+
+def opensampler(args):
+  """the EventSampler for the sampling options, None if all the events are read"""
+  sampler = EventSampler(maxevents=args.max_events, skip=args.skip_events, every=args.every, fraction=args.sample_fraction,
+                         unweight=args.unweight, unweightid=args.unweight_id, maxweight=args.unweight_max, seed=args.seed)
+  return sampler if sampler else None
+
+def openselection(args):
+  return Selection(args.cut)
+
+
+def openmelacache(args):
+  if not args.mela_cache: return None
+  return MelaCache(args.mela_cache, maxentries=args.mela_cache_size, version=args.mela_cache_version)
+
+
+def convertshard(shard):
+  """
+  runs in a worker process, which has its own Mela, or in the main process for --checkpoint-every with --jobs 1:
+  converts one shard into its own file, and its bad events into its own quarantine file,
+  and returns the shard file and the number of events, the cache statistics, the write statistics,
+  the profiler statistics, the number of bad events for each reason and the selection counts
+  """
+  args, shardfile, inputfile, begin, end = shard
+  profiler = openprofiler(args)
+  writer = outputwriter(args, shardfile)
+  cache = openmelacache(args)
+  badevents = openbadevents(args, quarantinefilename(shardfile))
+  selection = openselection(args)
+  try:
+    nevents = convertfile(args, writer, inputfile, begin, end, cache=cache, profiler=profiler, badevents=badevents, selection=selection, sampler=opensampler(args))
+  finally:
+    if cache is not None: cache.close()
+    badevents.close()
+  with profiler.stage("close"):
+    writer.close()
+  return shardfile, (nevents, cache.stats if cache is not None else None, writer.stats, profiler.stats if profiler.enabled else None, badevents.counts, selection.counts)
+
+
+if __name__ == "__main__":
+  bad = False
+  shardfiles = []
+  try:
+    if args.zh_lep_hawk:
+      print ("Algorithm will automaticaly merge associated FSR photons to the leptons")
+    args.weightids = weightids(args)
+    metadata = lhemetadata(args.inputfile)
+    metadata["schemaversion"] = str(args.schema_version)
+    if args.augment:
+      args.newbranches, args.alignmentbranches = augmentbranches(args)
+      metadata["augments"] = args.augment
+      print "Adding the branches", ", ".join(args.newbranches), "to", args.augment + ", checking the events with", ", ".join(args.alignmentbranches)
+    profiler = openprofiler(args)
+    selection = openselection(args)
+    sampler = opensampler(args)
+
+    if args.pipeline:
+      writer = outputwriter(args, args.outputfile, metadata)
+      badevents = openbadevents(args, args.quarantine_file)
+      if args.mela_cache:
+        #create the cache and check the version once, before the workers
+        cache = openmelacache(args)
+        cache.close()
+      try:
+        nevents, cachestats = convertpipeline(args, writer, badevents, profiler, selection, sampler)
+      finally:
+        badevents.close()
+      print "Processed", nevents, "events"
+      if args.mela_cache:
+        stats = cache.stats
+        for workerstats in cachestats:
+          for key in "hits", "misses", "evicted":
+            stats[key] += workerstats[key]
+        printreport(args.mela_cache, stats)
+      with profiler.stage("close"):
+        writer.close()
+      printwritereport(args.outputfile, writer.stats)
+      badevents.report()
+      selection.report()
+    elif args.jobs > 1 or args.checkpoint_every:
+      #the shards are merged in input order, so the output is the same as with --jobs 1
+      shards = makeshards(args.inputfile, 4*args.jobs, args.checkpoint_every)
+      shardfiles = ["{}.shard{}{}".format(os.path.splitext(args.outputfile)[0], n, os.path.splitext(args.outputfile)[1]) for n in range(len(shards))]
+      checkpoint = Checkpoint.open(args, shards, shardfiles) if args.checkpoint_every else None
+      results = dict(checkpoint.done) if checkpoint is not None else {}
+      if results:
+        print "Resuming from", checkpoint.filename + ":", len(results), "of", len(shards), "shards are done"
+      if args.mela_cache:
+        #create the cache and check the version once, before the workers
+        cache = openmelacache(args)
+        cache.close()
+      tasks = [(args, shardfile) + shard for shardfile, shard in zip(shardfiles, shards) if shardfile not in results]
+      pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+      try:
+        for shardfile, result in (pool.imap_unordered(convertshard, tasks, chunksize=1) if pool is not None else itertools.imap(convertshard, tasks)):
+          results[shardfile] = result
+          if checkpoint is not None: checkpoint.add(shardfile, result)
+      finally:
+        if pool is not None: pool.terminate()
+      results = [results[shardfile] for shardfile in shardfiles]
+      outputwriterclass = TreeWriter if args.output_format == "root" else ColumnWriter
+      with profiler.stage("merge"):
+        outputwriterclass.merge(args, shardfiles, args.outputfile, metadata)
+      print "Processed", sum(nevents for nevents, cachestats, writestats, profilestats, badcounts, selectioncounts in results), "events in", len(shards), "shards"
+      if args.profile:
+        for nevents, cachestats, writestats, profilestats, badcounts, selectioncounts in results:
+          profiler.add(profilestats)
+      if args.mela_cache:
+        stats = cache.stats
+        for nevents, cachestats, writestats, profilestats, badcounts, selectioncounts in results:
+          for key in "hits", "misses", "evicted":
+            stats[key] += cachestats[key]
+        printreport(args.mela_cache, stats)
+      badevents = openbadevents(args, args.quarantine_file)
+      for nevents, cachestats, writestats, profilestats, badcounts, selectioncounts in results:
+        badevents.add(badcounts)
+        selection.add(selectioncounts)
+      mergequarantinefiles([quarantinefilename(_) for _ in shardfiles], args.quarantine_file)
+      #writetime is summed over the workers, so this is the throughput per worker
+      printwritereport(args.outputfile, {key: sum(writestats[key] for nevents, cachestats, writestats, profilestats, badcounts, selectioncounts in results) for key in ("nevents", "totbytes", "zipbytes", "writetime")})
+      badevents.report()
+      selection.report()
+      if checkpoint is not None: checkpoint.remove()
+    else:
+      writer = outputwriter(args, args.outputfile, metadata)
+      cache = openmelacache(args)
+      badevents = openbadevents(args, args.quarantine_file)
+      try:
+        for inputfile in args.inputfile:
+          convertfile(args, writer, inputfile, cache=cache, profiler=profiler, badevents=badevents, selection=selection, sampler=sampler)
+      finally:
+        badevents.close()
+        if cache is not None:
+          cache.close()
+          cache.report()
+      with profiler.stage("close"):
+        writer.close()
+      printwritereport(args.outputfile, writer.stats)
+      badevents.report()
+      selection.report()
+    if args.profile:
+      profiler.write(args.profile)
+      profiler.report()
+  except:
+    bad = True
+    raise
+  finally:
+    #the finished shards of a --checkpoint-every conversion are kept for --resume
+    for shardfile in shardfiles if not (bad and args.checkpoint_every) else ():
+      for _ in shardfile, quarantinefilename(shardfile):
+        try:
+          os.remove(_)
+        except:
+          pass
+    if bad:
+      #the quarantine file is only this run's if --bad-events quarantine, otherwise it wasn't checked to not exist
+      for _ in [args.outputfile] + ([args.quarantine_file] if args.bad_events == "quarantine" else []):
+        try:
+          os.remove(_)
+        except:
+          pass
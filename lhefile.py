@@ -1,9 +1,23 @@
 import abc
+from array import array
+import bisect
 import collections
-import re
+import hashlib
+import itertools
+import json
+import linecache
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
+import struct
+import sys
+import threading
+import zlib
 
 if __name__ == "__main__":
-  import argparse, itertools, sys, unittest
+  import argparse, itertools, random, shutil, sys, tempfile, unittest
   from mela import TVar
   parser = argparse.ArgumentParser()
   parser.add_argument('--lhefile-hwithdecay')
@@ -15,21 +29,245 @@ if __name__ == "__main__":
 
 import ROOT
 
-from mela import Mela, SimpleParticle_t, SimpleParticleCollection_t
+from mela import SimpleParticle_t, SimpleParticleCollection_t
+from melapool import melapool
+from profiler import nullprofiler
+
+try:
+  import numpy
+except ImportError:
+  numpy = None  #only needed for the columnar reader
 
 InputEvent = collections.namedtuple("InputEvent", "daughters associated mothers isgen")
 
+#roles of the particles in the columnar reader: which of the InputEvent collections each particle goes into
+NOROLE, DAUGHTER, ASSOCIATED, MOTHER = range(4)
+
+#struct of arrays for a chunk of LHE events:
+#event, id, status, mother1, mother2, px, py, pz, E, m and role have one entry per particle
+#(mother1 and mother2 are 1-based indices within the event, as in the file),
+#eventoffset has one entry per event plus one: the particles of event i are eventoffset[i]:eventoffset[i+1],
+#weight has one entry per event
+LHEColumns = collections.namedtuple("LHEColumns", "event id status mother1 mother2 px py pz E m role eventoffset weight")
+
+class _ColumnEventError(ValueError):
+  def __init__(self, event, message):
+    super(_ColumnEventError, self).__init__(message)
+    self.event = event
+
+def _isjet(absid):
+  return ((1 <= absid) & (absid <= 6)) | (absid == 21)
+
+def _motherindex(c, mother, particles=slice(None)):
+  """index into the particle columns of the particle at 1-based position mother in the same event as particles, -1 for 0"""
+  return numpy.where(mother > 0, c.eventoffset[c.event[particles]] + mother - 1, -1)
+
+def _checkcount(c, mask, expected, message):
+  """raises if the number of particles in mask differs from expected in any event"""
+  counts = numpy.bincount(c.event[mask], minlength=len(c.weight))
+  bad = numpy.flatnonzero(counts != expected)
+  if len(bad):
+    raise _ColumnEventError(bad[0], message.format(expected=expected, found=counts[bad[0]]))
+
+class PDGIdSet(object):
+  """
+  Set of |PDG id|s for the particle classification, stored as a lookup table indexed by |id|
+  (with a frozenset for ids beyond the table), which works for single ids and for numpy arrays.
+  """
+  tablesize = 256
+
+  def __init__(self, *absids):
+    self.absids = frozenset(absids)
+    self.table = bytearray(self.tablesize)
+    for _ in self.absids:
+      if _ < self.tablesize: self.table[_] = 1
+    self.large = frozenset(_ for _ in self.absids if _ >= self.tablesize)
+    self.numpytable = numpy.array(self.table, dtype=bool) if numpy is not None else None
+
+  def __contains__(self, absid):
+    if absid < self.tablesize: return self.table[absid]
+    return absid in self.large
+
+  def __or__(self, other):
+    return PDGIdSet(*(self.absids | other.absids))
+
+  def contains(self, absid):
+    """the numpy version of absid in self, for an array of |id|s"""
+    result = self.numpytable[numpy.minimum(absid, self.tablesize-1)] & (absid < self.tablesize)
+    if self.large: result |= numpy.in1d(absid, tuple(self.large))
+    return result
+
+QUARKS = PDGIdSet(1, 2, 3, 4, 5, 6)
+JETS = QUARKS | PDGIdSet(21)
+LEPTONS = PDGIdSet(11, 12, 13, 14, 15, 16)
+PHOTONS = PDGIdSet(22)
+
+#the integers that id, status, mother1 and mother2 usually are, looked up instead of calling int()
+_intlookup = {str(_): _ for _ in range(-1000, 1000)}
+
+class ParticleTable(object):
+  """
+  The particle lines of one event with their id, status, mother1 and mother2 parsed once into integer lists.
+  The lists are indexed by the 1-based position in the event, like mother1 and mother2,
+  and index 0 is a dummy particle with id 0 and no mothers.
+  """
+  __slots__ = ("lines", "ids", "statuses", "mother1s", "mother2s")
+
+  def __init__(self, lines):
+    self.lines = lines
+    fields = list(itertools.chain.from_iterable([line.split(None, 4)[:4] for line in lines]))
+    values = map(_intlookup.get, fields)
+    if None in values: values = map(int, fields)
+    if len(values) != 4*len(lines): raise ValueError("Particle lines should have at least 4 columns")
+    values[0:0] = (0, 0, 0, 0)
+    self.ids, self.statuses, self.mother1s, self.mother2s = values[0::4], values[1::4], values[2::4], values[3::4]
+
+  def __len__(self):
+    return len(self.lines)
+
+class ParticleRule(object):
+  """
+  One row of the particle classification table of an LHEEvent class.
+  The particles that pass all the given conditions get role (DAUGHTER, ASSOCIATED or MOTHER),
+  and each particle gets the role of the first rule it passes.
+    status:           the particle's status
+    id:               the particle's (signed) id
+    ids:              PDGIdSet that contains the particle's |id|
+    motherids:        the particle has a single mother (mother1 == mother2 != 0) whose |id| is in this PDGIdSet
+    grandmotherid:    the mother1 of that mother has this id
+    notgrandmotherid: the mother1 of that mother doesn't have this id
+    ancestorids:      going up the chain of single mothers (mother1 == mother2), one of them has an id in this tuple
+  requiredstatus is not a condition: if a particle passes the conditions but has a different status, it's an error.
+  """
+  def __init__(self, role, status=None, id=None, ids=None, motherids=None, grandmotherid=None, notgrandmotherid=None, ancestorids=None, requiredstatus=None, statuserror=None):
+    self.role = role
+    self.status, self.id, self.ids = status, id, ids
+    self.motherids, self.grandmotherid, self.notgrandmotherid = motherids, grandmotherid, notgrandmotherid
+    self.ancestorids = frozenset(ancestorids) if ancestorids is not None else None
+    self.requiredstatus, self.statuserror = requiredstatus, statuserror
+
+  def condition(self, name):
+    """
+    returns the conditions as python source for compileparticlerules, where name is the name of this rule
+    in the namespace of the compiled function and name_ids, name_motherids (and _large) are its PDGIdSets' tables
+    """
+    def idset(pdgidset, absid):
+      return "({name}_{set}[{absid}] if {absid} < {size} else {absid} in {name}_{set}_large)".format(name=name, set=pdgidset, absid=absid, size=PDGIdSet.tablesize)
+    conditions = []
+    if self.status is not None: conditions.append("status == {}".format(self.status))
+    if self.id is not None: conditions.append("id == {}".format(self.id))
+    if self.ids is not None: conditions.append(idset("ids", "absid"))
+    if self.motherids is not None or self.grandmotherid is not None or self.notgrandmotherid is not None:
+      conditions.append("mother1 == mother2s[i] != 0")
+      if self.motherids is not None: conditions.append(idset("motherids", "abs(ids[mother1])"))
+      if self.grandmotherid is not None: conditions.append("ids[mother1s[mother1]] == {}".format(self.grandmotherid))
+      if self.notgrandmotherid is not None: conditions.append("ids[mother1s[mother1]] != {}".format(self.notgrandmotherid))
+    if self.ancestorids is not None: conditions.append("{}.hasancestor(p, i)".format(name))
+    return " and ".join(conditions) or "True"
+
+  def hasancestor(self, p, i):
+    mother1, mother2 = p.mother1s[i], p.mother2s[i]
+    for _ in xrange(len(p)):
+      if mother1 == 0 or mother1 != mother2: return False
+      if p.ids[mother1] in self.ancestorids: return True
+      mother1, mother2 = p.mother1s[mother1], p.mother2s[mother1]
+    raise ValueError("Mother chain doesn't end")
+
+  def passescolumns(self, c, particles):
+    """the numpy version of the conditions, returns whether each of the particles (indices into the LHEColumns c) passes"""
+    passes = numpy.ones(len(particles), dtype=bool)
+    if self.status is not None: passes &= c.status[particles] == self.status
+    if self.id is not None: passes &= c.id[particles] == self.id
+    if self.ids is not None: passes &= self.ids.contains(numpy.abs(c.id[particles]))
+    if self.motherids is not None or self.grandmotherid is not None or self.notgrandmotherid is not None:
+      mother1 = c.mother1[particles]
+      passes &= (mother1 != 0) & (mother1 == c.mother2[particles])
+      motherindex = _motherindex(c, mother1, particles)
+      if self.motherids is not None:
+        passes &= self.motherids.contains(numpy.abs(c.id[motherindex]))
+      grandmotherindex = _motherindex(c, c.mother1[motherindex], particles)
+      grandmotherid = numpy.where(grandmotherindex >= 0, c.id[grandmotherindex], 0)
+      if self.grandmotherid is not None: passes &= grandmotherid == self.grandmotherid
+      if self.notgrandmotherid is not None: passes &= grandmotherid != self.notgrandmotherid
+    if self.ancestorids is not None:
+      passes[passes] = self._ancestorscolumns(c, particles[passes])
+    if self.requiredstatus is not None:
+      bad = numpy.flatnonzero(passes & (c.status[particles] != self.requiredstatus))
+      if len(bad):
+        particle = particles[bad[0]]
+        raise _ColumnEventError(c.event[particle], self.statuserror.format(status=c.status[particle]))
+    return passes
+
+  def _ancestorscolumns(self, c, particles):
+    #walk up the mother chains of all the particles at once
+    result = numpy.zeros(len(particles), dtype=bool)
+    pending = numpy.arange(len(particles))
+    mother1, mother2 = c.mother1[particles], c.mother2[particles]
+    ancestorids = tuple(self.ancestorids)
+    for _ in xrange(len(c.id)+1):
+      if not len(pending): break
+      keep = (mother1 != 0) & (mother1 == mother2)
+      pending, mother1 = pending[keep], mother1[keep]
+      motherindex = _motherindex(c, mother1, particles[pending])
+      found = numpy.in1d(c.id[motherindex], ancestorids)
+      result[pending[found]] = True
+      pending, motherindex = pending[~found], motherindex[~found]
+      mother1, mother2 = c.mother1[motherindex], c.mother2[motherindex]
+    else:
+      raise _ColumnEventError(c.event[particles[pending[0]]], "Mother chain doesn't end")
+    return result
+
+_compiledparticlerules = {}
+
+def compileparticlerules(rules):
+  """
+  Compiles a table of ParticleRules into one python function classify(p) that returns the role of each particle
+  in the ParticleTable p (indexed like p, so that index 0 is NOROLE), with the conditions inlined into an if/elif chain.
+  The generated source is classify.source, and is also in linecache, so that tracebacks show the failing condition.
+  """
+  if rules in _compiledparticlerules: return _compiledparticlerules[rules]
+  namespace = {"NOROLE": NOROLE}
+  source = [
+    "def classify(p):",
+    "  ids, statuses, mother1s, mother2s = p.ids, p.statuses, p.mother1s, p.mother2s",
+    "  roles = [NOROLE] * len(ids)",
+    "  for i in xrange(1, len(ids)):",
+    "    id, status, mother1 = ids[i], statuses[i], mother1s[i]",
+    "    absid = -id if id < 0 else id",
+  ]
+  for k, rule in enumerate(rules):
+    name = "rule{}".format(k)
+    namespace[name] = rule
+    for pdgidset in "ids", "motherids":
+      if getattr(rule, pdgidset) is not None:
+        namespace[name+"_"+pdgidset] = getattr(rule, pdgidset).table
+        namespace[name+"_"+pdgidset+"_large"] = getattr(rule, pdgidset).large
+    source.append("    {} {}:".format("if" if k == 0 else "elif", rule.condition(name)))
+    if rule.requiredstatus is not None:
+      source.append("      if status != {}: raise ValueError({}.statuserror.format(status=status))".format(rule.requiredstatus, name))
+    source.append("      roles[i] = {}".format(rule.role))
+  source.append("  return roles")
+  source = "\n".join(source) + "\n"
+  filename = "<particlerules {}>".format(len(_compiledparticlerules))
+  linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+  exec compile(source, filename, "exec") in namespace
+  classify = namespace["classify"]
+  classify.source = source
+  _compiledparticlerules[rules] = classify
+  return classify
+
 class LHEEvent(object):
+  """
+  One event, with its particles classified into daughters, associated particles and mothers
+  by the particlerules table that each subclass defines.
+  """
   __metaclass__ = abc.ABCMeta
+
   def __init__(self, event, isgen):
+    self.event = event
+    self._weights = None
     lines = event.split("\n")
 
-    self.weights = {}
-    for line in lines:
-      if "<wgt" not in line: continue
-      match = re.match("<wgt id='(.*)'>([0-9+Ee.-]*)</wgt>", line)
-      if match: self.weights[match.group(1)] = float(match.group(2))
-
     lines = [line for line in lines if not ("<" in line or ">" in line or not line.split("#")[0].strip())]
     nparticles, _, weight, _, _, _ = lines[0].split()
 
@@ -42,169 +280,107 @@ class LHEEvent(object):
     if not list(mothers): mothers = None
     self.daughters, self.associated, self.mothers, self.isgen = self.inputevent = InputEvent(daughters, associated, mothers, isgen)
 
-  @abc.abstractmethod
-  def extracteventparticles(cls, lines, isgen): "has to be a classmethod that returns daughters, associated, mothers"
-
-  def __iter__(self):
-    return iter(self.inputevent)
-
-class LHEEvent_Hwithdecay(LHEEvent):
-  @classmethod
-  def extracteventparticles(cls, lines, isgen):
-    daughters, mothers, associated = [], [], []
-    ids = [None]
-    mother1s = [None]
-    mother2s = [None]
-    for line in lines:
-      id, status, mother1, mother2 = (int(_) for _ in line.split()[0:4])
-      ids.append(id)
-      if (1 <= abs(id) <= 6 or abs(id) == 21) and not isgen:
-        line = line.replace(str(id), "0", 1)  #replace the first instance of the jet id with 0, which means unknown jet
-      mother1s.append(mother1)
-      mother2s.append(mother2)
-      if status == -1:
-        mothers.append(line)
-      elif status == 1 and (1 <= abs(id) <= 6 or 11 <= abs(id) <= 16 or abs(id) in (21, 22)):
-        while True:
-          if mother1 != mother2 or mother1 is None:
-            associated.append(line)
-            break
-          if ids[mother1] in (25, 39):
-            daughters.append(line)
-            break
-          mother2 = mother2s[mother1]
-          mother1 = mother1s[mother1]
-
-    if not isgen: mothers = None
-    return daughters, associated, mothers
+  @property
+  def weights(self):
+    """dict of the reweighting weights, id: value, parsed when it's first used"""
+    if self._weights is None: self._weights = dict(iterweights(self.event))
+    return self._weights
 
+  @abc.abstractproperty
+  def particlerules(self):
+    "has to be a class attribute: the classification table, a tuple of ParticleRules, the first one that a particle passes gives its role"
 
-class LHEEvent_VHHiggsdecay(LHEEvent):
-  @classmethod
-  def extracteventparticles(cls, lines, isgen):
-    daughters, mothers, associated = [], [], []
-    ids = [None]
-    mother1s = [None]
-    mother2s = [None]
-    for line in lines:
-      id, status, mother1, mother2 = (int(_) for _ in line.split()[0:4])
-      ids.append(id)
-      
-      #if (1 <= abs(id) <= 6 or abs(id) == 21) and not isgen:
-      #  line = line.replace(str(id), "0", 1)  #replace the first instance of the jet id with 0, which means unknown jet
-      mother1s.append(mother1)
-      mother2s.append(mother2)
-      if status == -1:
-        mothers.append(line)
-      elif status == 1 and (1 <= abs(id) <= 6 or 11 <= abs(id) <= 16 or abs(id) in (21, 22)):
-        
-          if mother1 is None or ids is None or mother1s[mother1] is None :
-            #associated.append(line)
-            continue
-          
-          if mother1 == mother2 and abs(ids[mother1]) in (23,24) and  not ids[mother1s[mother1]] == 25 :
-            associated.append(line)
-            
-          
-          if mother1 == mother2 and abs(ids[mother1]) == 23 and  ids[mother1s[mother1]] == 25:
-            daughters.append(line)
-            
-    if not isgen: mothers = None
-    return daughters, associated, mothers
+  #checks of the number of particles with each role, after the classification:
+  #(role, class attribute with the expected number or None for no check, error message)
+  countchecks = ()
 
+  #whether quark and gluon ids are replaced by 0 (unknown jet) when not isgen
+  replacejetids = True
 
-  
-class LHEEvent_HwithdecayOnly(LHEEvent):
   @classmethod
   def extracteventparticles(cls, lines, isgen):
-    daughters, mothers, associated = [], [], []
-    ids = [None]
-    mother1s = [None]
-    mother2s = [None]
-    for line in lines:
-      id, status, mother1, mother2 = (int(_) for _ in line.split()[0:4])
-      ids.append(id)
-      if (1 <= abs(id) <= 6 or abs(id) == 21) and not isgen:
+    "returns the lines of the daughters, associated and mothers, classified with particlerules"
+    particles = ParticleTable(lines)
+    try:
+      roles = compileparticlerules(cls.particlerules)(particles)
+    except ValueError as e:
+      raise ValueError(e.message + "\n\n" + "\n".join(lines))
+    result = {NOROLE: [], DAUGHTER: [], ASSOCIATED: [], MOTHER: []}
+    replacejetids = cls.replacejetids and not isgen
+    for id, role, line in itertools.izip(particles.ids[1:], roles[1:], lines):
+      if replacejetids and abs(id) in JETS:
         line = line.replace(str(id), "0", 1)  #replace the first instance of the jet id with 0, which means unknown jet
-      mother1s.append(mother1)
-      mother2s.append(mother2)
-      if(abs(id) == 22 ):
-        associated.append(line)
-      #1 <= abs(id) <= 6 or
-      if ( 11 <= abs(id) <= 16 ):
-          daughters.append(line)
-          #if args.merge_photon:
-          #  print line
+      result[role].append(line)
 
-    if not isgen: mothers = None
+    for role, expected, message in cls.countchecks:
+      expected = getattr(cls, expected)
+      if expected is not None and len(result[role]) != expected:
+        raise ValueError(message.format(expected=expected, found=len(result[role])) + "\n\n" + "\n".join(lines))
 
-    return daughters, associated, mothers
+    mothers = result[MOTHER] if isgen else None
+    return result[DAUGHTER], result[ASSOCIATED], mothers
 
+  @classmethod
+  def columnroles(cls, c, isgen):
+    "returns the role of each particle in the LHEColumns c, classified with particlerules"
+    role = numpy.zeros(len(c.id), dtype=numpy.int8)
+    particles = numpy.arange(len(c.id))
+    for rule in cls.particlerules:
+      passes = rule.passescolumns(c, particles)
+      role[particles[passes]] = rule.role
+      particles = particles[~passes]
+    for checkrole, expected, message in cls.countchecks:
+      expected = getattr(cls, expected)
+      if expected is not None:
+        _checkcount(c, role == checkrole, expected, message)
+    return role
 
+  def __iter__(self):
+    return iter(self.inputevent)
 
-  
-class LHEEvent_StableHiggs(LHEEvent):
-  @classmethod
-  def extracteventparticles(cls, lines, isgen):
-    daughters, mothers, associated = [], [], []
-    for line in lines:
-      id, status, mother1, mother2 = (int(_) for _ in line.split()[0:4])
-      if (1 <= abs(id) <= 6 or abs(id) == 21) and not isgen:
-        line = line.replace(str(id), "0", 1)  #replace the first instance of the jet id with 0, which means unknown jet
-      if status == -1:
-        mothers.append(line)
-      if id == 25:
-        if status != 1:
-          raise ValueError("Higgs has status {}, expected it to be 1\n\n".format(status) + "\n".join(lines))
-        daughters.append(line)
-      if abs(id) in (0, 1, 2, 3, 4, 5, 11, 12, 13, 14, 15, 16, 21) and status == 1:
-        associated.append(line)
-
-    if len(daughters) != 1:
-      raise ValueError("More than one H in the event??\n\n"+"\n".join(lines))
-    if cls.nassociatedparticles is not None and len(associated) != cls.nassociatedparticles:
-      raise ValueError("Wrong number of associated particles (expected {}, found {})\n\n".format(cls.nassociatedparticles, len(associated))+"\n".join(lines))
-    if len(mothers) != 2:
-      raise ValueError("{} mothers in the event??\n\n".format(len(mothers))+"\n".join(lines))
-
-    if not isgen: mothers = None
-    return daughters, associated, mothers
+class LHEEvent_Hwithdecay(LHEEvent):
+  particlerules = (
+    ParticleRule(MOTHER, status=-1),
+    ParticleRule(DAUGHTER, status=1, ids=JETS|LEPTONS|PHOTONS, ancestorids=(25, 39)),
+    ParticleRule(ASSOCIATED, status=1, ids=JETS|LEPTONS|PHOTONS),
+  )
 
-  nassociatedparticles = None
+class LHEEvent_VHHiggsdecay(LHEEvent):
+  particlerules = (
+    ParticleRule(MOTHER, status=-1),
+    ParticleRule(ASSOCIATED, status=1, ids=JETS|LEPTONS|PHOTONS, motherids=PDGIdSet(23, 24), notgrandmotherid=25),
+    ParticleRule(DAUGHTER, status=1, ids=JETS|LEPTONS|PHOTONS, motherids=PDGIdSet(23), grandmotherid=25),
+  )
 
+  replacejetids = False
 
-  
-class LHEEvent_StableHiggsZHHAWK(LHEEvent):
-  @classmethod
-  def extracteventparticles(cls, lines, isgen):
-    daughters, mothers, associated = [], [], []
-    for line in lines:
-      id, status, mother1, mother2 = (int(_) for _ in line.split()[0:4])
-      if (1 <= abs(id) <= 6 or abs(id) == 21) and not isgen:
-        line = line.replace(str(id), "0", 1)  #replace the first instance of the jet id with 0, which means unknown jet
-      if status == -1:
-        mothers.append(line)
-      if id == 25:
-        if status != 1:
-          raise ValueError("Higgs has status {}, expected it to be 1\n\n".format(status) + "\n".join(lines))
-        daughters.append(line)
-      if abs(id) in (0, 1, 2, 3, 4, 5, 11, 12, 13, 14, 15, 16, 21,22) and status == 1:
-        associated.append(line)
-
-    if len(daughters) != 1:
-      raise ValueError("More than one H in the event??\n\n"+"\n".join(lines))
-    if cls.nassociatedparticles is not None and len(associated) != cls.nassociatedparticles:
-      raise ValueError("Wrong number of associated particles (expected {}, found {})\n\n".format(cls.nassociatedparticles, len(associated))+"\n".join(lines))
-    if len(mothers) != 2:
-      raise ValueError("{} mothers in the event??\n\n".format(len(mothers))+"\n".join(lines))
-
-    if not isgen: mothers = None
-    return daughters, associated, mothers
+class LHEEvent_HwithdecayOnly(LHEEvent):
+  particlerules = (
+    ParticleRule(ASSOCIATED, ids=PHOTONS),
+    ParticleRule(DAUGHTER, ids=LEPTONS),
+  )
+
+class LHEEvent_StableHiggs(LHEEvent):
+  particlerules = (
+    ParticleRule(DAUGHTER, id=25, requiredstatus=1, statuserror="Higgs has status {status}, expected it to be 1"),
+    ParticleRule(MOTHER, status=-1),
+    ParticleRule(ASSOCIATED, status=1, ids=PDGIdSet(0, 1, 2, 3, 4, 5, 11, 12, 13, 14, 15, 16, 21)),
+  )
+  countchecks = (
+    (DAUGHTER, "ndaughters", "More than one H in the event??"),
+    (ASSOCIATED, "nassociatedparticles", "Wrong number of associated particles (expected {expected}, found {found})"),
+    (MOTHER, "nmothers", "{found} mothers in the event??"),
+  )
 
+  ndaughters = 1
   nassociatedparticles = None
+  nmothers = 2
 
+class LHEEvent_StableHiggsZHHAWK(LHEEvent_StableHiggs):
+  particlerules = LHEEvent_StableHiggs.particlerules[:-1] + (
+    ParticleRule(ASSOCIATED, status=1, ids=PDGIdSet(0, 1, 2, 3, 4, 5, 11, 12, 13, 14, 15, 16, 21, 22)),
+  )
 
-  
 class LHEEvent_JHUGenVBFVH(LHEEvent_StableHiggs):
   nassociatedparticles = 2
 
@@ -212,31 +388,930 @@ class LHEEvent_JHUGenttH(LHEEvent_StableHiggs):
   nassociatedparticles = 6
 
 class LHEEvent_Offshell4l(LHEEvent):
-  @classmethod
-  def extracteventparticles(cls, lines, isgen):
-    daughters, mothers, associated = [], [], []
-    for line in lines:
-      id, status, mother1, mother2 = (int(_) for _ in line.split()[0:4])
-      if (1 <= abs(id) <= 6 or abs(id) == 21) and not isgen:
-        line = line.replace(str(id), "0", 1)  #replace the first instance of the jet id with 0, which means unknown jet
-      if status == -1:
-        mothers.append(line)
-      if abs(id) in (11, 12, 13, 14, 15, 16) and status == 1:
-        daughters.append(line)
-      if abs(id) in (0, 1, 2, 3, 4, 5, 21) and status == 1:
-        associated.append(line)
-
-    if len(daughters) != 4:
-      raise ValueError("Wrong number of daughters (expected {}, found {})\n\n".format(4, len(daughters))+"\n".join(lines))
-    if cls.nassociatedparticles is not None and len(associated) != cls.nassociatedparticles:
-      raise ValueError("Wrong number of associated particles (expected {}, found {})\n\n".format(cls.nassociatedparticles, len(associated))+"\n".join(lines))
-    if len(mothers) != 2:
-      raise ValueError("{} mothers in the event??\n\n".format(len(mothers))+"\n".join(lines))
-
-    if not isgen: mothers = None
-    return daughters, associated, mothers
+  particlerules = (
+    ParticleRule(MOTHER, status=-1),
+    ParticleRule(DAUGHTER, status=1, ids=LEPTONS),
+    ParticleRule(ASSOCIATED, status=1, ids=PDGIdSet(0, 1, 2, 3, 4, 5, 21)),
+  )
+  countchecks = (
+    (DAUGHTER, "ndaughters", "Wrong number of daughters (expected {expected}, found {found})"),
+    (ASSOCIATED, "nassociatedparticles", "Wrong number of associated particles (expected {expected}, found {found})"),
+    (MOTHER, "nmothers", "{found} mothers in the event??"),
+  )
 
+  ndaughters = 4
   nassociatedparticles = None
+  nmothers = 2
+
+def parsecolumns(events, lheeventclass, isgen=True):
+  """
+  Parses a list of event strings into LHEColumns in bulk,
+  classifying the particles with lheeventclass.columnroles.
+  """
+  if numpy is None: raise ImportError("The columnar reader needs numpy")
+  particlelines = []
+  nparticles = []
+  weights = []
+  for event in events:
+    if "#" in event:
+      lines = [line.split("#")[0] for line in event.split("\n") if not ("<" in line or ">" in line or not line.split("#")[0].strip())]
+    else:
+      lines = [line for line in event.split("\n") if line.strip() and "<" not in line and ">" not in line]
+    header = lines[0].split()
+    if int(header[0]) != len(lines)-1:
+      raise ValueError("Wrong number of particles! Should be {}, have {}\n\n".format(header[0], len(lines)-1) + event)
+    nparticles.append(len(lines)-1)
+    weights.append(float(header[2]))
+    particlelines += lines[1:]
+
+  #only the first 13 columns are read, like in SimpleParticle_t, so extra columns at the end of the line are ignored
+  fields = []
+  for line in particlelines:
+    line = line.split()
+    if len(line) < 13:
+      raise ValueError("Particle lines should have at least 13 columns\n\n" + " ".join(line))
+    fields += line[:13]
+  data = numpy.array(fields, dtype=numpy.float64).reshape(-1, 13)
+  nparticles = numpy.array(nparticles, dtype=numpy.int64)
+  eventoffset = numpy.zeros(len(events)+1, dtype=numpy.int64)
+  numpy.cumsum(nparticles, out=eventoffset[1:])
+  ints = data[:,0:4].astype(numpy.int32)
+  c = LHEColumns(
+    event=numpy.repeat(numpy.arange(len(events)), nparticles),
+    id=ints[:,0], status=ints[:,1], mother1=ints[:,2], mother2=ints[:,3],
+    px=data[:,6], py=data[:,7], pz=data[:,8], E=data[:,9], m=data[:,10],
+    role=None, eventoffset=eventoffset, weight=numpy.array(weights),
+  )
+
+  try:
+    role = lheeventclass.columnroles(c, isgen)
+  except _ColumnEventError as e:
+    raise ValueError(e.message + "\n\n" + events[e.event])
+  if not isgen:
+    role[role == MOTHER] = NOROLE
+    if lheeventclass.replacejetids:
+      ids = c.id.copy()
+      ids[_isjet(numpy.abs(ids))] = 0
+      c = c._replace(id=ids)
+  return c._replace(role=role)
+
+class BadEventHandler(object):
+  """
+  What to do with the events that can't be parsed or classified
+  (a ValueError or IndexError from the LHEEvent class or parsecolumns, e.g. the wrong number of daughters):
+    "fail":       raise the error
+    "skip":       leave the event out and count it
+    "quarantine": like skip, and write the event verbatim to quarantinefile, after a comment with the reason and where it was,
+                  so that the file can be read with scanevents
+  counts has the number of bad events for each reason (the first line of the error message).
+  Example usage:
+    badevents = BadEventHandler("quarantine", "bad.lhe")
+    with LHEFile_Hwithdecay("filename.lhe", onbadevent=badevents) as f:
+      for event in f:
+        ...
+    badevents.close()
+    badevents.report()
+  """
+  policies = ("fail", "skip", "quarantine")
+  errors = (ValueError, IndexError)
+
+  def __init__(self, policy="fail", quarantinefile=None):
+    if policy not in self.policies: raise ValueError("Unknown bad event policy {}, should be one of {}".format(policy, ", ".join(self.policies)))
+    if policy == "quarantine" and quarantinefile is None: raise ValueError("The quarantine policy needs a quarantinefile")
+    self.policy, self.quarantinefile = policy, quarantinefile
+    self.counts = collections.OrderedDict()
+    self._f = None
+
+  def handle(self, filename, offset, linenumber, event, error):
+    """called for a bad event with its error, returns True if the event should be left out, False if the error should be raised"""
+    if self.policy == "fail": return False
+    reason = str(error).split("\n")[0]
+    self.counts[reason] = self.counts.get(reason, 0) + 1
+    if self.policy == "quarantine":
+      if self._f is None: self._f = open(self.quarantinefile, "w")
+      where = "line {}".format(linenumber) if linenumber is not None else "byte {}".format(offset)
+      self._f.write("<!-- {} {}: {} -->\n".format(filename, where, reason.replace("--", "- -")))
+      self._f.write(event if event.endswith("\n") else event + "\n")
+    return True
+
+  @property
+  def nbad(self):
+    return sum(self.counts.itervalues())
+
+  def add(self, counts):
+    """adds the counts of another handler, e.g. from a worker process"""
+    for reason, count in counts.iteritems():
+      self.counts[reason] = self.counts.get(reason, 0) + count
+
+  def close(self):
+    if self._f is not None:
+      self._f.close()
+      self._f = None
+
+  def report(self):
+    if not self.nbad: return
+    print "Left out {} bad events{}:".format(self.nbad, ", written to "+self.quarantinefile if self.policy == "quarantine" else "")
+    for reason, count in self.counts.iteritems():
+      print "  {:10} {}".format(count, reason)
+
+failonbadevents = BadEventHandler("fail")
+
+class EventSampler(object):
+  """
+  Which events to read, decided from the raw event text from scanevents before it's parsed, in this order:
+    skip:       leave out the first skip events of each file
+    every:      of the rest, keep every every'th event of each file, starting with the first one
+    fraction:   keep each event with probability fraction
+    unweight:   keep each event with probability |w| / wmax (accept-reject unweighting), where w is the event weight,
+                or with unweightid the weight with that reweighting id, and wmax is maxweight or else the largest |w| in the file.
+                The event weight of the kept events is set to +-wmax in their text, so that they're unweighted.
+    maxevents:  stop after keeping maxevents events in total, over all the files read with this sampler
+  The random decisions come from a hash of seed and the byte offset of the event, so the same events are kept
+  however the file is split into byte ranges (see LHEIndex.split), and skip and every count from the start of the file
+  even when only a byte range is read.
+  nread is the number of events that were looked at and nsampled the number that were kept.
+  Example usage:
+    sampler = EventSampler(fraction=0.01, seed=1)
+    with LHEFile_Hwithdecay("filename.lhe", sampler=sampler) as f:
+      for event in f:
+        ...
+  """
+  def __init__(self, maxevents=None, skip=0, every=1, fraction=None, unweight=False, unweightid=None, maxweight=None, seed=0):
+    if maxevents is not None and maxevents < 0: raise ValueError("maxevents should be >= 0, not {}".format(maxevents))
+    if skip < 0: raise ValueError("skip should be >= 0, not {}".format(skip))
+    if every < 1: raise ValueError("every should be >= 1, not {}".format(every))
+    if fraction is not None and not 0 < fraction <= 1: raise ValueError("fraction should be in (0, 1], not {}".format(fraction))
+    if maxweight is not None and maxweight <= 0: raise ValueError("maxweight should be > 0, not {}".format(maxweight))
+    self.maxevents, self.skip, self.every, self.fraction = maxevents, skip, every, fraction
+    self.unweight, self.unweightid, self.maxweight, self.seed = unweight or unweightid is not None, unweightid, maxweight, seed
+    self.nread = self.nsampled = 0
+    self.__maxweights = {}
+
+  def __nonzero__(self):
+    """whether this leaves out any events"""
+    return self.maxevents is not None or self.skip > 0 or self.every > 1 or self.fraction is not None or self.unweight
+
+  @property
+  def done(self):
+    return self.maxevents is not None and self.nsampled >= self.maxevents
+
+  def random(self, name, offset):
+    """uniform in [0, 1), the same for the same seed, name and offset"""
+    return struct.unpack("<Q", hashlib.md5("{} {} {}".format(self.seed, name, offset)).digest()[:8])[0] / 2.**64
+
+  def weight(self, event):
+    """w of the event for the unweighting"""
+    if self.unweightid is None: return eventweight(event)
+    for id, value in iterweights(event):
+      if id == self.unweightid: return value
+    raise ValueError("No weight {} in the event\n\n{}".format(self.unweightid, event))
+
+  def filemaxweight(self, filename, compression=None, blocksize=1<<22):
+    """wmax for the unweighting of filename, from the index for the event weight or from reading the whole file for a reweighting id"""
+    if self.maxweight is not None: return self.maxweight
+    if filename not in self.__maxweights:
+      if self.unweightid is None:
+        weights = LHEIndex.load(filename, compression=compression, blocksize=blocksize).weights
+      else:
+        with openlhefile(filename, compression) as f:
+          weights = [self.weight(event) for offset, linenumber, event in scanevents(f, blocksize)]
+      maxweight = max([abs(_) for _ in weights] or [0])
+      if not maxweight: raise ValueError("Can't unweight {}, all the weights are 0".format(filename))
+      self.__maxweights[filename] = maxweight
+    return self.__maxweights[filename]
+
+  def sample(self, events, filename, compression=None, blocksize=1<<22, firstevent=0):
+    """
+    yields the (offset, linenumber, event) from scanevents on filename that are kept,
+    where the first one is event number firstevent of the file (e.g. from LHEIndex for a byte range)
+    """
+    if self.done: return
+    for number, (offset, linenumber, event) in enumerate(events, firstevent):
+      self.nread += 1
+      if number < self.skip or (number - self.skip) % self.every: continue
+      if self.fraction is not None and self.random("fraction", offset) >= self.fraction: continue
+      if self.unweight:
+        weight, maxweight = self.weight(event), self.filemaxweight(filename, compression, blocksize)
+        if self.random("unweight", offset) * maxweight >= abs(weight): continue
+        event = seteventweight(event, math.copysign(max(maxweight, abs(weight)), weight))
+      self.nsampled += 1
+      yield offset, linenumber, event
+      if self.done: return
+
+def _printeventlocation(offset, linenumber):
+  if linenumber is None:
+    print "In event starting at byte", offset
+  else:
+    print "In event starting on line", linenumber
+
+def parsechunk(chunk, lheeventclass, isgen=True, onbadevent=None, filename=None):
+  """
+  parsecolumns for a list of (offset, linenumber, event) from scanevents, returns the LHEColumns and the list of the events in them.
+  If there are bad events, the chunk is parsed again one event at a time to find them, and they're passed to onbadevent (a BadEventHandler).
+  """
+  try:
+    return parsecolumns([event for offset, linenumber, event in chunk], lheeventclass, isgen), chunk
+  except BadEventHandler.errors:
+    pass
+  good = []
+  for offset, linenumber, event in chunk:
+    try:
+      parsecolumns([event], lheeventclass, isgen)
+    except BadEventHandler.errors as e:
+      if (onbadevent or failonbadevents).handle(filename, offset, linenumber, event, e): continue
+      _printeventlocation(offset, linenumber)
+      raise
+    good.append((offset, linenumber, event))
+  return parsecolumns([event for offset, linenumber, event in good], lheeventclass, isgen), good
+
+class LHEColumnEvent(object):
+  """
+  Event i of a chunk of LHEColumns, which can be used like an LHEEvent.
+  The particles for mela are only built (from the columns, without parsing the text again) when they're used.
+  """
+  def __init__(self, c, i, event, isgen):
+    self.c, self.i = c, i
+    self.event = event
+    self.isgen = isgen
+    self.weight = float(c.weight[i])
+    self._inputevent = None
+
+  @property
+  def inputevent(self):
+    if self._inputevent is None:
+      c, particles = self.c, slice(self.c.eventoffset[self.i], self.c.eventoffset[self.i+1])
+      particles = zip(c.role[particles].tolist(), c.id[particles].tolist(), c.px[particles].tolist(), c.py[particles].tolist(), c.pz[particles].tolist(), c.E[particles].tolist())
+      daughters, associated, mothers = (
+        SimpleParticleCollection_t([SimpleParticle_t(id, ROOT.TLorentzVector(px, py, pz, E)) for role, id, px, py, pz, E in particles if role == wanted])
+        for wanted in (DAUGHTER, ASSOCIATED, MOTHER)
+      )
+      if not list(mothers): mothers = None
+      self._inputevent = InputEvent(daughters, associated, mothers, self.isgen)
+    return self._inputevent
+
+  daughters = property(lambda self: self.inputevent.daughters)
+  associated = property(lambda self: self.inputevent.associated)
+  mothers = property(lambda self: self.inputevent.mothers)
+
+  weights = LHEEvent.weights
+
+  def __iter__(self):
+    return iter(self.inputevent)
+
+#magic bytes at the start of the compressed formats that openlhefile detects
+compressionmagic = (
+  ("gzip", "\x1f\x8b"),
+  ("xz", "\xfd7zXZ\x00"),
+  ("zstd", "\x28\xb5\x2f\xfd"),
+  ("bz2", "BZh"),
+)
+
+#threads used to decompress BGZF and multi-frame zstd files in parallel
+decompressionthreads = min(multiprocessing.cpu_count(), 4)
+
+def detectcompression(filename):
+  """returns the compression of filename from its magic bytes: "gzip", "xz", "zstd", "bz2", or None if there are none"""
+  with open(filename, "rb") as f:
+    start = f.read(6)
+  for compression, magic in compressionmagic:
+    if start.startswith(magic): return compression
+  return None
+
+def openlhefile(filename, compression=None, threads=None):
+  """
+  opens an LHE file for reading.
+  compression is "gzip", "xz", "zstd" or "bz2", by default it's detected from the magic bytes
+  and the file is read as plain text if there are none.
+  Compressed files are returned as a DecompressedFile, which decompresses in a background thread.
+  """
+  if compression is None: compression = detectcompression(filename)
+  if compression is None: return open(filename)
+  if threads is None: threads = decompressionthreads
+  return DecompressedFile(filename, compression, threads)
+
+def _lzma():
+  try:
+    import lzma
+  except ImportError:
+    try:
+      from backports import lzma
+    except ImportError:
+      raise ImportError("Reading xz files needs the lzma module, on python 2: pip install backports.lzma")
+  return lzma
+
+def _zstandard():
+  try:
+    import zstandard
+  except ImportError:
+    raise ImportError("Reading zstd files needs the zstandard module: pip install zstandard")
+  return zstandard
+
+def _newdecompressor(compression):
+  if compression == "gzip": return zlib.decompressobj(16+zlib.MAX_WBITS)
+  if compression == "xz": return _lzma().LZMADecompressor()
+  if compression == "bz2":
+    import bz2
+    return bz2.BZ2Decompressor()
+  raise ValueError("Unknown compression {}".format(compression))
+
+def _decodestream(f, compression, chunksize):
+  """decompresses f sequentially, including files with several concatenated gzip members, xz or bz2 streams, or zstd frames"""
+  if compression == "zstd":
+    #zstandard's decompressobj stops after the first frame
+    reader = _zstandard().ZstdDecompressor().stream_reader(f, read_across_frames=True)
+    while True:
+      data = reader.read(chunksize)
+      if not data: return
+      yield data
+  d = _newdecompressor(compression)
+  while True:
+    data = f.read(chunksize)
+    if not data: break
+    while data:
+      yield d.decompress(data)
+      #the data after the end of this member
+      data = getattr(d, "unused_data", "") if getattr(d, "eof", True) else ""
+      if data:
+        if not data.strip("\0"): break  #padding at the end of the file
+        d = _newdecompressor(compression)
+  flush = getattr(d, "flush", None)
+  if flush is not None: yield flush()
+
+def _bgzfmembers(f):
+  """yields the gzip members of a BGZF (bgzip) file, which store their compressed size in the header"""
+  while True:
+    header = f.read(18)
+    if not header: return
+    if not _isbgzfheader(header): raise IOError("Invalid BGZF member")
+    size = struct.unpack("<H", header[16:18])[0] + 1
+    yield header + f.read(size - 18)
+
+def _isbgzfheader(header):
+  return len(header) == 18 and header[:4] == "\x1f\x8b\x08\x04" and header[10:14] == "\x06\x00BC"
+
+def _zstdframes(f):
+  """yields the frames of a zstd file, walking the block headers without decompressing"""
+  while True:
+    start = f.read(4)
+    if not start: return
+    magic, = struct.unpack("<I", start)
+    if 0x184D2A50 <= magic <= 0x184D2A5F:  #skippable frame
+      size, = struct.unpack("<I", f.read(4))
+      f.seek(size, 1)
+      continue
+    if magic != 0xFD2FB528: raise IOError("Invalid zstd frame")
+    descriptor = f.read(1)
+    flags = ord(descriptor)
+    contentsizeflag, singlesegment, checksum, dictionaryidflag = flags >> 6, flags >> 5 & 1, flags >> 2 & 1, flags & 3
+    headersize = (not singlesegment) + (0, 1, 2, 4)[dictionaryidflag] + (singlesegment, 2, 4, 8)[contentsizeflag]
+    frame = [start, descriptor, f.read(headersize)]
+    while True:
+      blockheader = f.read(3)
+      if len(blockheader) < 3: raise IOError("Truncated zstd frame")
+      value, = struct.unpack("<I", blockheader + "\0")
+      last, blocktype, blocksize = value & 1, value >> 1 & 3, value >> 3
+      frame += [blockheader, f.read(1 if blocktype == 1 else blocksize)]  #an RLE block has 1 byte
+      if last: break
+    if checksum: frame.append(f.read(4))
+    yield "".join(frame)
+
+def _groupmembers(members, size):
+  """groups the members into lists of about size compressed bytes, so that each task is big enough to be worth a thread"""
+  group, groupsize = [], 0
+  for member in members:
+    group.append(member)
+    groupsize += len(member)
+    if groupsize >= size:
+      yield group
+      group, groupsize = [], 0
+  if group: yield group
+
+def _decodegzipmembers(members):
+  return "".join(zlib.decompress(member, 16+zlib.MAX_WBITS) for member in members)
+
+def _decodezstdframes(frames):
+  return "".join(_zstandard().ZstdDecompressor().decompressobj().decompress(frame) for frame in frames)
+
+def _decodeparallel(members, decode, threads):
+  """decodes the members in a pool of threads and yields the results in order, with up to 2*threads members in flight"""
+  pool = ThreadPool(threads)
+  try:
+    pending = collections.deque()
+    for member in members:
+      pending.append(pool.apply_async(decode, (member,)))
+      if len(pending) >= 2*threads:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+  finally:
+    pool.terminate()
+
+def _decode(f, compression, chunksize, threads):
+  """
+  yields the decompressed data of the file object f.
+  BGZF files and zstd files are split into their members/frames, which are decompressed in parallel
+  (zlib and zstd release the GIL), anything else is decompressed sequentially.
+  """
+  if threads > 1 and compression == "gzip":
+    isbgzf = _isbgzfheader(f.read(18))
+    f.seek(0)
+    if isbgzf:
+      return _decodeparallel(_groupmembers(_bgzfmembers(f), chunksize), _decodegzipmembers, threads)
+  if threads > 1 and compression == "zstd":
+    return _decodeparallel(_groupmembers(_zstdframes(f), chunksize), _decodezstdframes, threads)
+  return _decodestream(f, compression, chunksize)
+
+class DecompressedFile(object):
+  """
+  Read-only file object for a compressed file, which is decompressed in a background thread
+  that starts at the first read and runs up to queuesize chunks ahead of the reader, so that decompressing and parsing overlap.
+  Seeking forward reads and discards the data in between, seeking backward starts again from the beginning,
+  like gzip.GzipFile.
+  """
+  def __init__(self, filename, compression, threads=1, chunksize=1<<20, queuesize=16):
+    self.filename = filename
+    self.compression = compression
+    self.threads = threads
+    self.chunksize = chunksize
+    self.queuesize = queuesize
+    self.closed = False
+    self.__start()
+
+  def __start(self):
+    self.__raw = open(self.filename, "rb")
+    self.__queue = Queue.Queue(self.queuesize)
+    self.__stop = threading.Event()
+    self.__buffer = ""
+    self.__bufferpos = 0
+    self.__offset = 0  #decompressed offset of the next byte to be read
+    self.__eof = False
+    #started at the first read, so that opening the file doesn't decompress anything
+    self.__thread = None
+
+  def __put(self, item):
+    """puts item in the queue, returns False if the file was closed in the meantime"""
+    while not self.__stop.is_set():
+      try:
+        self.__queue.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def __run(self):
+    try:
+      for data in _decode(self.__raw, self.compression, self.chunksize, self.threads):
+        if data and not self.__put(data): return
+      self.__put(None)
+    except BaseException:
+      self.__put(sys.exc_info())
+
+  def __nextpiece(self):
+    """gets the next piece of decompressed data from the thread, returns False at the end of the file"""
+    if self.__eof: return False
+    if self.__thread is None:
+      self.__thread = threading.Thread(target=self.__run)
+      self.__thread.daemon = True
+      self.__thread.start()
+    item = self.__queue.get()
+    if item is None:
+      self.__eof = True
+      return False
+    if isinstance(item, tuple):
+      self.__eof = True
+      raise item[0], item[1], item[2]
+    self.__buffer, self.__bufferpos = item, 0
+    return True
+
+  def read(self, size=-1):
+    pieces = []
+    while size != 0:
+      if self.__bufferpos >= len(self.__buffer) and not self.__nextpiece(): break
+      if size < 0:
+        piece = self.__buffer[self.__bufferpos:]
+      else:
+        piece = self.__buffer[self.__bufferpos:self.__bufferpos+size]
+        size -= len(piece)
+      self.__bufferpos += len(piece)
+      self.__offset += len(piece)
+      pieces.append(piece)
+    return "".join(pieces)
+
+  def readline(self):
+    pieces = []
+    while True:
+      if self.__bufferpos >= len(self.__buffer) and not self.__nextpiece(): break
+      end = self.__buffer.find("\n", self.__bufferpos)
+      end = len(self.__buffer) if end == -1 else end+1
+      pieces.append(self.__buffer[self.__bufferpos:end])
+      self.__offset += end - self.__bufferpos
+      self.__bufferpos = end
+      if pieces[-1].endswith("\n"): break
+    return "".join(pieces)
+
+  def __iter__(self):
+    return iter(self.readline, "")
+
+  def tell(self):
+    return self.__offset
+
+  def seek(self, offset, whence=0):
+    if whence == 1: offset += self.__offset
+    elif whence != 0: raise ValueError("Can only seek from the beginning or the current position of a compressed file")
+    if offset < self.__offset:
+      self.__close()
+      self.__start()
+    while self.__offset < offset:
+      if not self.read(min(offset - self.__offset, 1<<24)): break
+
+  def __close(self):
+    self.__stop.set()
+    if self.__thread is not None: self.__thread.join()
+    self.__raw.close()
+
+  def close(self):
+    if self.closed: return
+    self.__close()
+    self.closed = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *errorinfo):
+    self.close()
+
+def scanevents(f, blocksize=1<<22, begin=0, end=None):
+  """
+  Yields (offset, linenumber, event) for every <event>...</event> block in the file object f,
+  where offset is the byte offset of the <event> tag and linenumber is the line on which the event starts.
+  Only the events whose <event> tag is in the byte range [begin, end) are returned.
+  If begin > 0, the lines before it are never read and linenumber is None.
+  The file is read in blocks of blocksize bytes and each event is sliced out of the
+  buffer in one go, instead of being built up line by line.
+  """
+  if begin: f.seek(begin)
+  buf = ""
+  bufoffset = begin  #file offset of the start of buf
+  linenumber = None if begin else 1  #line number at the start of buf
+  while True:
+    block = f.read(blocksize)
+    buf += block
+    pos = 0
+    while True:
+      start = buf.find("<event>", pos)
+      if start == -1: break
+      stop = buf.find("</event>", start)
+      if stop == -1: break
+      stop = buf.find("\n", stop)
+      if stop == -1:
+        if block: break  #the rest of the line is in the next block
+        stop = len(buf)
+      else:
+        stop += 1
+      if end is not None and bufoffset + start >= end: return
+      if linenumber is not None:
+        linenumber += buf.count("\n", pos, start)
+      yield bufoffset + start, linenumber, buf[start:stop]
+      if linenumber is not None:
+        linenumber += buf.count("\n", start, stop)
+      pos = stop
+    if not block: break
+    #keep the unfinished event, or enough characters to catch an <event> tag split between blocks
+    keep = start if start != -1 else max(pos, len(buf)-len("<event>")+1)
+    if linenumber is not None:
+      linenumber += buf.count("\n", pos, keep)
+    buf = buf[keep:]
+    bufoffset += keep
+    if end is not None and bufoffset >= end: return
+
+def _eventinfoline(event):
+  """the start and end of the event info line, the first line after the <event> tag that isn't a tag or a comment"""
+  pos = 0
+  while True:
+    pos = event.find("\n", pos) + 1
+    if not pos: raise ValueError("No event info line in the event\n\n" + event)
+    stop = event.find("\n", pos)
+    if stop == -1: stop = len(event)
+    line = event[pos:stop]
+    if "<" not in line and ">" not in line and line.split("#")[0].strip():
+      return pos, stop
+
+def eventweight(event):
+  """reads the event weight from the first line after the <event> tag, without parsing the particles"""
+  start, stop = _eventinfoline(event)
+  return float(event[start:stop].split()[2])
+
+def seteventweight(event, weight):
+  """returns the event text with the event weight replaced by weight"""
+  start, stop = _eventinfoline(event)
+  fields = event[start:stop].split()
+  fields[2] = "{:.10e}".format(weight)
+  return event[:start] + " " + " ".join(fields) + event[stop:]
+
+def _attribute(text, pos, name):
+  """returns the start and end of the value of the name='...' or name="..." attribute of the tag that starts at pos, or None"""
+  close = text.find(">", pos)
+  start = pos
+  while True:
+    start = text.find(name+"=", start+1, close)
+    if start == -1: return None
+    if text[start-1].isspace(): break
+  start += len(name)+2
+  return start, text.index(text[start-1], start)
+
+def _idattribute(text, pos):
+  result = _attribute(text, pos, "id")
+  if result is None: raise ValueError("No id in the tag " + text[pos:text.find(">", pos)+1])
+  return result
+
+def iterweights(event):
+  """yields (id, value) for the <wgt id='...'>value</wgt> tags of the event, in the order they appear"""
+  pos = event.find("<wgt")
+  while pos != -1:
+    idstart, idend = _idattribute(event, pos)
+    valuestart = event.find(">", idend) + 1
+    pos = event.find("</wgt>", valuestart)
+    yield event[idstart:idend], float(event[valuestart:pos])
+    pos = event.find("<wgt", pos)
+
+LHEBeam = collections.namedtuple("LHEBeam", "id energy pdfgroup pdfset")
+LHEProcess = collections.namedtuple("LHEProcess", "crosssection error maxweight id")
+LHEWeightGroup = collections.namedtuple("LHEWeightGroup", "name weights")  #weights is a tuple of (id, description)
+
+class LHEHeader(object):
+  """
+  Everything before the first <event> of an LHE file: the text of the header and the <init> block.
+  Only the beginning of the file is read, and each part is parsed the first time it's used.
+  Example usage:
+    header = LHEHeader.read("filename.lhe.gz")
+    print header.crosssection, [group.name for group in header.weightgroups]
+  """
+  def __init__(self, text):
+    self.text = text
+    self._init = self._weightgroups = None
+
+  @classmethod
+  def read(cls, filename, compression=None, blocksize=1<<16):
+    text = ""
+    with openlhefile(filename, compression) as f:
+      while True:
+        block = f.read(blocksize)
+        text += block
+        #search only the new block and the few characters before it that could hold the start of the tag
+        end = text.find("<event>", max(len(text)-len(block)-len("<event>")+1, 0))
+        if end != -1: return cls(text[:end])
+        if not block: return cls(text)
+
+  @property
+  def version(self):
+    pos = self.text.find("<LesHouchesEvents")
+    if pos == -1: return None
+    result = _attribute(self.text, pos, "version")
+    return self.text[slice(*result)] if result is not None else None
+
+  def _parseinit(self):
+    begin = self.text.find("<init>")
+    if begin == -1: return None, None, ()
+    lines = self.text[begin+len("<init>"):self.text.find("</init>", begin)].split("\n")
+    lines = [line.split("#")[0].split() for line in lines if not ("<" in line or ">" in line or not line.split("#")[0].strip())]
+    if not lines: raise ValueError("Empty <init> block")
+    beam1, beam2, energy1, energy2, pdfgroup1, pdfgroup2, pdfset1, pdfset2, weightingstrategy, nprocesses = lines[0]
+    beams = (
+      LHEBeam(int(beam1), float(energy1), int(pdfgroup1), int(pdfset1)),
+      LHEBeam(int(beam2), float(energy2), int(pdfgroup2), int(pdfset2)),
+    )
+    if int(nprocesses) != len(lines)-1:
+      raise ValueError("Wrong number of processes in the <init> block! Should be {}, have {}".format(nprocesses, len(lines)-1))
+    processes = tuple(LHEProcess(float(xsec), float(error), float(maxweight), int(id)) for xsec, error, maxweight, id in lines[1:])
+    return beams, int(weightingstrategy), processes
+
+  @property
+  def beams(self):
+    """the two LHEBeams of the <init> block, or None if there isn't one"""
+    if self._init is None: self._init = self._parseinit()
+    return self._init[0]
+
+  @property
+  def weightingstrategy(self):
+    """IDWTUP"""
+    if self._init is None: self._init = self._parseinit()
+    return self._init[1]
+
+  @property
+  def processes(self):
+    """tuple of LHEProcess, one for each process in the <init> block"""
+    if self._init is None: self._init = self._parseinit()
+    return self._init[2]
+
+  @property
+  def crosssection(self):
+    """total cross section in pb, summed over the processes"""
+    return sum(process.crosssection for process in self.processes)
+
+  @property
+  def crosssectionerror(self):
+    return sum(process.error**2 for process in self.processes) ** 0.5
+
+  def _parseweightgroups(self):
+    begin = self.text.find("<initrwgt>")
+    if begin == -1: return ()
+    end = self.text.find("</initrwgt>", begin)
+    if end == -1: end = len(self.text)
+    groups = []
+    name, weights = None, []
+    previous = begin
+    pos = self.text.find("<weight", begin, end)
+    while pos != -1:
+      #weights after a </weightgroup> tag aren't in a group
+      if self.text.find("</weightgroup>", previous, pos) != -1:
+        if weights: groups.append(LHEWeightGroup(name, tuple(weights)))
+        name, weights = None, []
+      previous = pos
+      if self.text.startswith("<weightgroup", pos):
+        if weights: groups.append(LHEWeightGroup(name, tuple(weights)))
+        #MadGraph writes the name as name= or, in older versions, type=
+        result = _attribute(self.text, pos, "name") or _attribute(self.text, pos, "type")
+        name, weights = (self.text[slice(*result)] if result is not None else None), []
+      elif self.text[pos+len("<weight")].isspace():
+        idstart, idend = _idattribute(self.text, pos)
+        descriptionstart = self.text.find(">", idend) + 1
+        descriptionend = self.text.find("</weight>", descriptionstart)
+        weights.append((self.text[idstart:idend], self.text[descriptionstart:descriptionend].strip()))
+      pos = self.text.find("<weight", pos+1, end)
+    if weights: groups.append(LHEWeightGroup(name, tuple(weights)))
+    return tuple(groups)
+
+  @property
+  def weightgroups(self):
+    """tuple of LHEWeightGroup, in the order of the <initrwgt> block"""
+    if self._weightgroups is None: self._weightgroups = self._parseweightgroups()
+    return self._weightgroups
+
+  @property
+  def weightids(self):
+    return tuple(id for group in self.weightgroups for id, description in group.weights)
+
+  def asdict(self):
+    """the parsed metadata and the text of the header, as json serializable types"""
+    return collections.OrderedDict((
+      ("version", self.version),
+      ("beams", [beam._asdict() for beam in self.beams] if self.beams is not None else None),
+      ("weightingstrategy", self.weightingstrategy),
+      ("processes", [process._asdict() for process in self.processes]),
+      ("crosssection", self.crosssection),
+      ("crosssectionerror", self.crosssectionerror),
+      ("weightgroups", [{"name": group.name, "weights": [list(_) for _ in group.weights]} for group in self.weightgroups]),
+      ("header", self.text),
+    ))
+
+def readweightids(filename, compression=None):
+  """
+  returns the ids of the reweighting points of the file, in the order of the <weight id=...> tags of the <initrwgt> block in the header,
+  or, if the header doesn't have one, in the order of the <wgt> tags of the first event
+  """
+  ids = LHEHeader.read(filename, compression).weightids
+  if ids: return ids
+  with openlhefile(filename, compression) as f:
+    for offset, linenumber, event in scanevents(f):
+      return tuple(id for id, value in iterweights(event))
+  return ()
+
+class WeightParser(object):
+  """
+  Parses the <wgt> tags of each event into the same preallocated array("d"), with one entry per id in ids,
+  so that the weights are in the same columns for every event.  Weights that are missing from an event are nan.
+  Example usage:
+    parser = WeightParser(readweightids("filename.lhe"))
+    for offset, linenumber, event in scanevents(f):
+      values = parser.parse(event)
+  """
+  def __init__(self, ids):
+    self.ids = tuple(ids)
+    self.columns = {id: i for i, id in enumerate(self.ids)}
+    self.values = array("d", [float("nan")]) * len(self.ids)
+    self.__missing = array("d", self.values)
+
+  def parse(self, event):
+    """fills and returns self.values, which is overwritten by the next call"""
+    values, ids, columns, nids = self.values, self.ids, self.columns, len(self.ids)
+    find, startswith = event.find, event.startswith
+    values[:] = self.__missing
+    column = 0
+    pos = find("<wgt")
+    while pos != -1:
+      #only look for the id inside this tag
+      tagend = find(">", pos)
+      idstart = find("id=", pos, tagend)
+      if idstart == -1 or not event[idstart-1].isspace():
+        idstart, idend = _idattribute(event, pos)
+      else:
+        idstart += 4
+        idend = find(event[idstart-1], idstart)
+      #the tags are almost always in the order of the header, so check the next column first without slicing out the id
+      if not (column < nids and startswith(ids[column], idstart) and idend - idstart == len(ids[column])):
+        column = columns.get(event[idstart:idend])
+        if column is None: raise ValueError("Weight {} isn't one of the weight ids of the file".format(event[idstart:idend]))
+      valuestart = tagend + 1
+      pos = find("</wgt>", valuestart)
+      values[column] = float(event[valuestart:pos])
+      column += 1
+      pos = find("<wgt", pos)
+    return values
+
+class LHEIndex(object):
+  """
+  Byte offset, length and weight of each event in an LHE file, built in one pass with scanevents.
+  It's stored next to the LHE file in filename+".idx", together with the size and mtime
+  of the LHE file so that stale indices are rebuilt.
+  Example usage:
+    index = LHEIndex.load("filename.lhe")
+    for begin, end in index.split(10):
+      with LHEFile_Hwithdecay("filename.lhe", begin=begin, end=end) as f:
+        ...
+  """
+  version = 1
+
+  def __init__(self, offsets, lengths, weights):
+    self.offsets, self.lengths, self.weights = offsets, lengths, weights
+
+  def __len__(self):
+    return len(self.offsets)
+
+  @staticmethod
+  def indexfilename(filename):
+    return filename + ".idx"
+
+  @classmethod
+  def build(cls, filename, compression=None, blocksize=1<<22):
+    offsets, lengths, weights = array("l"), array("l"), array("d")
+    with openlhefile(filename, compression) as f:
+      for offset, linenumber, event in scanevents(f, blocksize):
+        offsets.append(offset)
+        lengths.append(len(event))
+        weights.append(eventweight(event))
+    return cls(offsets, lengths, weights)
+
+  @classmethod
+  def _stamp(cls, filename):
+    stat = os.stat(filename)
+    return {"version": cls.version, "size": stat.st_size, "mtime": stat.st_mtime, "itemsize": array("l").itemsize}
+
+  def write(self, filename):
+    """writes the index of the LHE file filename to its sidecar file"""
+    header = self._stamp(filename)
+    header["nevents"] = len(self)
+    with open(self.indexfilename(filename), "wb") as f:
+      f.write(json.dumps(header) + "\n")
+      for _ in self.offsets, self.lengths, self.weights:
+        _.tofile(f)
+
+  @classmethod
+  def read(cls, filename):
+    """reads the sidecar index of the LHE file filename, returns None if it doesn't exist, is stale or is broken"""
+    try:
+      f = open(cls.indexfilename(filename), "rb")
+    except IOError:
+      return None
+    with f:
+      try:
+        header = json.loads(f.readline())
+      except ValueError:
+        return None
+      if not isinstance(header, dict): return None
+      nevents = header.pop("nevents", None)
+      if not isinstance(nevents, (int, long)) or isinstance(nevents, bool) or nevents < 0: return None
+      if header != cls._stamp(filename): return None
+      offsets, lengths, weights = array("l"), array("l"), array("d")
+      try:
+        for _ in offsets, lengths, weights:
+          _.fromfile(f, nevents)
+      except EOFError:
+        return None
+      if f.read(1): return None  #more data than the header says
+    return cls(offsets, lengths, weights)
+
+  @classmethod
+  def load(cls, filename, compression=None, blocksize=1<<22):
+    """reads the sidecar index if it's up to date, otherwise builds it and tries to write it"""
+    result = cls.read(filename)
+    if result is None:
+      result = cls.build(filename, compression=compression, blocksize=blocksize)
+      try:
+        result.write(filename)
+      except (IOError, OSError) as e:
+        print "Couldn't write the index for {}: {}".format(filename, e)
+    return result
+
+  def byterange(self, start, stop):
+    """returns the (begin, end) byte range that contains events start:stop"""
+    start, stop, step = slice(start, stop).indices(len(self))
+    if start >= stop: return (0, 0)
+    return self.offsets[start], self.offsets[stop-1] + self.lengths[stop-1]
+
+  def split(self, n):
+    """splits the file into n byte ranges with the same number of events, up to 1"""
+    bounds = [len(self) * k // n for k in range(n+1)]
+    return [self.byterange(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if start < stop]
 
 class LHEFileBase(object):
   """
@@ -255,62 +1330,225 @@ class LHEFileBase(object):
   """
   __metaclass__ = abc.ABCMeta
 
-  __melas = {}
-
   def __init__(self, filename, *melaargs, **kwargs):
     self.isgen = kwargs.pop("isgen", True)
     reusemela = kwargs.pop("reusemela", False)
-    gzip = kwargs.pop("gzip", False)
+    compression = kwargs.pop("compression", None)
+    if kwargs.pop("gzip", False): compression = "gzip"
+    self.blocksize = kwargs.pop("blocksize", 1<<22)
+    self.begin = kwargs.pop("begin", 0)
+    self.end = kwargs.pop("end", None)
+    self.weightids = kwargs.pop("weightids", None)
+    self.profiler = kwargs.pop("profiler", None) or nullprofiler
+    self.onbadevent = kwargs.pop("onbadevent", None) or failonbadevents
+    self.sampler = kwargs.pop("sampler", None)
     if kwargs: raise ValueError("Unknown kwargs: " + ", ".join(kwargs))
     self.filename = filename
-    if reusemela and melaargs in self.__melas:
-      self.mela = self.__melas[melaargs]
-    else:
-      self.__melas[melaargs] = self.mela = Mela(*melaargs)
+    self.mela = melapool.get(melaargs, reuse=reusemela)
 
-    openfunction = open
-    if gzip: from gzip import GzipFile as openfunction
-    self.f = openfunction(self.filename)
+    self._index = self._header = self.offset = None
+    self._lheevent = self._weightparser = None
+    self.f = openlhefile(self.filename, compression)
+    self.compression = getattr(self.f, "compression", None)
   def __enter__(self, *args, **kwargs):
     self.f.__enter__(*args, **kwargs)
     return self
   def __exit__(self, *args, **kwargs):
     return self.f.__exit__(*args, **kwargs)
 
+  def _scanevents(self):
+    """scanevents on the byte range [begin, end), with only the events that the sampler keeps"""
+    events = scanevents(self.f, self.blocksize, self.begin, self.end)
+    if not self.sampler: return events
+    firstevent = 0
+    if self.begin and (self.sampler.skip or self.sampler.every > 1):
+      firstevent = bisect.bisect_left(self.index.offsets, self.begin)
+    return self.sampler.sample(events, self.filename, self.compression, self.blocksize, firstevent)
+
   def __iter__(self):
-    event = ""
-    for linenumber, line in enumerate(self.f, start=1):
-      if "<event>" not in line and not event:
-        continue
-      event += line
-      if "</event>" in line:
+    events = self._scanevents()
+    read = self.profiler.stage("read")
+    while True:
+      with read:
+        try:
+          offset, linenumber, event = next(events)
+        except StopIteration:
+          return
+      try:
+        self.offset = offset
         try:
           self._setInputEvent(event)
-          yield self
-          event = ""
-        except GeneratorExit:
+        except BadEventHandler.errors as e:
+          if self.onbadevent.handle(self.filename, offset, linenumber, event, e): continue
           raise
+        yield self
+      except GeneratorExit:
+        raise
+      except:
+        _printeventlocation(offset, linenumber)
+        raise
+      finally:
+        try:
+          self.mela.resetInputEvent()
         except:
-          print "On line", linenumber
-          raise
-        finally:
-          try:
-            self.mela.resetInputEvent()
-          except:
-            pass
+          pass
+
+  @property
+  def index(self):
+    """the LHEIndex of the file, built or read from the sidecar on first use"""
+    if self._index is None:
+      self._index = LHEIndex.load(self.filename, compression=self.compression, blocksize=self.blocksize)
+    return self._index
+
+  @property
+  def header(self):
+    """the LHEHeader of the file, read the first time it's used without moving the position in the events"""
+    if self._header is None:
+      self._header = LHEHeader.read(self.filename, compression=self.compression)
+    return self._header
+
+  def __len__(self):
+    return len(self.index)
+
+  def __getitem__(self, item):
+    """
+    f[k] sets the input event to event k of the file and returns the mela object, like iterating does.
+    f[i:j:k] returns an iterator over those events.
+    Both seek in the file, so don't use them while iterating through it.
+    """
+    if isinstance(item, slice):
+      return self._iterindices(xrange(*item.indices(len(self))))
+    if item < 0: item += len(self)
+    if not 0 <= item < len(self): raise IndexError("Event {} is out of range, there are {} events".format(item, len(self)))
+    try:
+      self.mela.resetInputEvent()
+    except:
+      pass
+    self.f.seek(self.index.offsets[item])
+    self.offset = self.index.offsets[item]
+    self._setInputEvent(self.f.read(self.index.lengths[item]))
+    return self
+
+  def _iterindices(self, indices):
+    for i in indices:
+      try:
+        yield self[i]
+      finally:
+        try:
+          self.mela.resetInputEvent()
+        except:
+          pass
+
+  def iterchunks(self, chunksize=1000):
+    """
+    Yields (c, events) for each chunk of up to chunksize events in the byte range [begin, end):
+    the LHEColumns of the chunk, parsed in bulk, and the (offset, linenumber, event) of each event.
+    Nothing is passed to mela, call setchunkevent for the events that need it.
+    Bad events are left out of the chunk or raise, depending on onbadevent.
+    """
+    events = self._scanevents()
+    read, parse = self.profiler.stage("read"), self.profiler.stage("parse")
+    while True:
+      with read:
+        chunk = list(itertools.islice(events, chunksize))
+      if not chunk: return
+      with parse:
+        c, chunk = parsechunk(chunk, self.lheeventclass, self.isgen, self.onbadevent, self.filename)
+      if chunk: yield c, chunk
+
+  def setchunkevent(self, c, events, i, mela=True):
+    """
+    makes event i of a chunk from iterchunks the current event (for the weights),
+    and if mela is true, sets the mela input event from the columns
+    """
+    try:
+      self.mela.resetInputEvent()
+    except:
+      pass
+    self.offset = events[i][0]
+    lheevent = LHEColumnEvent(c, i, events[i][2], self.isgen)
+    if mela:
+      with self.profiler.stage("parse"):
+        lheevent.inputevent
+    self._setLHEEvent(lheevent, mela)
+    return self
 
   def _setInputEvent(self, event):
-    lheevent = self.lheeventclass(event, self.isgen)
+    with self.profiler.stage("parse"):
+      lheevent = self.lheeventclass(event, self.isgen)
+    self._setLHEEvent(lheevent)
+
+  def _setLHEEvent(self, lheevent, mela=True):
+    self.weight = lheevent.weight
+    self._lheevent = lheevent
+    if not mela:
+      self.daughters = self.associated = self.mothers = None
+      return
     self.daughters = lheevent.daughters
     self.associated = lheevent.associated
     self.mothers = lheevent.mothers
-    self.weight = lheevent.weight
-    self.weights = lheevent.weights
-    self.setInputEvent(*lheevent)
+    with self.profiler.stage("setInputEvent"):
+      self.setInputEvent(*lheevent)
+
+  @property
+  def weights(self):
+    """dict of the reweighting weights of the current event, id: value"""
+    return self._lheevent.weights
+
+  @property
+  def weightarray(self):
+    """
+    the reweighting weights of the current event as an array("d") in the order of weightids
+    (by default read from the header of the file), with nan for the ones missing from the event.
+    The same array is reused for every event, so copy it if you need to keep it.
+    """
+    if self._weightparser is None:
+      if self.weightids is None:
+        self.weightids = self.header.weightids or readweightids(self.filename, self.compression)
+      self._weightparser = WeightParser(self.weightids)
+    return self._weightparser.parse(self._lheevent.event)
+
+  @classmethod
+  def itercolumns(cls, filename, chunksize=100000, isgen=True, compression=None, blocksize=1<<22, onbadevent=None, sampler=None):
+    """
+    Kinematics-only reader: yields LHEColumns for each chunk of up to chunksize events,
+    without creating a Mela object or any per-particle python objects.
+    Bad events are left out or raise, depending on onbadevent (a BadEventHandler, by default they raise),
+    and if sampler (an EventSampler) is given, only the events it keeps are read.
+    Example usage:
+      for c in LHEFile_Hwithdecay.itercolumns("filename.lhe"):
+        daughters = c.role == DAUGHTER
+        pxH = numpy.bincount(c.event[daughters], weights=c.px[daughters], minlength=len(c.weight))
+    """
+    with openlhefile(filename, compression) as f:
+      events = []
+      scanned = scanevents(f, blocksize)
+      if sampler: scanned = sampler.sample(scanned, filename, compression, blocksize)
+      for event in scanned:
+        events.append(event)
+        if len(events) == chunksize:
+          yield parsechunk(events, cls.lheeventclass, isgen, onbadevent, filename)[0]
+          events = []
+      if events:
+        yield parsechunk(events, cls.lheeventclass, isgen, onbadevent, filename)[0]
+
+  @classmethod
+  def readcolumns(cls, filename, **kwargs):
+    """reads the whole file with itercolumns and concatenates the chunks"""
+    chunks = list(cls.itercolumns(filename, **kwargs))
+    if not chunks: return parsecolumns([], cls.lheeventclass)
+    if len(chunks) == 1: return chunks[0]
+    nevents = numpy.cumsum([0] + [len(c.weight) for c in chunks])
+    nparticles = numpy.cumsum([0] + [len(c.id) for c in chunks])
+    return LHEColumns(
+      event=numpy.concatenate([c.event + n for c, n in zip(chunks, nevents)]),
+      eventoffset=numpy.concatenate([chunks[0].eventoffset[:1]] + [c.eventoffset[1:] + n for c, n in zip(chunks, nparticles)]),
+      **{field: numpy.concatenate([getattr(c, field) for c in chunks]) for field in LHEColumns._fields if field not in ("event", "eventoffset")}
+    )
 
   @classmethod
   def _LHEclassattributes(cls):
-    return "filename", "f", "mela", "isgen", "daughters", "mothers", "associated", "weight", "weights"
+    return "filename", "f", "mela", "isgen", "compression", "blocksize", "begin", "end", "_index", "_header", "daughters", "mothers", "associated", "weight", "weightids", "_lheevent", "_weightparser", "profiler", "offset", "onbadevent", "sampler"
 
   def __getattr__(self, attr):
     if attr == "mela": raise RuntimeError("Something is wrong, trying to access mela before it's created")
@@ -339,7 +1577,20 @@ class LHEFile_VHHiggsdecay(LHEFileBase):
   lheeventclass = LHEEvent_VHHiggsdecay
   
 if __name__ == '__main__':
+  from benchmark import writesyntheticfile
+
   class TestLHEFiles(unittest.TestCase):
+    def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+    def syntheticfile(self, topology, nevents, **kwargs):
+      filename = os.path.join(self.tmpdir, topology+".lhe")
+      writesyntheticfile(filename, topology, nevents, **kwargs)
+      return filename
+
     @unittest.skipUnless(args.lhefile_hwithdecay, "needs --lhefile-hwithdecay argument")
     def testHwithDecay(self):
       with LHEFile_Hwithdecay(args.lhefile_hwithdecay) as f:
@@ -350,6 +1601,352 @@ if __name__ == '__main__':
           self.assertNotEqual(prob, 0)
           print prob, event.computeDecayAngles()
 
+    def testScanEventsBlockBoundaries(self):
+      filename = self.syntheticfile("h4l", 50)
+      with open(filename) as f:
+        data = f.read()
+        f.seek(0)
+        expected = list(scanevents(f))
+      self.assertEqual(len(expected), 50)
+      for offset, linenumber, event in expected:
+        self.assertTrue(event.startswith("<event>") and event.endswith("</event>\n"))
+        self.assertEqual(data[offset:offset+len(event)], event)
+        self.assertEqual(linenumber, data.count("\n", 0, offset) + 1)
+      #the tags are split between blocks for the small block sizes
+      blocksizes = 1, 3, 7, 8, 100, 4096
+      for blocksize in blocksizes:
+        with open(filename) as f:
+          self.assertEqual(list(scanevents(f, blocksize)), expected)
+      #splitting the file into byte ranges gives every event exactly once
+      size = len(data)
+      ranges = [(begin, begin+size//5+1) for begin in range(0, size, size//5+1)]
+      for blocksize in blocksizes:
+        found = []
+        for begin, end in ranges:
+          with open(filename) as f:
+            found += [(offset, event) for offset, linenumber, event in scanevents(f, blocksize, begin, end)]
+        self.assertEqual(found, [(offset, event) for offset, linenumber, event in expected])
+      #an event without </event> at the end of the file is left out,
+      #and the last event doesn't need a newline after </event>
+      for text, events in (
+        (data.replace("</LesHouchesEvents>\n", expected[0][2][:-20]), expected),
+        (data[:expected[-1][0]+len(expected[-1][2])-1], expected[:-1] + [expected[-1][:2] + (expected[-1][2][:-1],)]),
+      ):
+        with open(filename, "w") as f:
+          f.write(text)
+        for blocksize in blocksizes:
+          with open(filename) as f:
+            self.assertEqual(list(scanevents(f, blocksize)), events)
+
+    @unittest.skipIf(numpy is None, "needs numpy")
+    def testColumnsMatchLHEEvent(self):
+      filename = self.syntheticfile("h4l", 300)
+      for isgen in True, False:
+        c = LHEFile_Hwithdecay.readcolumns(filename, isgen=isgen, chunksize=100)
+        with open(filename) as f:
+          for i, (offset, linenumber, event) in enumerate(scanevents(f)):
+            lheevent = LHEEvent_Hwithdecay(event, isgen)
+            particles = slice(c.eventoffset[i], c.eventoffset[i+1])
+            for role, collection in (DAUGHTER, lheevent.daughters), (ASSOCIATED, lheevent.associated), (MOTHER, lheevent.mothers):
+              mask = c.role[particles] == role
+              self.assertEqual(list(c.id[particles][mask]), [p.first for p in collection or []])
+              for px, p in zip(c.px[particles][mask], collection or []):
+                self.assertAlmostEqual(px, p.second.Px(), places=4)
+            self.assertEqual(c.weight[i], lheevent.weight)
+        self.assertEqual(i+1, 300)
+
+    @unittest.skipIf(numpy is None, "needs numpy")
+    def testColumnsExtraColumns(self):
+      filename = self.syntheticfile("h4l", 20)
+      with open(filename) as f:
+        events = [event for offset, linenumber, event in scanevents(f)]
+      expected = parsecolumns(events, LHEEvent_Hwithdecay)
+      #columns after the 13th are ignored, like in the per-line parser
+      extra = ["\n".join(line + " 1.5 -2" if len(line.split()) == 13 else line for line in event.split("\n")) for event in events]
+      self.assertNotEqual(extra, events)
+      found = parsecolumns(extra, LHEEvent_Hwithdecay)
+      for field in LHEColumns._fields:
+        self.assertEqual(getattr(found, field).tolist(), getattr(expected, field).tolist())
+      self.assertEqual(LHEEvent_Hwithdecay(extra[0], True).weight, expected.weight[0])
+      #but a line with fewer columns is an error
+      short = events[0].replace(" 9.\n", "\n", 1)
+      self.assertNotEqual(short, events[0])
+      self.assertRaises(ValueError, parsecolumns, [short], LHEEvent_Hwithdecay)
+
+    def testChunkEventsMatchIteration(self):
+      def particles(collection):
+        return [(p.first, p.second.Px(), p.second.Py(), p.second.Pz(), p.second.E()) for p in collection or []]
+      for lhefileclass, topology in (LHEFile_Hwithdecay, "h4l"), (LHEFile_JHUGenVBFVH, "vbf"), (LHEFile_VHHiggsdecay, "vhdecay"):
+        filename = self.syntheticfile(topology, 60)
+        for isgen in True, False:
+          with lhefileclass(filename, reusemela=True, isgen=isgen) as f:
+            expected = [(particles(e.daughters), particles(e.associated), particles(e.mothers), e.weight) for e in f]
+          self.assertEqual(len(expected), 60)
+          with lhefileclass(filename, reusemela=True, isgen=isgen) as f:
+            found = []
+            for c, events in f.iterchunks(7):
+              for i in range(len(events)):
+                e = f.setchunkevent(c, events, i)
+                found.append((particles(e.daughters), particles(e.associated), particles(e.mothers), e.weight))
+          self.assertEqual(found, expected)
+
+    def testSampling(self):
+      #the synthetic events all have weight 1, so give them different weights, some of them negative
+      rng = random.Random(3)
+      with open(self.syntheticfile("mg", 400, nweights=3)) as f:
+        events = [seteventweight(event, rng.uniform(-1, 3)) for offset, linenumber, event in scanevents(f)]
+      filename = os.path.join(self.tmpdir, "test.lhe")
+      with open(filename, "w") as f:
+        f.write("<LesHouchesEvents>\n" + "".join(events) + "</LesHouchesEvents>\n")
+      with open(filename) as f:
+        events = list(scanevents(f))
+      offsets = [offset for offset, linenumber, event in events]
+      sampled = lambda sampler, events=events: [offset for offset, linenumber, event in sampler.sample(iter(events), filename)]
+      self.assertEqual(sampled(EventSampler(skip=3, every=4, maxevents=10)), offsets[3::4][:10])
+      self.assertEqual(sampled(EventSampler(skip=390)), offsets[390:])
+      self.assertEqual(sampled(EventSampler(maxevents=0)), [])
+      #the fraction is the same for the same seed, and the same for a byte range of the file as for the whole file
+      fraction = sampled(EventSampler(fraction=0.3, seed=5))
+      self.assertEqual(fraction, sampled(EventSampler(fraction=0.3, seed=5)))
+      self.assertNotEqual(fraction, sampled(EventSampler(fraction=0.3, seed=6)))
+      self.assertTrue(0.2*len(offsets) < len(fraction) < 0.4*len(offsets))
+      index = LHEIndex.load(filename)
+      found = []
+      for begin, end in index.split(3):
+        with LHEFile_Hwithdecay(filename, reusemela=True, begin=begin, end=end, sampler=EventSampler(fraction=0.3, seed=5, skip=1, every=2)) as f:
+          found += [_.offset for _ in f]
+      self.assertEqual(found, [offset for offset in fraction if offsets.index(offset) % 2 == 1])
+      #unweighting keeps the events with probability |w| / wmax, with their weight set to +-wmax
+      weights = [eventweight(event) for offset, linenumber, event in events]
+      wmax = max(abs(w) for w in weights)
+      sampler = EventSampler(unweight=True, seed=1)
+      unweighted = list(sampler.sample(iter(events), filename))
+      self.assertEqual((sampler.nread, sampler.nsampled), (len(events), len(unweighted)))
+      self.assertTrue(0 < len(unweighted) < len(events))
+      for offset, linenumber, event in unweighted:
+        self.assertAlmostEqual(eventweight(event), math.copysign(wmax, weights[offsets.index(offset)]), delta=wmax*1e-9)
+      self.assertEqual(len(unweighted), len(sampled(EventSampler(unweight=True, maxweight=wmax, seed=1))))
+      #a larger maxweight keeps fewer events
+      self.assertLess(len(sampled(EventSampler(unweight=True, maxweight=2*wmax, seed=1))), len(unweighted))
+      #or unweighting with one of the reweighting weights
+      weights = [dict(iterweights(event))["rwgt_2"] for offset, linenumber, event in events]
+      wmax = max(abs(w) for w in weights)
+      unweighted = list(EventSampler(unweightid="rwgt_2", seed=1).sample(iter(events), filename))
+      self.assertTrue(0 < len(unweighted) < len(events))
+      for offset, linenumber, event in unweighted:
+        self.assertAlmostEqual(eventweight(event), math.copysign(wmax, weights[offsets.index(offset)]), delta=wmax*1e-9)
+
+    def testIndex(self):
+      def particles(collection):
+        return [(p.first, p.second.Px(), p.second.Py(), p.second.Pz(), p.second.E()) for p in collection or []]
+      def readevents(filename):
+        with open(filename) as f:
+          return list(scanevents(f))
+      def daughters(events):
+        return [particles(LHEEvent_Hwithdecay(event, True).daughters) for offset, linenumber, event in events]
+
+      filename = self.syntheticfile("h4l", 100)
+      events = readevents(filename)
+      index = LHEIndex.load(filename)
+      self.assertTrue(os.path.exists(LHEIndex.indexfilename(filename)))
+      self.assertEqual(list(index.offsets), [offset for offset, linenumber, event in events])
+      self.assertEqual(list(index.lengths), [len(event) for offset, linenumber, event in events])
+      self.assertEqual(list(index.weights), [LHEEvent_Hwithdecay(event, True).weight for offset, linenumber, event in events])
+      reread = LHEIndex.read(filename)
+      self.assertEqual((reread.offsets, reread.lengths, reread.weights), (index.offsets, index.lengths, index.weights))
+
+      #random access with the index
+      expected = daughters(events)
+      with LHEFile_Hwithdecay(filename, reusemela=True) as f:
+        self.assertEqual(len(f), 100)
+        for i in 0, 57, 99, -1, -100, 3:
+          self.assertEqual(particles(f[i].daughters), expected[i])
+          self.assertEqual(f.offset, events[i][0])
+        self.assertEqual([particles(e.daughters) for e in f[2:40:7]], expected[2:40:7])
+        self.assertEqual([particles(e.daughters) for e in f[-3:]], expected[-3:])
+        self.assertEqual(list(f[50:10]), [])
+        self.assertRaises(IndexError, f.__getitem__, 100)
+        self.assertRaises(IndexError, f.__getitem__, -101)
+
+      #the ranges from split contain all the events once
+      found = []
+      for begin, end in index.split(7):
+        with open(filename) as f:
+          found += [event for offset, linenumber, event in scanevents(f, begin=begin, end=end)]
+      self.assertEqual(found, [event for offset, linenumber, event in events])
+
+      #the index is stale once the file is rewritten, even with the same size, and then it's rebuilt
+      size, mtime = os.path.getsize(filename), os.path.getmtime(filename)
+      writesyntheticfile(filename, "h4l", 100, seed=2)
+      os.utime(filename, (mtime + 10, mtime + 10))  #in case the file system's timestamps are coarse
+      self.assertEqual(os.path.getsize(filename), size)
+      self.assertIsNone(LHEIndex.read(filename))
+      newevents = readevents(filename)
+      self.assertNotEqual(daughters(newevents), expected)
+      with LHEFile_Hwithdecay(filename, reusemela=True) as f:
+        self.assertEqual(len(f), 100)
+        self.assertEqual(list(f.index.offsets), [offset for offset, linenumber, event in newevents])
+        self.assertEqual(particles(f[57].daughters), daughters(newevents)[57])
+      self.assertEqual(list(LHEIndex.read(filename).offsets), [offset for offset, linenumber, event in newevents])
+
+      #and once the file changes size
+      with open(filename, "a") as f:
+        f.write("\n")
+      self.assertIsNone(LHEIndex.read(filename))
+
+      #a broken sidecar is rebuilt as well
+      index = LHEIndex.load(filename)
+      indexfilename = LHEIndex.indexfilename(filename)
+      with open(indexfilename, "rb") as f:
+        header, data = json.loads(f.readline()), f.read()
+      def writeindex(header, data):
+        with open(indexfilename, "wb") as f:
+          f.write(json.dumps(header) + "\n" + data)
+      for brokenheader, brokendata in (
+        ({key: value for key, value in header.iteritems() if key != "nevents"}, data),
+        (dict(header, nevents="100"), data),
+        (dict(header, nevents=-1), data),
+        (dict(header, nevents=None), data),
+        (header, data[:-1]),
+        (header, data[:len(data)//2]),
+        (header, data + "\0"),
+        ([header], data),
+      ):
+        writeindex(brokenheader, brokendata)
+        self.assertIsNone(LHEIndex.read(filename))
+        with LHEFile_Hwithdecay(filename, reusemela=True) as f:
+          self.assertEqual(len(f), 100)
+          self.assertEqual(list(f.index.offsets), list(index.offsets))
+        self.assertEqual(list(LHEIndex.read(filename).offsets), list(index.offsets))
+      with open(indexfilename, "wb") as f:
+        f.write("not json\n")
+      self.assertIsNone(LHEIndex.read(filename))
+
+    def testCompressedInput(self):
+      import bz2, gzip
+      filename = self.syntheticfile("h4l", 300)
+      with open(filename) as f:
+        data = f.read()
+        f.seek(0)
+        events = list(scanevents(f))
+      def bgzf(data):
+        """BGZF members of at most 60000 uncompressed bytes, and the empty member at the end like bgzip"""
+        members = []
+        for start in range(0, len(data), 60000) + [len(data)]:
+          block = data[start:start+60000]
+          compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+          body = compressor.compress(block) + compressor.flush()
+          header = "\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\x00BC\x02\x00" + struct.pack("<H", 18 + len(body) + 8 - 1)
+          members.append(header + body + struct.pack("<II", zlib.crc32(block) & 0xffffffff, len(block)))
+        return "".join(members)
+      self.assertTrue(_isbgzfheader(bgzf(data)[:18]))
+      compressors = [
+        ("gzip", None),  #written with GzipFile below
+        ("bgzf", None),
+        ("bz2", bz2.compress),
+      ]
+      #lzma is only in the standard library from python 3.3, and zstandard is never
+      try:
+        compressors.append(("xz", _lzma().compress))
+      except ImportError:
+        print "skipping the xz file, there's no lzma module"
+      try:
+        compressors.append(("zstd", _zstandard().ZstdCompressor().compress))
+      except ImportError:
+        print "skipping the zstd file, there's no zstandard module"
+      self.assertEqual(detectcompression(filename), None)
+      for compression, compress in compressors:
+        compressedfilename = os.path.join(self.tmpdir, "test.lhe."+compression)
+        with open(compressedfilename, "wb") as f:
+          if compression == "bgzf":
+            f.write(bgzf(data))
+          #several members/streams/frames, which are concatenated
+          else:
+            for start in range(0, len(data), len(data)//3+1):
+              if compression == "gzip":
+                with gzip.GzipFile(fileobj=f, mode="wb") as g:
+                  g.write(data[start:start+len(data)//3+1])
+              else:
+                f.write(compress(data[start:start+len(data)//3+1]))
+        self.assertEqual(detectcompression(compressedfilename), "gzip" if compression == "bgzf" else compression)
+        if compression == "bgzf":
+          with open(compressedfilename, "rb") as f:
+            self.assertEqual(len(list(_bgzfmembers(f))), len(data)//60000 + 2)
+        for threads in 1, 4:
+          with openlhefile(compressedfilename, threads=threads) as f:
+            self.assertEqual(list(scanevents(f, blocksize=1<<16)), events)
+            f.seek(events[3][0])
+            self.assertEqual(f.read(len(events[3][2])), events[3][2])
+            #seeking backward starts again from the beginning
+            f.seek(events[1][0])
+            self.assertEqual(f.read(len(events[1][2])), events[1][2])
+        with LHEFile_Hwithdecay(compressedfilename) as f:
+          self.assertEqual(len(f), len(events))
+          self.assertEqual(f[-1].weight, LHEEvent_Hwithdecay(events[-1][2], True).weight)
+
+    def testBadEvents(self):
+      with open(self.syntheticfile("h4l", 20)) as f:
+        events = [event for offset, linenumber, event in scanevents(f)]
+      #drop the last particle of event 3, so the number of particles is wrong
+      lines = events[3].split("\n")
+      del lines[max(i for i, line in enumerate(lines) if len(line.split()) == 13)]
+      events[3] = "\n".join(lines)
+      filename, quarantinefile = os.path.join(self.tmpdir, "test.lhe"), os.path.join(self.tmpdir, "quarantine.lhe")
+      with open(filename, "w") as f:
+        f.write("<LesHouchesEvents>\n" + "".join(events) + "</LesHouchesEvents>\n")
+      with LHEFile_Hwithdecay(filename, reusemela=True) as f:
+        self.assertRaises(ValueError, list, f)
+      with LHEFile_Hwithdecay(filename, reusemela=True) as f:
+        self.assertRaises(ValueError, list, f.iterchunks(7))
+
+      badevents = BadEventHandler("quarantine", quarantinefile)
+      with LHEFile_Hwithdecay(filename, reusemela=True, onbadevent=badevents) as f:
+        self.assertEqual([e.offset for e in f], [len("<LesHouchesEvents>\n") + len("".join(events[:i])) for i in range(20) if i != 3])
+      with LHEFile_Hwithdecay(filename, reusemela=True, onbadevent=badevents) as f:
+        self.assertEqual(sum(len(chunk) for c, chunk in f.iterchunks(7)), 19)
+      badevents.close()
+      self.assertEqual(badevents.counts.values(), [2])
+      with open(quarantinefile) as f:
+        quarantined = [event for offset, linenumber, event in scanevents(f)]
+      self.assertEqual(quarantined, [events[3]]*2)
+
+      badevents = BadEventHandler("skip")
+      with LHEFile_Hwithdecay(filename, reusemela=True, onbadevent=badevents) as f:
+        self.assertEqual(len(list(f)), 19)
+      self.assertEqual(badevents.nbad, 1)
+
+    def testWeights(self):
+      header = """<LesHouchesEvents version="3.0">\n<header>\n<initrwgt>\n<weightgroup name='mg_reweighting'>\n<weight id="rwgt_1">a</weight>\n<weight id='rwgt_2'>b</weight>\n<weight id="rwgt_10">c</weight>\n</weightgroup>\n</initrwgt>\n</header>\n"""
+      event = """<event>\n 0 1 1.0 125.0 0.0078 0.11\n<rwgt>\n<wgt id='rwgt_1'>3.05900e-02</wgt>\n<wgt id="rwgt_10"> -1.5e+01 </wgt>\n</rwgt>\n</event>\n"""
+      self.assertEqual(list(iterweights(event)), [("rwgt_1", 0.0305900), ("rwgt_10", -15)])
+      filename = os.path.join(self.tmpdir, "test.lhe")
+      with open(filename, "w") as f:
+        f.write(header + event + "</LesHouchesEvents>\n")
+      self.assertEqual(readweightids(filename), ("rwgt_1", "rwgt_2", "rwgt_10"))
+      with open(filename, "w") as f:
+        f.write(event)
+      self.assertEqual(readweightids(filename), ("rwgt_1", "rwgt_10"))
+      header = LHEHeader(header + "<init>\n2212 2212 6.5e3 6.5e3 0 0 247000 247000 -4 2\n<generator name='MG5'>2.6</generator>\n1.2e1 3e-2 1.0 1\n4 4e-2 1.0 2 # comment\n</init>\n")
+      self.assertEqual(header.version, "3.0")
+      self.assertEqual(header.beams, (LHEBeam(2212, 6500, 0, 247000),)*2)
+      self.assertEqual(header.weightingstrategy, -4)
+      self.assertEqual(header.processes, (LHEProcess(12, 0.03, 1, 1), LHEProcess(4, 0.04, 1, 2)))
+      self.assertEqual((header.crosssection, header.crosssectionerror), (16, 0.05))
+      self.assertEqual(header.weightgroups, (LHEWeightGroup("mg_reweighting", (("rwgt_1", "a"), ("rwgt_2", "b"), ("rwgt_10", "c"))),))
+      json.dumps(header.asdict())
+      parser = WeightParser(("rwgt_1", "rwgt_2", "rwgt_10"))
+      values = parser.parse(event)
+      self.assertEqual((values[0], values[2]), (0.0305900, -15))
+      self.assertNotEqual(values[1], values[1])  #nan
+      self.assertIs(parser.parse(event.replace("rwgt_10", "rwgt_2")), values)
+      self.assertEqual(values[1], -15)
+      self.assertNotEqual(values[2], values[2])
+      self.assertRaises(ValueError, parser.parse, event.replace("rwgt_10", "rwgt_3"))
+      #the id has to be in the tag itself, not in the next one or in another attribute
+      self.assertRaises(ValueError, parser.parse, event.replace("<wgt id='rwgt_1'>", "<wgt>"))
+      values = parser.parse(event.replace("<wgt id='rwgt_1'>", "<wgt pid='rwgt_10' id='rwgt_1'>"))
+      self.assertEqual((values[0], values[2]), (0.0305900, -15))
+
     @unittest.skipUnless(args.lhefile_jhugenvbfvh, "needs --lhefile-jhugenvbfvh argument")
     def testJHUGenVBFVH(self):
       with LHEFile_JHUGenVBFVH(args.lhefile_jhugenvbfvh, isgen=False) as f:
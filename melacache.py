@@ -0,0 +1,302 @@
+import hashlib
+import os
+import sqlite3
+
+def computeprobability(event, function, hypothesis, matrixelement, process, couplings):
+  """
+  sets the process and couplings and calls event.function (computeP or computeProdP).
+  everytime you call a compute Prob function all the couplings are reset, so they are set again every time.
+  """
+  event.setProcess(hypothesis, matrixelement, process)
+  for coupling, value in couplings.iteritems():
+    setattr(event, coupling, value)
+  return getattr(event, function)()
+
+#substrings of the names of the shared libraries that mela loads: libmela/libJHUGenMELAMELA, libjhugenmela, libmcfm_*, libcollier
+melalibrarykeywords = ("mela", "jhugen", "mcfm", "collier")
+
+def _ismelalibrary(filename):
+  name = os.path.basename(filename).lower()
+  return (".so" in name or name.endswith(".dylib")) and any(keyword in name for keyword in melalibrarykeywords)
+
+def melalibraries(maps="/proc/self/maps"):
+  """
+  the shared libraries of mela: the ones that are loaded in this process (from maps, on linux)
+  and the ones in the directory of the mela module
+  """
+  import mela
+  libraries = []
+  try:
+    with open(maps) as f:
+      for line in f:
+        fields = line.split(None, 5)
+        if len(fields) == 6 and _ismelalibrary(fields[5].strip()): libraries.append(fields[5].strip())
+  except IOError:
+    pass
+  directory = os.path.dirname(os.path.realpath(mela.__file__))
+  libraries += [os.path.join(directory, _) for _ in os.listdir(directory) if _ismelalibrary(_)]
+  return sorted({os.path.realpath(_) for _ in libraries if os.path.isfile(_)})
+
+def melaversion():
+  """
+  identifies the mela installation by the location, size and mtime of the mela module and of its shared libraries,
+  which change when mela's C++ or fortran code is rebuilt even if the python module doesn't
+  """
+  import mela
+  stamps = []
+  for filename in [os.path.realpath(mela.__file__)] + melalibraries():
+    stat = os.stat(filename)
+    stamps.append("{} {} {}".format(filename, stat.st_size, stat.st_mtime))
+  return "; ".join(stamps)
+
+class MelaCache(object):
+  """
+  On-disk cache of MELA probabilities, keyed by a hash of the event's particles, the compute function,
+  the (hypothesis, matrix element, process) triple and the couplings.
+  It keeps at most maxentries results, evicting the least recently used ones,
+  and clears itself when the mela version changes.
+  Example usage:
+    cache = MelaCache("mela.cache")
+    for event in f:
+      eventkey = cache.eventkey(event)
+      p0plus = cache.compute(event, eventkey, "computeP", TVar.HSMHiggs, TVar.JHUGen, TVar.ZZINDEPENDENT, {})
+    cache.close()
+    cache.report()
+  """
+  def __init__(self, filename, maxentries=10000000, version=None, commitevery=10000):
+    if version is None: version = melaversion()
+    self.filename = filename
+    self.maxentries = maxentries
+    self.commitevery = commitevery
+    self.hits = self.misses = self.evicted = 0
+    self.invalidated = False
+    self.__pending = {}
+    self.__used = set()
+    self.connection = sqlite3.connect(filename, timeout=600)
+    with self.connection:
+      self.connection.execute("CREATE TABLE IF NOT EXISTS probabilities (key TEXT PRIMARY KEY, value REAL, lastused INTEGER)")
+      self.connection.execute("CREATE INDEX IF NOT EXISTS lastused ON probabilities (lastused)")
+      self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+      stored = self.connection.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+      if stored is None or stored[0] != version:
+        if stored is not None:
+          self.invalidated = True
+          self.connection.execute("DELETE FROM probabilities")
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+      generation = self.connection.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()
+      self.generation = int(generation[0])+1 if generation is not None else 1
+      self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (str(self.generation),))
+
+  @staticmethod
+  def eventkey(event):
+    """hash of the ids and momenta of the daughters, associated particles and mothers"""
+    h = hashlib.sha1()
+    for particles in event.daughters, event.associated, event.mothers:
+      if particles is None:
+        h.update("None;")
+        continue
+      for p in particles:
+        h.update("{} {!r} {!r} {!r} {!r},".format(p.first, p.second.Px(), p.second.Py(), p.second.Pz(), p.second.E()))
+      h.update(";")
+    return h.hexdigest()
+
+  @staticmethod
+  def key(eventkey, function, hypothesis, matrixelement, process, couplings):
+    return hashlib.sha1("{} {} {!r} {!r} {!r} {!r}".format(eventkey, function, hypothesis, matrixelement, process, sorted(couplings.iteritems()))).hexdigest()
+
+  def get(self, key):
+    if key in self.__pending: return self.__pending[key]
+    result = self.connection.execute("SELECT value FROM probabilities WHERE key = ?", (key,)).fetchone()
+    if result is None: return None
+    self.__used.add(key)
+    return result[0]
+
+  def put(self, key, value):
+    self.__pending[key] = value
+    if len(self.__pending) + len(self.__used) >= self.commitevery:
+      self.flush()
+
+  def compute(self, event, eventkey, function, hypothesis, matrixelement, process, couplings, compute=None):
+    """
+    returns the cached probability, or computes and stores it,
+    with compute() if it's given (e.g. MelaState.compute) or else with computeprobability
+    """
+    key = self.key(eventkey, function, hypothesis, matrixelement, process, couplings)
+    result = self.get(key)
+    if result is not None:
+      self.hits += 1
+      return result
+    self.misses += 1
+    if compute is None:
+      result = computeprobability(event, function, hypothesis, matrixelement, process, couplings)
+    else:
+      result = compute()
+    self.put(key, result)
+    return result
+
+  def flush(self):
+    with self.connection:
+      self.connection.executemany("INSERT OR REPLACE INTO probabilities VALUES (?, ?, ?)", ((key, value, self.generation) for key, value in self.__pending.iteritems()))
+      self.connection.executemany("UPDATE probabilities SET lastused = ? WHERE key = ?", ((self.generation, key) for key in self.__used))
+    self.__pending.clear()
+    self.__used.clear()
+    self.evict()
+
+  def evict(self):
+    """deletes the least recently used entries beyond maxentries"""
+    with self.connection:
+      nentries = self.connection.execute("SELECT COUNT(*) FROM probabilities").fetchone()[0]
+      if nentries > self.maxentries:
+        self.connection.execute("DELETE FROM probabilities WHERE key IN (SELECT key FROM probabilities ORDER BY lastused LIMIT ?)", (nentries - self.maxentries,))
+        self.evicted += nentries - self.maxentries
+
+  def close(self):
+    self.flush()
+    self.connection.close()
+
+  @property
+  def stats(self):
+    return {"hits": self.hits, "misses": self.misses, "evicted": self.evicted, "invalidated": self.invalidated}
+
+  def report(self):
+    printreport(self.filename, self.stats)
+
+def printreport(filename, stats):
+  """prints the hit/miss summary, stats can be summed over several MelaCache objects"""
+  total = stats["hits"] + stats["misses"]
+  print "MELA cache {}: {} hits, {} misses ({:.1%} hit rate), {} evicted{}".format(
+    filename, stats["hits"], stats["misses"], float(stats["hits"]) / total if total else 0, stats["evicted"],
+    ", cleared because the mela version changed" if stats["invalidated"] else "",
+  )
+
+if __name__ == "__main__":
+  import shutil
+  import sys
+  import tempfile
+  import unittest
+  import stubmela
+  stubmela.install()
+
+  class TestMelaCache(unittest.TestCase):
+    def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+      self.filename = os.path.join(self.tmpdir, "mela.cache")
+
+    def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+    def contents(self, version="v1"):
+      cache = MelaCache(self.filename, version=version)
+      result = {key: cache.get(key) for key in "abcde"}
+      cache.connection.close()
+      return {key: value for key, value in result.iteritems() if value is not None}
+
+    def testEviction(self):
+      #each MelaCache is a generation, the entries that were last used in the oldest generation are evicted first
+      cache = MelaCache(self.filename, maxentries=3, version="v1")
+      cache.put("a", 1.)
+      cache.put("b", 2.)
+      cache.close()
+      cache = MelaCache(self.filename, maxentries=3, version="v1")
+      self.assertEqual(cache.get("a"), 1.)
+      cache.put("c", 3.)
+      cache.close()
+      self.assertEqual(cache.evicted, 0)
+      cache = MelaCache(self.filename, maxentries=3, version="v1")
+      cache.put("d", 4.)
+      cache.close()
+      self.assertEqual(cache.evicted, 1)
+      self.assertEqual(self.contents(), {"a": 1., "c": 3., "d": 4.})
+
+    def testFlush(self):
+      #with commitevery, entries are evicted while the cache is open, and pending entries are returned before they're written
+      cache = MelaCache(self.filename, maxentries=2, version="v1", commitevery=2)
+      cache.put("a", 1.)
+      self.assertEqual(cache.get("a"), 1.)
+      cache.put("b", 2.)
+      cache.put("c", 3.)
+      self.assertEqual(cache.evicted, 0)
+      cache.put("d", 4.)
+      self.assertEqual(cache.evicted, 2)
+      cache.close()
+
+    def testVersion(self):
+      cache = MelaCache(self.filename, version="v1")
+      cache.put("a", 1.)
+      cache.close()
+      self.assertEqual(self.contents("v1"), {"a": 1.})
+      cache = MelaCache(self.filename, version="v2")
+      self.assertTrue(cache.invalidated)
+      self.assertIsNone(cache.get("a"))
+      cache.close()
+      cache = MelaCache(self.filename, version="v2")
+      self.assertFalse(cache.invalidated)
+      cache.close()
+
+    def testMelaVersion(self):
+      #the default version changes with the mela module's path, size and mtime
+      mela = sys.modules["mela"]
+      original = mela.__file__
+      try:
+        mela.__file__ = os.path.join(self.tmpdir, "mela.py")
+        shutil.copy(original, mela.__file__)
+        os.utime(mela.__file__, (1e9, 1e9))
+        version = melaversion()
+        MelaCache(self.filename).close()
+        self.assertFalse(MelaCache(self.filename).invalidated)
+
+        os.utime(mela.__file__, (2e9, 2e9))
+        self.assertNotEqual(melaversion(), version)
+        self.assertTrue(MelaCache(self.filename).invalidated)
+
+        os.utime(mela.__file__, (1e9, 1e9))
+        self.assertEqual(melaversion(), version)
+        with open(mela.__file__, "a") as f: f.write("\n")
+        os.utime(mela.__file__, (1e9, 1e9))
+        self.assertNotEqual(melaversion(), version)
+
+        mela.__file__ = os.path.join(self.tmpdir, "othermela.py")
+        shutil.copy(original, mela.__file__)
+        os.utime(mela.__file__, (1e9, 1e9))
+        self.assertNotEqual(melaversion(), version)
+      finally:
+        mela.__file__ = original
+
+    def testMelaLibraryVersion(self):
+      #the default version also changes when only mela's shared libraries are rebuilt
+      mela = sys.modules["mela"]
+      original = mela.__file__
+      try:
+        mela.__file__ = os.path.join(self.tmpdir, "mela.py")
+        shutil.copy(original, mela.__file__)
+        os.utime(mela.__file__, (1e9, 1e9))
+        library = os.path.join(self.tmpdir, "libJHUGenMELAMELA.so")
+        with open(library, "w") as f: f.write("library")
+        os.utime(library, (1e9, 1e9))
+        with open(os.path.join(self.tmpdir, "notmela.txt"), "w") as f: f.write("not a library")
+        self.assertIn(library, melalibraries())
+        self.assertEqual(len(melalibraries()), len(set(melalibraries())))
+        version = melaversion()
+        MelaCache(self.filename).close()
+        self.assertFalse(MelaCache(self.filename).invalidated)
+
+        os.utime(library, (2e9, 2e9))
+        self.assertNotEqual(melaversion(), version)
+        self.assertTrue(MelaCache(self.filename).invalidated)
+
+        #the libraries that are loaded are found from the memory map, wherever they are
+        otherdir = os.path.join(self.tmpdir, "lib")
+        os.mkdir(otherdir)
+        mcfm, other = os.path.join(otherdir, "libmcfm_707.so"), os.path.join(otherdir, "libother.so")
+        for _ in mcfm, other:
+          with open(_, "w") as f: f.write("library")
+        maps = os.path.join(self.tmpdir, "maps")
+        with open(maps, "w") as f:
+          for _ in mcfm, other, os.path.join(otherdir, "libmela_deleted.so"):
+            f.write("7f0000000000-7f0000001000 r-xp 00000000 08:01 1234 {}\n".format(_))
+          f.write("7f0000001000-7f0000002000 rw-p 00000000 00:00 0 \n")
+        self.assertEqual(melalibraries(maps), sorted([library, mcfm]))
+      finally:
+        mela.__file__ = original
+
+  unittest.main(argv=sys.argv)
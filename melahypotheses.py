@@ -0,0 +1,124 @@
+import itertools
+
+class HypothesisEngine(object):
+  """
+  Plans the MELA evaluations for the pure and interference terms of a set of couplings.
+  The probability is quadratic in the couplings, P(c) = sum_ij c_i c_j M_ij, so
+    the pure term of coupling i is P(e_i) = M_ii and
+    the interference term of i and j is P(e_i + e_j) - M_ii - M_jj = 2 M_ij,
+  which is one evaluation per term (plus one for each coupling in purehypotheses that interferes),
+  with each pure term evaluated once and shared between all the interference terms it enters.  Every evaluation sets all the couplings explicitly.
+
+  couplings is a sequence of (coupling, term name), e.g. (("ghz1", "g1"), ("ghz4", "g4")),
+  interferences is a sequence of pairs of couplings (default: all pairs),
+  purehypotheses can replace the evaluation of a pure term by {coupling: (hypothesis, couplings)},
+  e.g. to use HSMHiggs for ghz1.  That evaluation is stored as the pure term as it is, so its normalization
+  is whatever the hypothesis and couplings give (e.g. HSMHiggs with ghz1=2 for the decay, as pg1 always was),
+  but it isn't M_ii, so the interference terms of that coupling subtract an extra evaluation of e_i
+  with hypothesis instead, and stay 2 M_ij in the normalization of the couplings.
+  The term names are "p" + the term names of the couplings, e.g. pg1, pg4, pg1g4.
+  Example usage:
+    engine = HypothesisEngine((("ghz1", "g1"), ("ghz4", "g4")), None, TVar.SelfDefine_spin0, TVar.JHUGen)
+    probabilities = {name: computeprobability(event, "computeP", hypothesis, matrixelement, process, couplings) for name, hypothesis, matrixelement, couplings in engine.evaluations}
+    terms = engine.terms(probabilities)  #{"pg1": ..., "pg4": ..., "pg1g4": ...}
+  """
+  def __init__(self, couplings, interferences, hypothesis, matrixelement, purehypotheses={}):
+    self.couplings = tuple(couplings)
+    termnames = dict(self.couplings)
+    if interferences is None:
+      interferences = itertools.combinations([coupling for coupling, termname in self.couplings], 2)
+    self.interferences = tuple(tuple(_) for _ in interferences)
+    for coupling in purehypotheses:
+      if coupling not in termnames: raise ValueError("Unknown coupling {}".format(coupling))
+    for pair in self.interferences:
+      for coupling in pair:
+        if coupling not in termnames: raise ValueError("Unknown coupling {}".format(coupling))
+      if pair[0] == pair[1]: raise ValueError("Interference of {} with itself".format(pair[0]))
+
+    def setcouplings(on):
+      return {coupling: (1 if coupling in on else 0) for coupling, termname in self.couplings}
+
+    #(name, hypothesis, matrix element, couplings), as taken by computeprobabilities in lhe2root.py
+    self.evaluations = []
+    #term name: [(coefficient, evaluation name)]
+    self.combinations = {}
+
+    #coupling: name of the evaluation of e_i with hypothesis, which the interference terms subtract
+    unitevaluations = {}
+    interfering = set(itertools.chain.from_iterable(self.interferences))
+    for coupling, termname in self.couplings:
+      name = "p" + termname
+      unitevaluations[coupling] = name
+      if coupling in purehypotheses:
+        purehypothesis, purecouplings = purehypotheses[coupling]
+        self.evaluations.append((name, purehypothesis, matrixelement, dict(purecouplings)))
+        if coupling in interfering:
+          unitevaluations[coupling] = name + "_unit"
+          self.evaluations.append((unitevaluations[coupling], hypothesis, matrixelement, setcouplings((coupling,))))
+      else:
+        self.evaluations.append((name, hypothesis, matrixelement, setcouplings((coupling,))))
+      self.combinations[name] = [(1, name)]
+
+    for coupling1, coupling2 in self.interferences:
+      name = "p" + termnames[coupling1] + termnames[coupling2]
+      evaluationname = name + "_total"
+      self.evaluations.append((evaluationname, hypothesis, matrixelement, setcouplings((coupling1, coupling2))))
+      self.combinations[name] = [(1, evaluationname), (-1, unitevaluations[coupling1]), (-1, unitevaluations[coupling2])]
+
+    self.evaluations = tuple(self.evaluations)
+
+  def terms(self, probabilities):
+    """takes the results of the evaluations as a dict name: probability and returns the pure and interference terms"""
+    return {name: sum(coefficient * probabilities[evaluationname] for coefficient, evaluationname in combination) for name, combination in self.combinations.iteritems()}
+
+if __name__ == "__main__":
+  import sys
+  import unittest
+  from stubmela import TVar
+
+  class TestHypothesisEngine(unittest.TestCase):
+    couplings = (("ghz1", "g1"), ("ghz2", "g2"), ("ghz4", "g4"))
+    #P(c) = sum_ij c_i c_j M_ij
+    matrix = {("ghz1", "ghz1"): 3., ("ghz2", "ghz2"): 5., ("ghz4", "ghz4"): 7., ("ghz1", "ghz2"): 0.25, ("ghz1", "ghz4"): -0.5, ("ghz2", "ghz4"): 0.125}
+
+    def probability(self, hypothesis, couplings):
+      """the quadratic form for SelfDefine_spin0, and a different normalization for HSMHiggs, like mela's ghz1=2 convention"""
+      result = sum(couplings.get(i, 0) * couplings.get(j, 0) * value * (1 if i == j else 2) for (i, j), value in self.matrix.iteritems())
+      return result * 10 if hypothesis == TVar.HSMHiggs else result
+
+    def evaluate(self, engine):
+      return {name: self.probability(hypothesis, couplings) for name, hypothesis, matrixelement, couplings in engine.evaluations}
+
+    def testPlan(self):
+      engine = HypothesisEngine(self.couplings, None, TVar.SelfDefine_spin0, TVar.JHUGen)
+      self.assertEqual([name for name, hypothesis, matrixelement, couplings in engine.evaluations], ["pg1", "pg2", "pg4", "pg1g2_total", "pg1g4_total", "pg2g4_total"])
+      for name, hypothesis, matrixelement, couplings in engine.evaluations:
+        self.assertEqual(sorted(couplings), ["ghz1", "ghz2", "ghz4"])
+        self.assertEqual((hypothesis, matrixelement), (TVar.SelfDefine_spin0, TVar.JHUGen))
+      self.assertEqual(engine.evaluations[3][3], {"ghz1": 1, "ghz2": 1, "ghz4": 0})
+      self.assertRaises(ValueError, HypothesisEngine, self.couplings, (("ghz1", "ghza2"),), TVar.SelfDefine_spin0, TVar.JHUGen)
+      self.assertRaises(ValueError, HypothesisEngine, self.couplings, (("ghz1", "ghz1"),), TVar.SelfDefine_spin0, TVar.JHUGen)
+      self.assertRaises(ValueError, HypothesisEngine, self.couplings, None, TVar.SelfDefine_spin0, TVar.JHUGen, purehypotheses={"ghza2": (TVar.HSMHiggs, {})})
+
+    def testTerms(self):
+      engine = HypothesisEngine(self.couplings, None, TVar.SelfDefine_spin0, TVar.JHUGen)
+      terms = engine.terms(self.evaluate(engine))
+      self.assertEqual(sorted(terms), ["pg1", "pg1g2", "pg1g4", "pg2", "pg2g4", "pg4"])
+      for (i, j), value in self.matrix.iteritems():
+        name = "p" + dict(self.couplings)[i] + (dict(self.couplings)[j] if i != j else "")
+        self.assertAlmostEqual(terms[name], value if i == j else 2*value)
+
+    def testPureHypotheses(self):
+      #the pure term is the HSMHiggs evaluation as it is, the interference terms don't depend on its normalization
+      engine = HypothesisEngine(self.couplings, (("ghz1", "ghz4"), ("ghz1", "ghz2")), TVar.SelfDefine_spin0, TVar.JHUGen, purehypotheses={"ghz1": (TVar.HSMHiggs, {"ghz1": 2})})
+      self.assertEqual(len(engine.evaluations), 6)
+      self.assertIn(("pg1_unit", TVar.SelfDefine_spin0, TVar.JHUGen, {"ghz1": 1, "ghz2": 0, "ghz4": 0}), engine.evaluations)
+      terms = engine.terms(self.evaluate(engine))
+      self.assertAlmostEqual(terms["pg1"], 10 * 4 * 3.)
+      self.assertAlmostEqual(terms["pg1g2"], 2 * 0.25)
+      self.assertAlmostEqual(terms["pg1g4"], 2 * -0.5)
+      #without interferences, there's no extra evaluation
+      engine = HypothesisEngine(self.couplings, (("ghz2", "ghz4"),), TVar.SelfDefine_spin0, TVar.JHUGen, purehypotheses={"ghz1": (TVar.HSMHiggs, {"ghz1": 2})})
+      self.assertEqual(len(engine.evaluations), 4)
+
+  unittest.main(argv=sys.argv)
@@ -0,0 +1,222 @@
+"""
+The Mela objects of a process, and the configuration state of each one.
+A Mela is expensive to create, and the JHUGen couplings behind it are global to the process,
+so there's one per set of constructor arguments in each process (MelaPool.get),
+and forked worker processes create their own instead of using the parent's.
+The hypotheses are evaluated through the MelaState of the Mela, which only calls setProcess
+when the (hypothesis, matrix element, process) changes, and only sets the couplings that aren't already 0.
+Example usage:
+  mela = melapool.get((13, 125))
+  state = melapool.state(mela)
+  hypotheses = state.prepare("computeP", engine.evaluations, TVar.ZZINDEPENDENT)
+  with state.lock:
+    mela.setInputEvent(...)
+    probabilities = {hypothesis.name: state.compute(mela, hypothesis) for hypothesis in state.order(hypotheses)}
+"""
+
+import os
+import threading
+
+from mela import Mela
+
+class PreparedHypothesis(object):
+  """one evaluation of a HypothesisEngine for a compute function and a process, with its couplings split up once"""
+  __slots__ = ("name", "function", "configuration", "couplings", "nonzerocouplings")
+
+  def __init__(self, name, function, hypothesis, matrixelement, process, couplings):
+    self.name, self.function = name, function
+    self.configuration = (hypothesis, matrixelement, process)
+    self.couplings = dict(couplings)
+    self.nonzerocouplings = tuple((coupling, value) for coupling, value in sorted(self.couplings.iteritems()) if value)
+
+class MelaState(object):
+  """
+  The configuration that was last set on a Mela.
+  Every compute resets all the couplings to 0 (computeresetscouplings), so after one only the nonzero couplings are set.
+  Code that calls setProcess or sets couplings on the Mela directly has to call invalidate() afterwards.
+  Threads that share the Mela have to hold lock from setInputEvent to the last compute of the event.
+  """
+  computeresetscouplings = True
+
+  def __init__(self, mela):
+    self.mela = mela
+    self.lock = threading.RLock()
+    self.prepared = {}
+    self.invalidate()
+
+  def invalidate(self):
+    self.configuration = None
+    self.couplingsarezero = False
+
+  def prepare(self, function, evaluations, process):
+    """
+    the PreparedHypotheses of evaluations ((name, hypothesis, matrix element, couplings), see HypothesisEngine)
+    for function (computeP or computeProdP) and process, grouped by configuration and kept for the next events
+    """
+    key = (function, id(evaluations), process)
+    if key not in self.prepared:
+      hypotheses = [PreparedHypothesis(name, function, hypothesis, matrixelement, process, couplings) for name, hypothesis, matrixelement, couplings in evaluations]
+      configurations = []
+      for hypothesis in hypotheses:
+        if hypothesis.configuration not in configurations: configurations.append(hypothesis.configuration)
+      groups = tuple(tuple(hypothesis for hypothesis in hypotheses if hypothesis.configuration == configuration) for configuration in configurations)
+      #evaluations is kept so that its id isn't reused
+      self.prepared[key] = (evaluations, groups)
+    return self.prepared[key][1]
+
+  def order(self, groups):
+    """the hypotheses of the groups from prepare, starting with the group of the current configuration, which doesn't need setProcess"""
+    for group in groups:
+      if group[0].configuration == self.configuration:
+        first = group
+        break
+    else:
+      first = None
+    if first is not None:
+      for hypothesis in first: yield hypothesis
+    for group in groups:
+      if group is first: continue
+      for hypothesis in group: yield hypothesis
+
+  def compute(self, event, hypothesis):
+    """
+    computes the probability of hypothesis for the input event that's set,
+    event is the Mela or an object that passes the Mela's attributes through (e.g. LHEFileBase)
+    """
+    if hypothesis.configuration != self.configuration:
+      self.configuration = None
+      event.setProcess(*hypothesis.configuration)
+      self.configuration = hypothesis.configuration
+    couplings = hypothesis.nonzerocouplings if self.couplingsarezero else hypothesis.couplings.iteritems()
+    self.couplingsarezero = False
+    for coupling, value in couplings:
+      setattr(event, coupling, value)
+    result = getattr(event, hypothesis.function)()
+    self.couplingsarezero = self.computeresetscouplings
+    return result
+
+class MelaPool(object):
+  """one Mela per set of constructor arguments in each process, and their MelaStates"""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.pid = None
+    self.melas = {}
+    self.states = {}
+
+  def _checkpid(self):
+    #after a fork, the Melas belong to the parent process
+    if self.pid != os.getpid():
+      self.pid = os.getpid()
+      self.melas.clear()
+      self.states.clear()
+
+  def get(self, melaargs, reuse=True):
+    """the Mela for melaargs, which is created if there isn't one or if reuse is False (then it replaces the existing one)"""
+    with self.lock:
+      self._checkpid()
+      if not reuse or melaargs not in self.melas:
+        #the MelaState of the Mela that's replaced would keep it alive
+        if melaargs in self.melas: self.states.pop(id(self.melas[melaargs]), None)
+        self.melas[melaargs] = Mela(*melaargs)
+      return self.melas[melaargs]
+
+  def state(self, mela):
+    with self.lock:
+      self._checkpid()
+      if id(mela) not in self.states:
+        self.states[id(mela)] = MelaState(mela)
+      return self.states[id(mela)]
+
+melapool = MelaPool()
+
+if __name__ == "__main__":
+  import sys
+  import unittest
+  import weakref
+  import stubmela
+  from stubmela import TVar
+
+  class RecordingMela(stubmela.Mela):
+    """records the setProcess calls and the couplings that are set"""
+    def __init__(self, *args):
+      super(RecordingMela, self).__init__(*args)
+      self.calls = []
+    def setProcess(self, *configuration):
+      self.calls.append(("setProcess",) + configuration)
+    def __setattr__(self, name, value):
+      if name.startswith("ghz"): self.calls.append((name, value))
+      super(RecordingMela, self).__setattr__(name, value)
+
+  Mela = RecordingMela
+
+  class TestMelaState(unittest.TestCase):
+    evaluations = (
+      ("pg1", TVar.SelfDefine_spin0, TVar.JHUGen, {"ghz1": 1, "ghz2": 0}),
+      ("pg2", TVar.SelfDefine_spin0, TVar.JHUGen, {"ghz1": 0, "ghz2": 1}),
+      ("p0plus", TVar.HSMHiggs, TVar.JHUGen, {}),
+    )
+
+    def computeevent(self, mela, state, groups):
+      del mela.calls[:]
+      return [(hypothesis.name, state.compute(mela, hypothesis)) for hypothesis in state.order(groups)]
+
+    def setprocesscalls(self, mela):
+      return [call[1:] for call in mela.calls if call[0] == "setProcess"]
+
+    def testSetProcess(self):
+      mela = RecordingMela()
+      state = MelaState(mela)
+      groups = state.prepare("computeP", self.evaluations, TVar.ZZINDEPENDENT)
+      self.assertIs(state.prepare("computeP", self.evaluations, TVar.ZZINDEPENDENT), groups)
+      self.assertEqual([name for name, probability in self.computeevent(mela, state, groups)], ["pg1", "pg2", "p0plus"])
+      self.assertEqual(self.setprocesscalls(mela), [(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZINDEPENDENT), (TVar.HSMHiggs, TVar.JHUGen, TVar.ZZINDEPENDENT)])
+      #the next event starts with the configuration that's set
+      self.assertEqual([name for name, probability in self.computeevent(mela, state, groups)], ["p0plus", "pg1", "pg2"])
+      self.assertEqual(self.setprocesscalls(mela), [(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZINDEPENDENT)])
+      #a different process is a different configuration
+      other = state.prepare("computeP", self.evaluations, TVar.ZZGG)
+      self.computeevent(mela, state, other)
+      self.assertEqual(self.setprocesscalls(mela), [(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG), (TVar.HSMHiggs, TVar.JHUGen, TVar.ZZGG)])
+      #after invalidate, setProcess is called even for the configuration that was set
+      state.invalidate()
+      self.computeevent(mela, state, other)
+      self.assertEqual(self.setprocesscalls(mela), [(TVar.SelfDefine_spin0, TVar.JHUGen, TVar.ZZGG), (TVar.HSMHiggs, TVar.JHUGen, TVar.ZZGG)])
+
+    def couplingcalls(self, mela):
+      calls = [call for call in mela.calls if call[0] != "setProcess"]
+      return sorted(calls[:2]) + calls[2:]
+
+    def testCouplings(self):
+      mela = RecordingMela()
+      state = MelaState(mela)
+      groups = state.prepare("computeP", self.evaluations[:2], TVar.ZZINDEPENDENT)
+      #the first compute sets all the couplings, the ones after it only the nonzero ones
+      self.computeevent(mela, state, groups)
+      self.assertEqual(self.couplingcalls(mela), [("ghz1", 1), ("ghz2", 0), ("ghz2", 1)])
+      self.computeevent(mela, state, groups)
+      self.assertEqual(self.couplingcalls(mela), [("ghz1", 1), ("ghz2", 1)])
+      state.invalidate()
+      self.computeevent(mela, state, groups)
+      self.assertEqual(self.couplingcalls(mela), [("ghz1", 1), ("ghz2", 0), ("ghz2", 1)])
+
+  class TestMelaPool(unittest.TestCase):
+    def testGet(self):
+      pool = MelaPool()
+      mela = pool.get((13, 125))
+      state = pool.state(mela)
+      self.assertIs(pool.get((13, 125)), mela)
+      self.assertIs(pool.state(mela), state)
+      self.assertIsNot(pool.get((13, 125, TVar.ERROR)), mela)
+
+    def testReplace(self):
+      pool = MelaPool()
+      mela = pool.get((13, 125))
+      pool.state(mela)
+      old = weakref.ref(mela)
+      del mela
+      replacement = pool.get((13, 125), reuse=False)
+      self.assertIsNone(old())
+      self.assertEqual(list(pool.states), [])
+      self.assertIs(pool.state(replacement).mela, replacement)
+
+  unittest.main(argv=sys.argv)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""
+Merges lhe2root outputs (e.g. the partial outputs of a large production) into one file, in the order they're given,
+after checking that they can be merged:
+  - they have the same branches, with the same types and array lengths, which vary with the lhe2root mode and options
+  - the weights branch has the same columns, from the reweighting ids in the headers of the source LHE files
+  - the headers of the source LHE files (the lhemetadata stored by lhe2root) have the same beams, PDFs,
+    weighting strategy and process ids (the cross sections can differ between runs), unless --allow-different-headers
+The lhemetadata of the output is the list of the source LHE files of all the inputs.
+ROOT files are merged with TFileMerger's fast method, which copies the compressed baskets as they are
+when the output compression is the same as the inputs' (the default), with at most --max-open-files inputs open at once.
+The columnar formats are copied one row group at a time, so the memory use doesn't depend on the number of inputs.
+Example usage:
+  mergeoutputs.py merged.root part*.root --jobs 8
+"""
+
+if __name__ == "__main__":
+  import argparse, os
+  parser = argparse.ArgumentParser()
+  parser.add_argument("outputfile")
+  parser.add_argument("inputfile", nargs="+")
+  parser.add_argument("--jobs", type=int, default=1, help="number of processes that read and check the inputs")
+  parser.add_argument("--max-open-files", type=int, default=100, help="maximum number of ROOT inputs that are open at once while merging")
+  parser.add_argument("--allow-different-headers", action="store_true", help="merge inputs whose source LHE files have different beams, PDFs, weighting strategies or processes")
+  parser.add_argument("--compression-algorithm", choices=("zlib", "lzma", "lz4", "zstd"), help="default: the compression of the first input")
+  parser.add_argument("--compression-level", type=int, help="0-9, default: the compression level of the first input, or 4 if only --compression-algorithm is given")
+  args = parser.parse_args()
+
+  if os.path.exists(args.outputfile): raise IOError(args.outputfile+" already exists")
+  for _ in args.inputfile:
+    if not os.path.exists(_): raise IOError(_+" doesn't exist")
+
+import collections
+import json
+import multiprocessing
+import os
+
+import numpy
+
+import columnwriters
+
+#the branches of an input as (name, type), the metadata (a dict of strings), the number of events and the compression:
+#ROOT's compression settings for root, the algorithm and level (see columnwriters) for the columnar formats
+OutputInfo = collections.namedtuple("OutputInfo", "filename format branches metadata nevents compression compressionlevel")
+
+compressionalgorithms = {"zlib": 1, "lzma": 2, "lz4": 4, "zstd": 5}
+
+def rootcompressionsettings(algorithm, level):
+  """returns ROOT's compression settings, 100*algorithm + level, or None to use ROOT's default"""
+  if algorithm is None and level is None: return None
+  return 100*compressionalgorithms[algorithm or "zlib"] + (level if level is not None else 4)
+
+def readrootinfo(filename):
+  import ROOT
+  f = ROOT.TFile.Open(filename)
+  if not f or f.IsZombie(): raise IOError("Can't open "+filename)
+  try:
+    tree = f.Get("tree")
+    if not tree: raise ValueError(filename+" doesn't have a tree called tree")
+    #the title of a branch is its leaf list, e.g. weights[nweights]/F
+    branches = tuple((branch.GetName(), branch.GetTitle()) for branch in tree.GetListOfBranches())
+    metadata = {key.GetName(): key.ReadObj().GetTitle() for key in f.GetListOfKeys() if key.GetClassName() == "TNamed"}
+    return OutputInfo(filename, "root", branches, metadata, tree.GetEntries(), f.GetCompressionSettings(), None)
+  finally:
+    f.Close()
+
+def columntype(base, shape):
+  """e.g. float32 or float32[200], float32[?] for an array whose length isn't known"""
+  name = numpy.dtype(base).name
+  if shape is None: return name + "[?]"
+  return name + "".join("[{}]".format(_) for _ in shape)
+
+def readinfo(filename):
+  """the OutputInfo of an lhe2root output, the format is determined from the extension"""
+  outputformat = columnwriters.outputformat(filename)
+  if outputformat == "root": return readrootinfo(filename)
+  info = columnwriters.writers[outputformat].readinfo(filename)
+  branches = tuple((name, columntype(base, shape)) for name, base, shape in info.fields)
+  return OutputInfo(filename, outputformat, branches, info.metadata, info.nevents, info.compression, info.compressionlevel)
+
+def lheheaders(info):
+  """the headers of the source LHE files of an input, see lhemetadata in lhe2root.py"""
+  return json.loads(info.metadata.get("lhemetadata", "[]"))
+
+def weightlayout(headers):
+  """the reweighting ids in the headers, in the order that lhe2root puts them in the weights branch"""
+  return tuple(collections.OrderedDict.fromkeys(id for header in headers for group in header["weightgroups"] for id, description in group["weights"]))
+
+def headersignature(header):
+  """the parts of a header that have to be the same for events that are merged"""
+  return (
+    header["version"],
+    tuple(tuple(sorted(beam.items())) for beam in header["beams"]) if header["beams"] is not None else None,
+    header["weightingstrategy"],
+    tuple(sorted(process["id"] for process in header["processes"])),
+  )
+
+def sametype(type1, type2):
+  if type1 == type2: return True
+  #the length of an array isn't known in a columnar file without events
+  base1, base2 = (_.split("[")[0] for _ in (type1, type2))
+  return base1 == base2 and (type1.endswith("[?]") or type2.endswith("[?]"))
+
+class OutputChecker(object):
+  """
+  Checks each input against the first one, and collects the headers of their source LHE files.
+  Only the first input's OutputInfo is kept, so the memory use doesn't grow with the number of inputs
+  beyond the headers themselves, which go into the output.
+  Example usage:
+    checker = OutputChecker()
+    for info in infos:
+      checker.add(info)
+    metadata = checker.metadata()
+  """
+  def __init__(self, allowdifferentheaders=False):
+    self.allowdifferentheaders = allowdifferentheaders
+    self.first = self.firstheader = None
+    self.layout = None
+    self.branches = None
+    self.headers = []
+    self.nevents = 0
+    self.ninputs = 0
+
+  def error(self, info, message):
+    return ValueError("{} can't be merged with {}: {}".format(info.filename, self.first.filename, message))
+
+  def add(self, info):
+    if self.first is None: self.first = info
+    self.ninputs += 1
+    self.nevents += info.nevents
+    if info.format != self.first.format:
+      raise self.error(info, "it's {}, not {}".format(info.format, self.first.format))
+    self.checkbranches(info)
+    headers = lheheaders(info)
+    self.checkweights(info, headers)
+    self.checkheaders(info, headers)
+    self.headers += headers
+
+  def checkbranches(self, info):
+    #an hdf5 file without events has no datasets, so nothing to check
+    if info.format == "hdf5" and not info.nevents and not info.branches: return
+    if self.branches is None:
+      self.branches = collections.OrderedDict(info.branches)
+      self.branchesfrom = info
+      return
+    branches = dict(info.branches)
+    missing = [name for name in self.branches if name not in branches]
+    extra = [name for name, type in info.branches if name not in self.branches]
+    different = ["{} ({} instead of {})".format(name, type, self.branches[name]) for name, type in info.branches if name in self.branches and not sametype(type, self.branches[name])]
+    problems = []
+    if missing: problems.append("missing branches " + ", ".join(missing))
+    if extra: problems.append("extra branches " + ", ".join(extra))
+    if different: problems.append("different types " + ", ".join(different))
+    if problems:
+      raise ValueError("{} can't be merged with {}: {}".format(info.filename, self.branchesfrom.filename, "; ".join(problems)))
+    #keep the known lengths
+    for name, type in info.branches:
+      if self.branches[name].endswith("[?]"): self.branches[name] = type
+
+  def checkweights(self, info, headers):
+    if "weights" not in dict(info.branches): return
+    #without reweighting ids in the headers, lhe2root takes them from the first event, so only the length can be checked
+    layout = weightlayout(headers)
+    if not layout: return
+    if self.layout is None:
+      self.layout, self.layoutfrom = layout, info
+    elif layout != self.layout:
+      raise ValueError("{} can't be merged with {}: the weights branch has different reweighting ids ({} instead of {})".format(
+        info.filename, self.layoutfrom.filename, ", ".join(layout), ", ".join(self.layout)))
+    weightstype = dict(info.branches)["weights"]
+    if info.format != "root" and not weightstype.endswith("[?]") and weightstype != columntype(numpy.float32, (len(layout),)):
+      raise self.error(info, "the weights branch is {}, but there are {} reweighting ids in the headers".format(weightstype, len(layout)))
+
+  def checkheaders(self, info, headers):
+    if self.allowdifferentheaders: return
+    for name, value in info.metadata.iteritems():
+      if name != "lhemetadata" and value != self.first.metadata.get(name):
+        raise self.error(info, "different {}".format(name))
+    for header in headers:
+      if self.firstheader is None:
+        self.firstheader, self.firstheaderfrom = header, info
+        continue
+      if headersignature(header) != headersignature(self.firstheader):
+        raise ValueError("{} can't be merged with {}: the header of its source {} has different beams, PDFs, weighting strategy or processes from {}, use --allow-different-headers to merge anyway".format(
+          info.filename, self.firstheaderfrom.filename, header["filename"], self.firstheader["filename"]))
+
+  def metadata(self):
+    """the metadata of the output: that of the first input, with the lhemetadata of all of them"""
+    result = dict(self.first.metadata)
+    if self.headers or "lhemetadata" in result: result["lhemetadata"] = json.dumps(self.headers)
+    return result
+
+def readinfos(filenames, jobs=1):
+  """yields the OutputInfo of each file, in order, reading them in jobs processes"""
+  if jobs <= 1:
+    for filename in filenames:
+      yield readinfo(filename)
+    return
+  pool = multiprocessing.Pool(jobs)
+  try:
+    for info in pool.imap(readinfo, filenames, chunksize=max(min(len(filenames) // (4*jobs), 100), 1)):
+      yield info
+  finally:
+    pool.terminate()
+
+def mergeroot(filenames, outputfile, compression=None, metadata=None, maxopenfiles=100):
+  """
+  merges the trees of filenames with TFileMerger, which copies the baskets without recompressing them
+  when compression (ROOT's compression settings) is the same as the inputs', and writes metadata as TNamed
+  """
+  import ROOT
+  merger = ROOT.TFileMerger(False)
+  merger.SetFastMethod(True)
+  merger.SetMaxOpenedFiles(maxopenfiles)
+  if compression is None:
+    merger.OutputFile(outputfile, "RECREATE")
+  else:
+    merger.OutputFile(outputfile, "RECREATE", compression)
+  for filename in filenames:
+    if not merger.AddFile(filename, False): raise IOError("Can't open "+filename)
+  #only the tree, the TNamed metadata is written below
+  merger.AddObjectNames("tree")
+  if not merger.PartialMerge(ROOT.TFileMerger.kAll | ROOT.TFileMerger.kRegular | ROOT.TFileMerger.kOnlyListed):
+    raise RuntimeError("Failed to merge the inputs into "+outputfile)
+  if metadata:
+    f = ROOT.TFile(outputfile, "UPDATE")
+    for name, value in metadata.iteritems():
+      f.WriteTObject(ROOT.TNamed(name, value), name, "Overwrite")
+    f.Close()
+
+def columndtype(branches):
+  """the numpy dtype of the columnar branches, an array whose length isn't known (no input has events) has length 0"""
+  fields = []
+  for name, type in branches.iteritems():
+    parts = type.replace("]", "").split("[")
+    shape = tuple(0 if _ == "?" else int(_) for _ in parts[1:])
+    fields.append((name, parts[0], shape) if shape else (name, parts[0]))
+  return numpy.dtype(fields)
+
+def merge(filenames, outputfile, jobs=1, maxopenfiles=100, allowdifferentheaders=False, compressionalgorithm=None, compressionlevel=None):
+  """checks that the lhe2root outputs filenames can be merged and merges them into outputfile, returns the OutputChecker"""
+  checker = OutputChecker(allowdifferentheaders)
+  for info in readinfos(filenames, jobs):
+    checker.add(info)
+  outputformat = columnwriters.outputformat(outputfile)
+  if outputformat != checker.first.format:
+    raise ValueError("The inputs are {}, but {} would be {}".format(checker.first.format, outputfile, outputformat))
+  metadata = checker.metadata()
+  if outputformat == "root":
+    compression = rootcompressionsettings(compressionalgorithm, compressionlevel)
+    if compression is None: compression = checker.first.compression
+    mergeroot(filenames, outputfile, compression, metadata, maxopenfiles)
+  else:
+    if compressionalgorithm is None and compressionlevel is None:
+      compressionalgorithm, compressionlevel = checker.first.compression, checker.first.compressionlevel
+    columnwriters.writers[outputformat].concatenate(filenames, outputfile, columndtype(checker.branches or {}), compressionalgorithm, compressionlevel, metadata)
+  nevents = readinfo(outputfile).nevents
+  if nevents != checker.nevents:
+    raise RuntimeError("{} has {} events, but the inputs have {}".format(outputfile, nevents, checker.nevents))
+  return checker
+
+if __name__ == "__main__":
+  bad = False
+  try:
+    checker = merge(args.inputfile, args.outputfile, args.jobs, args.max_open_files, args.allow_different_headers, args.compression_algorithm, args.compression_level)
+  except:
+    bad = True
+    raise
+  finally:
+    if bad:
+      try:
+        os.remove(args.outputfile)
+      except:
+        pass
+  print "Merged {} events from {} files ({} source LHE files) into {}".format(checker.nevents, checker.ninputs, len(checker.headers), args.outputfile)
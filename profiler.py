@@ -0,0 +1,285 @@
+import collections
+import csv
+import heapq
+import json
+import os
+import time
+
+class StageTimer(object):
+  """
+  Context manager that adds the wall and CPU time of each block it's used for to the totals of its stage.
+  The CPU time is the time.clock() of the whole process, so it includes other threads (e.g. decompression).
+  """
+  __slots__ = ("name", "profiler", "calls", "wall", "cpu", "_wall", "_cpu")
+
+  def __init__(self, name, profiler):
+    self.name, self.profiler = name, profiler
+    self.calls = 0
+    self.wall = self.cpu = 0.
+
+  def __enter__(self):
+    self._wall = time.time()
+    self._cpu = time.clock()
+    return self
+
+  def __exit__(self, *errorinfo):
+    wall = time.time() - self._wall
+    self.cpu += time.clock() - self._cpu
+    self.wall += wall
+    self.calls += 1
+    eventstages = self.profiler.eventstages
+    eventstages[self.name] = eventstages.get(self.name, 0) + wall
+
+class Profiler(object):
+  """
+  Accumulates the wall and CPU time of named stages, the number of events over time,
+  and the per stage times of every sampleevery'th event and of the nslowest slowest events.
+  The stats of profilers in worker processes can be added to the main one, then the stage
+  and CPU times are summed over the processes.
+  Stages that are done once for a chunk of events count in the totals, but not in the time of any event,
+  as long as profiler.startevent() is called after them.
+  Example usage:
+    profiler = Profiler()
+    for chunk in chunks:
+      with profiler.stage("kinematics"):
+        ...
+      for event in chunk:
+        profiler.startevent()
+        with profiler.stage("angles"):
+          ...
+        with profiler.stage("fill"):
+          ...
+        profiler.endevent(label)
+    profiler.write("profile.json")  #or .csv for the stage totals only
+    profiler.report()
+  """
+  enabled = True
+
+  def __init__(self, sampleevery=1000, nslowest=20, interval=10):
+    self.sampleevery, self.nslowest, self.interval = sampleevery, nslowest, interval
+    self.start, self.startcpu = time.time(), time.clock()
+    self.timers = collections.OrderedDict()
+    self.nevents = 0
+    self.workercpu = 0.
+    self.timeline = [(0., 0)]  #(seconds since the start, number of events)
+    self.workertimelines = []
+    self.samples = []
+    self.slowest = []  #heap of (wall time, label, stage times)
+    self.eventstages = {}
+    self.eventstart = self.nexttimeline = self.start
+
+  def stage(self, name):
+    """the StageTimer for name, to be used as with profiler.stage(name): ..."""
+    try:
+      return self.timers[name]
+    except KeyError:
+      self.timers[name] = StageTimer(name, self)
+      return self.timers[name]
+
+  def startevent(self):
+    """marks the start of an event: the time and the stages since the last endevent aren't counted in the event"""
+    self.eventstages.clear()
+    self.eventstart = time.time()
+
+  def endevent(self, label=None):
+    """marks the end of an event, label identifies it in the samples and the slowest events"""
+    now = time.time()
+    wall = now - self.eventstart
+    self.nevents += 1
+    if self.sampleevery and self.nevents % self.sampleevery == 0:
+      self.samples.append((wall, label, dict(self.eventstages)))
+    if len(self.slowest) < self.nslowest:
+      heapq.heappush(self.slowest, (wall, label, dict(self.eventstages)))
+    elif self.slowest and wall > self.slowest[0][0]:
+      heapq.heapreplace(self.slowest, (wall, label, dict(self.eventstages)))
+    self.eventstages.clear()
+    if now >= self.nexttimeline:
+      self.timeline.append((now - self.start, self.nevents))
+      self.nexttimeline = now + self.interval
+    self.eventstart = now
+
+  @property
+  def stats(self):
+    """everything that's been measured, as json serializable types"""
+    now = time.time()
+    return collections.OrderedDict((
+      ("nevents", self.nevents),
+      ("wall", now - self.start),
+      ("cpu", time.clock() - self.startcpu + self.workercpu),
+      ("stages", collections.OrderedDict((name, {"calls": timer.calls, "wall": timer.wall, "cpu": timer.cpu}) for name, timer in self.timers.iteritems())),
+      ("timeline", self.timeline + [(now - self.start, self.nevents)]),
+      ("workertimelines", self.workertimelines),
+      ("samples", [{"wall": wall, "event": label, "stages": stages} for wall, label, stages in self.samples]),
+      ("slowest", [{"wall": wall, "event": label, "stages": stages} for wall, label, stages in sorted(self.slowest, reverse=True)]),
+    ))
+
+  def add(self, stats):
+    """adds the stats of the profiler of a worker process"""
+    self.nevents += stats["nevents"]
+    self.workercpu += stats["cpu"]
+    for name, stage in stats["stages"].iteritems():
+      timer = self.stage(name)
+      timer.calls += stage["calls"]
+      timer.wall += stage["wall"]
+      timer.cpu += stage["cpu"]
+    self.workertimelines.append(stats["timeline"])
+    self.samples += [(sample["wall"], sample["event"], sample["stages"]) for sample in stats["samples"]]
+    self.slowest = heapq.nlargest(self.nslowest, self.slowest + [(event["wall"], event["event"], event["stages"]) for event in stats["slowest"]])
+    heapq.heapify(self.slowest)
+
+  def write(self, filename):
+    """writes the stats as json, or if filename ends with .csv, a table of the stage totals"""
+    stats = self.stats
+    if os.path.splitext(filename)[1].lower() != ".csv":
+      with open(filename, "w") as f:
+        json.dump(stats, f, indent=2)
+      return
+    with open(filename, "wb") as f:
+      writer = csv.writer(f)
+      writer.writerow(("stage", "calls", "wall", "cpu", "wall per call", "fraction of wall"))
+      for name, stage in stats["stages"].iteritems():
+        writer.writerow((name, stage["calls"], stage["wall"], stage["cpu"], stage["wall"] / stage["calls"] if stage["calls"] else 0, stage["wall"] / stats["wall"] if stats["wall"] else 0))
+      writer.writerow(("total", stats["nevents"], stats["wall"], stats["cpu"], stats["wall"] / stats["nevents"] if stats["nevents"] else 0, 1))
+
+  def report(self):
+    stats = self.stats
+    print "Profile: {} events in {:.1f} s wall, {:.1f} s CPU ({:.1f} events/s)".format(
+      stats["nevents"], stats["wall"], stats["cpu"], stats["nevents"] / stats["wall"] if stats["wall"] else 0,
+    )
+    for name, stage in sorted(stats["stages"].iteritems(), key=lambda item: -item[1]["wall"]):
+      print "  {:30} {:10.3f} s wall {:10.3f} s CPU {:10} calls {:10.1f} us/call".format(
+        name, stage["wall"], stage["cpu"], stage["calls"], 1e6 * stage["wall"] / stage["calls"] if stage["calls"] else 0,
+      )
+
+class NullProfiler(object):
+  """does nothing, so that the instrumented code doesn't need to check whether profiling is on"""
+  enabled = False
+
+  class NullStage(object):
+    def __enter__(self):
+      return self
+    def __exit__(self, *errorinfo):
+      pass
+
+  nullstage = NullStage()
+
+  def stage(self, name):
+    return self.nullstage
+
+  def startevent(self):
+    pass
+
+  def endevent(self, label=None):
+    pass
+
+nullprofiler = NullProfiler()
+
+if __name__ == "__main__":
+  import shutil
+  import sys
+  import tempfile
+  import unittest
+
+  class FakeTime(object):
+    """stands in for the time module, the wall and CPU time only move with advance"""
+    def __init__(self):
+      self.now, self.cpu = 1000., 10.
+    def time(self):
+      return self.now
+    def clock(self):
+      return self.cpu
+    def advance(self, wall, cpu=0.):
+      self.now += wall
+      self.cpu += cpu
+
+  class TestProfiler(unittest.TestCase):
+    def setUp(self):
+      self.module = sys.modules[__name__]
+      self.realtime, self.module.time = self.module.time, FakeTime()
+      self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+      self.module.time = self.realtime
+      shutil.rmtree(self.tmpdir)
+
+    def runevents(self, profiler, chunks, label=""):
+      """each chunk is a list of the times of its events, the kinematics of each chunk take 100 s"""
+      clock = self.module.time
+      for i, chunk in enumerate(chunks):
+        with profiler.stage("kinematics"):
+          clock.advance(100., 50.)
+        for j, wall in enumerate(chunk):
+          profiler.startevent()
+          with profiler.stage("angles"):
+            clock.advance(wall, wall/2)
+          with profiler.stage("fill"):
+            clock.advance(1.)
+          profiler.endevent(label + "{}:{}".format(i, j))
+
+    def testStages(self):
+      profiler = Profiler(sampleevery=2, nslowest=3, interval=1e9)
+      self.runevents(profiler, [[1., 2., 3.], [4.]])
+      stats = profiler.stats
+      self.assertEqual(stats["nevents"], 4)
+      self.assertEqual(stats["wall"], 2*100. + 10. + 4*1.)
+      self.assertEqual(stats["cpu"], 2*50. + 5.)
+      self.assertEqual(stats["stages"].keys(), ["kinematics", "angles", "fill"])
+      self.assertEqual(stats["stages"]["kinematics"], {"calls": 2, "wall": 200., "cpu": 100.})
+      self.assertEqual(stats["stages"]["angles"], {"calls": 4, "wall": 10., "cpu": 5.})
+      self.assertEqual(stats["stages"]["fill"], {"calls": 4, "wall": 4., "cpu": 0.})
+      #the kinematics of the chunk aren't counted in its first event
+      self.assertEqual(stats["samples"], [
+        {"wall": 3., "event": "0:1", "stages": {"angles": 2., "fill": 1.}},
+        {"wall": 5., "event": "1:0", "stages": {"angles": 4., "fill": 1.}},
+      ])
+      self.assertEqual(stats["timeline"], [(0., 0), (102., 1), (214., 4)])
+
+    def testSlowest(self):
+      profiler = Profiler(nslowest=3)
+      self.runevents(profiler, [[5., 1., 7.], [2., 9.], [3.]])
+      self.assertEqual([(event["wall"], event["event"]) for event in profiler.stats["slowest"]], [(10., "1:1"), (8., "0:2"), (6., "0:0")])
+      self.assertEqual(profiler.stats["slowest"][0]["stages"], {"angles": 9., "fill": 1.})
+      self.assertEqual(len(profiler.slowest), 3)
+      self.assertEqual(Profiler(nslowest=0).stats["slowest"], [])
+
+    def testAdd(self):
+      worker = Profiler(sampleevery=1, nslowest=2)
+      self.runevents(worker, [[4., 8.]], "worker ")
+      workerstats = worker.stats
+      main = Profiler(sampleevery=1, nslowest=2)
+      self.runevents(main, [[2., 6.], [20.]])
+      with main.stage("merge"):
+        main.add(workerstats)
+      stats = main.stats
+      self.assertEqual(stats["nevents"], 5)
+      self.assertEqual(stats["cpu"], (2*50. + 14.) + (50. + 6.))
+      self.assertEqual(stats["stages"].keys(), ["kinematics", "angles", "fill", "merge"])
+      self.assertEqual(stats["stages"]["kinematics"], {"calls": 3, "wall": 300., "cpu": 150.})
+      self.assertEqual(stats["stages"]["angles"], {"calls": 5, "wall": 40., "cpu": 20.})
+      self.assertEqual(stats["stages"]["merge"]["calls"], 1)
+      self.assertEqual(stats["workertimelines"], [workerstats["timeline"]])
+      self.assertEqual([sample["event"] for sample in stats["samples"]], ["0:0", "0:1", "1:0", "worker 0:0", "worker 0:1"])
+      #only the nslowest slowest of all the events are kept
+      self.assertEqual([(event["wall"], event["event"]) for event in stats["slowest"]], [(21., "1:0"), (9., "worker 0:1")])
+
+    def testWrite(self):
+      profiler = Profiler(sampleevery=1, nslowest=1)
+      self.runevents(profiler, [[2., 4.]])
+      jsonfile, csvfile = os.path.join(self.tmpdir, "profile.json"), os.path.join(self.tmpdir, "profile.csv")
+      profiler.write(jsonfile)
+      with open(jsonfile) as f:
+        stats = json.load(f)
+      self.assertEqual(stats["nevents"], 2)
+      self.assertEqual(stats["stages"]["angles"], {"calls": 2, "wall": 6., "cpu": 3.})
+      self.assertEqual(stats["slowest"], [{"wall": 5., "event": "0:1", "stages": {"angles": 4., "fill": 1.}}])
+      self.assertEqual(len(stats["samples"]), 2)
+
+      profiler.write(csvfile)
+      with open(csvfile) as f:
+        rows = list(csv.reader(f))
+      self.assertEqual(rows[0], ["stage", "calls", "wall", "cpu", "wall per call", "fraction of wall"])
+      self.assertEqual([row[0] for row in rows[1:]], ["kinematics", "angles", "fill", "total"])
+      self.assertEqual([float(_) for _ in rows[2][1:]], [2, 6., 3., 3., 6./108])
+      self.assertEqual([float(_) for _ in rows[-1][1:]], [2, 108., 53., 54., 1])
+
+  unittest.main(argv=sys.argv)
@@ -0,0 +1,259 @@
+"""
+Pre-selection of the events with cut expressions on their kinematics,
+evaluated with numpy for a whole chunk of LHEColumns (after the FSR recombination) before mela is used,
+so that the events that fail don't go through the angles and probabilities.
+A cut is a python expression of the variables in cutvariables, e.g.
+  "M4L > 105 and 40 < MZ1 < 120"
+  "njets >= 2 and mjj > 300"
+  "associatedflavor in (11, 13)"
+with and, or, not, comparisons, +-*/, abs() and in (a tuple of numbers).
+A variable is nan for an event that doesn't have it (e.g. MZ1 without 4 daughters), which fails every comparison except !=.
+Example usage:
+  selection = Selection(["M4L > 105", "ptleptonmin > 5"])
+  for c in LHEFile_Hwithdecay.itercolumns("filename.lhe"):
+    passes = selection.select(c)
+  selection.report()
+"""
+
+if __name__ == "__main__":
+  import itertools, shutil, sys, tempfile, unittest
+  #the tests read synthetic events, which don't need mela
+  import stubmela
+  stubmela.install()
+
+import ast
+import collections
+
+import numpy
+
+import fourvectors
+from lhefile import ASSOCIATED, DAUGHTER, JETS, PDGIdSet
+
+CHARGEDLEPTONS = PDGIdSet(11, 13, 15)
+ZMASS = 91.1876
+
+def _daughterpairs(c):
+  """
+  MZ1 and MZ2 of the events with 4 daughters: of the pairings into two opposite sign same flavor pairs,
+  the pair with the mass closest to the Z mass is Z1 and the other one Z2, nan if there's no such pairing
+  """
+  daughters = c.role == DAUGHTER
+  ranks = fourvectors.rank(c, daughters)
+  four = fourvectors.count(c, daughters) == 4
+  indices = [fourvectors.nth(c, daughters, n, ranks) for n in range(4)]
+  ids = [numpy.where(four, c.id[numpy.maximum(_, 0)], 0) for _ in indices]
+  momenta = [fourvectors.particle(c, _) for _ in indices]
+  MZ1 = numpy.full(len(four), numpy.nan)
+  MZ2 = numpy.full(len(four), numpy.nan)
+  best = numpy.full(len(four), numpy.inf)
+  for (a, b), (d, e) in ((0, 1), (2, 3)), ((0, 2), (1, 3)), ((0, 3), (1, 2)):
+    valid = four & (ids[a] == -ids[b]) & (ids[d] == -ids[e]) & (ids[a] != 0) & (ids[d] != 0)
+    mab = fourvectors.mass(fourvectors.add(momenta[a], momenta[b]))
+    mde = fourvectors.mass(fourvectors.add(momenta[d], momenta[e]))
+    abfirst = numpy.abs(mab - ZMASS) <= numpy.abs(mde - ZMASS)
+    distance = numpy.where(abfirst, numpy.abs(mab - ZMASS), numpy.abs(mde - ZMASS))
+    better = valid & (distance < best)
+    best = numpy.where(better, distance, best)
+    MZ1 = numpy.where(better, numpy.where(abfirst, mab, mde), MZ1)
+    MZ2 = numpy.where(better, numpy.where(abfirst, mde, mab), MZ2)
+  return MZ1, MZ2
+
+def _leptons(c):
+  return ((c.role == DAUGHTER) | (c.role == ASSOCIATED)) & CHARGEDLEPTONS.contains(numpy.abs(c.id))
+
+def _jets(c):
+  #without isgen, the ids of the quarks and gluons are 0
+  return (c.role == ASSOCIATED) & (JETS.contains(numpy.abs(c.id)) | (c.id == 0))
+
+def _particlept(c):
+  return fourvectors.pt((c.E, c.px, c.py, c.pz))
+
+def _particleabseta(c):
+  return numpy.abs(fourvectors.eta((c.E, c.px, c.py, c.pz)))
+
+def _mjj(c):
+  jets = _jets(c)
+  ranks = fourvectors.rank(c, jets)
+  j1, j2 = (fourvectors.nth(c, jets, n, ranks) for n in (0, 1))
+  return numpy.where(j2 >= 0, fourvectors.mass(fourvectors.add(fourvectors.particle(c, j1), fourvectors.particle(c, j2))), numpy.nan)
+
+def _associatedflavor(c):
+  #as in ChunkKinematics in lhe2root.py
+  associated = c.role == ASSOCIATED
+  last = fourvectors.last(c, associated)
+  return numpy.where(last >= 0, numpy.abs(c.id[numpy.maximum(last, 0)]), 0)
+
+#name: (function of the LHEColumns that returns one value per event, description)
+cutvariables = collections.OrderedDict((
+  ("M4L", (lambda c: fourvectors.mass(fourvectors.sumbyevent(c, c.role == DAUGHTER)), "invariant mass of the daughters (of the Higgs itself if it's stable)")),
+  ("MZ1", (lambda c: _daughterpairs(c)[0], "mass of the opposite sign same flavor pair of daughters closest to the Z mass, with 4 daughters")),
+  ("MZ2", (lambda c: _daughterpairs(c)[1], "mass of the other pair of daughters")),
+  ("ptH", (lambda c: fourvectors.pt(fourvectors.sumbyevent(c, c.role == DAUGHTER)), "pt of the sum of the daughters")),
+  ("rapH", (lambda c: fourvectors.rapidity(fourvectors.sumbyevent(c, c.role == DAUGHTER)), "rapidity of the sum of the daughters")),
+  ("nleptons", (lambda c: fourvectors.count(c, _leptons(c)), "number of charged leptons among the daughters and associated particles")),
+  ("ptleptonmin", (lambda c: fourvectors.minbyevent(c, _leptons(c), _particlept(c)), "smallest pt of those leptons")),
+  ("ptleptonmax", (lambda c: fourvectors.maxbyevent(c, _leptons(c), _particlept(c)), "largest pt of those leptons")),
+  ("absetaleptonmax", (lambda c: fourvectors.maxbyevent(c, _leptons(c), _particleabseta(c)), "largest |eta| of those leptons")),
+  ("njets", (lambda c: fourvectors.count(c, _jets(c)), "number of associated quarks and gluons (or particles with id 0)")),
+  ("ptjetmin", (lambda c: fourvectors.minbyevent(c, _jets(c), _particlept(c)), "smallest pt of those jets")),
+  ("absetajetmax", (lambda c: fourvectors.maxbyevent(c, _jets(c), _particleabseta(c)), "largest |eta| of those jets")),
+  ("mjj", (lambda c: _mjj(c), "invariant mass of the first two of those jets")),
+  ("associatedflavor", (lambda c: _associatedflavor(c), "|id| of the last associated particle, 0 if there is none")),
+))
+
+class ChunkVariables(object):
+  """the cutvariables of a chunk of LHEColumns, each computed the first time it's used"""
+  def __init__(self, c):
+    self.c = c
+    self.values = {}
+
+  def __getitem__(self, name):
+    if name not in self.values:
+      self.values[name] = cutvariables[name][0](self.c)
+    return self.values[name]
+
+class Cut(object):
+  """
+  One cut expression, compiled into a numpy function of the ChunkVariables that returns whether each event passes.
+  Only the syntax described at the top of this file is allowed, the expression is never evaluated as python.
+  """
+  comparisons = {ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">=", ast.Eq: "==", ast.NotEq: "!="}
+  operators = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Div: "/"}
+
+  def __init__(self, expression):
+    self.expression = expression
+    self.variables = []
+    try:
+      tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError as e:
+      raise ValueError("Invalid cut {!r}: {}".format(expression, e))
+    source = self._source(tree.body)
+    self.function = eval("lambda v: " + source, {"numpy": numpy})
+
+  def _error(self, node):
+    return ValueError("Invalid cut {!r}: {} isn't allowed".format(self.expression, type(node).__name__))
+
+  def _source(self, node):
+    if isinstance(node, ast.BoolOp):
+      function = "numpy.logical_and" if isinstance(node.op, ast.And) else "numpy.logical_or"
+      return reduce(lambda a, b: "{}({}, {})".format(function, a, b), (self._source(_) for _ in node.values))
+    if isinstance(node, ast.UnaryOp):
+      if isinstance(node.op, ast.Not): return "numpy.logical_not({})".format(self._source(node.operand))
+      if isinstance(node.op, ast.USub): return "(-{})".format(self._source(node.operand))
+      if isinstance(node.op, ast.UAdd): return self._source(node.operand)
+      raise self._error(node.op)
+    if isinstance(node, ast.BinOp):
+      if type(node.op) not in self.operators: raise self._error(node.op)
+      return "({} {} {})".format(self._source(node.left), self.operators[type(node.op)], self._source(node.right))
+    if isinstance(node, ast.Compare):
+      parts = []
+      left = self._source(node.left)
+      for op, comparator in zip(node.ops, node.comparators):
+        if isinstance(op, (ast.In, ast.NotIn)):
+          if not isinstance(comparator, (ast.Tuple, ast.List)) or not all(isinstance(_, ast.Num) for _ in comparator.elts):
+            raise ValueError("Invalid cut {!r}: in needs a tuple of numbers".format(self.expression))
+          right = repr(tuple(_.n for _ in comparator.elts))
+          parts.append("{}numpy.in1d({}, {})".format("~" if isinstance(op, ast.NotIn) else "", left, right))
+        else:
+          if type(op) not in self.comparisons: raise self._error(op)
+          right = self._source(comparator)
+          parts.append("({} {} {})".format(left, self.comparisons[type(op)], right))
+        left = right
+      return reduce(lambda a, b: "numpy.logical_and({}, {})".format(a, b), parts)
+    if isinstance(node, ast.Call):
+      if not (isinstance(node.func, ast.Name) and node.func.id == "abs" and len(node.args) == 1 and not node.keywords and node.starargs is None and node.kwargs is None):
+        raise ValueError("Invalid cut {!r}: abs(x) is the only function".format(self.expression))
+      return "numpy.abs({})".format(self._source(node.args[0]))
+    if isinstance(node, ast.Name):
+      if node.id not in cutvariables:
+        raise ValueError("Invalid cut {!r}: unknown variable {}, should be one of {}".format(self.expression, node.id, ", ".join(cutvariables)))
+      if node.id not in self.variables: self.variables.append(node.id)
+      return "v[{!r}]".format(node.id)
+    if isinstance(node, ast.Num):
+      return repr(node.n)
+    raise self._error(node)
+
+  def passes(self, variables, nevents):
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+      result = numpy.asarray(self.function(variables), dtype=bool)
+    if result.shape != (nevents,): result = numpy.broadcast_to(result, (nevents,)).copy()
+    return result
+
+class Selection(object):
+  """
+  The cuts, applied in order, with the number of events that reach and pass each one for the efficiencies.
+  A cut is only evaluated (and its variables computed) if some events of the chunk pass the previous ones.
+  counts is [events, passing the first cut, passing the first two cuts, ...].
+  """
+  def __init__(self, expressions):
+    self.cuts = [Cut(_) for _ in expressions]
+    self.counts = [0] * (len(self.cuts) + 1)
+
+  def __nonzero__(self):
+    return bool(self.cuts)
+
+  def select(self, c, good=None):
+    """returns whether each event of the LHEColumns c passes all the cuts, only counting the events where good is true if it's given"""
+    nevents = len(c.eventoffset) - 1
+    passes = numpy.ones(nevents, dtype=bool) if good is None else numpy.array(good, dtype=bool)
+    self.counts[0] += numpy.count_nonzero(passes)
+    variables = ChunkVariables(c)
+    for k, cut in enumerate(self.cuts):
+      if not passes.any(): break
+      passes &= cut.passes(variables, nevents)
+      self.counts[k+1] += numpy.count_nonzero(passes)
+    return passes
+
+  def add(self, counts):
+    """adds the counts of another Selection with the same cuts, e.g. from a worker process"""
+    self.counts = [a + b for a, b in zip(self.counts, counts)]
+
+  def report(self):
+    if not self.cuts: return
+    total = self.counts[0]
+    print "Selection: {} of {} events pass ({:.1%})".format(self.counts[-1], total, float(self.counts[-1]) / total if total else 0)
+    print "  {:40} {:>10} {:>11} {:>11}".format("cut", "events", "efficiency", "cumulative")
+    for cut, before, after in zip(self.cuts, self.counts[:-1], self.counts[1:]):
+      print "  {:40} {:10} {:11.1%} {:11.1%}".format(cut.expression, after, float(after) / before if before else 0, float(after) / total if total else 0)
+
+if __name__ == "__main__":
+  import os
+  import ROOT
+  from benchmark import writesyntheticfile
+  from lhefile import LHEFile_Hwithdecay
+
+  class TestSelection(unittest.TestCase):
+    def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+      self.filename = os.path.join(self.tmpdir, "h4l.lhe")
+      writesyntheticfile(self.filename, "h4l", 500)
+
+    def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+    def testSelection(self):
+      #the synthetic Higgs bosons have the same mass, but different rapidities and lepton momenta
+      with LHEFile_Hwithdecay(self.filename, reusemela=True) as f:
+        daughters = [[p.second for p in e.daughters] for e in itertools.islice(f, 500)]
+      rapidities = [abs(sum(_, ROOT.TLorentzVector()).Rapidity()) for _ in daughters]
+      leptonpts = [sorted(p.Pt() for p in _) for _ in daughters]
+      c = next(LHEFile_Hwithdecay.itercolumns(self.filename, chunksize=500))
+      selection = Selection(["abs(rapH) > 0.5", "ptleptonmax < 50 or not ptleptonmin < 20"])
+      passes = selection.select(c)
+      first = [y > 0.5 for y in rapidities]
+      expected = [f and (pts[-1] < 50 or not pts[0] < 20) for f, pts in zip(first, leptonpts)]
+      self.assertEqual(list(passes), expected)
+      self.assertEqual(selection.counts, [500, sum(first), sum(expected)])
+      #every cut has events that pass and events that fail
+      self.assertTrue(0 < selection.counts[2] < selection.counts[1] < 500)
+      #only the good events are counted and can pass
+      good = numpy.arange(500) % 2 == 0
+      selection = Selection(["abs(rapH) > 0.5"])
+      self.assertEqual(list(selection.select(c, good)), [g and f for g, f in zip(good, first)])
+      self.assertEqual(selection.counts, [250, sum(first[::2])])
+
+    def testInvalidCuts(self):
+      for bad in "M4L >", "unknown > 1", "__import__('os')", "M4L.real > 1", "associatedflavor in (M4L,)":
+        self.assertRaises(ValueError, Cut, bad)
+
+  unittest.main(argv=sys.argv)
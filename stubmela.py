@@ -0,0 +1,78 @@
+"""
+Stand-in for the mela and pythonmelautils modules, so that the readers and lhe2root can be benchmarked
+without MELA, or on machines where it isn't installed.  Mela returns constant probabilities and angles,
+so the timings are the overhead of everything except the matrix elements and the angle computations.
+Example usage (before importing lhefile or lhe2root):
+  import stubmela
+  stubmela.install()
+"""
+import sys
+import types
+
+import ROOT
+
+class _TVar(object):
+  """every enum value is its own name"""
+  def __getattr__(self, name):
+    if name.startswith("__"): raise AttributeError(name)
+    return name
+
+TVar = _TVar()
+
+class SimpleParticle_t(object):
+  """(id, TLorentzVector), constructed from a particle line of an LHE event like mela's"""
+  def __init__(self, lheline_or_id, momentum=None):
+    if momentum is None:
+      fields = lheline_or_id.split()
+      self.first = int(fields[0])
+      self.second = ROOT.TLorentzVector(float(fields[6]), float(fields[7]), float(fields[8]), float(fields[9]))
+    else:
+      self.first, self.second = lheline_or_id, momentum
+
+class SimpleParticleCollection_t(list):
+  def __init__(self, particles=()):
+    super(SimpleParticleCollection_t, self).__init__(SimpleParticle_t(_) if isinstance(_, basestring) else _ for _ in particles or ())
+
+  def push_back(self, particle):
+    self.append(particle)
+
+  def pop_back(self):
+    self.pop()
+
+class Mela(object):
+  probability = 0.5
+  def __init__(self, *args):
+    self.daughters = self.associated = self.mothers = None
+  def setInputEvent(self, daughters, associated, mothers=None, isgen=True):
+    self.daughters, self.associated, self.mothers = daughters, associated, mothers
+  def resetInputEvent(self):
+    self.daughters = self.associated = self.mothers = None
+  def setProcess(self, hypothesis, matrixelement, production):
+    self.process = hypothesis, matrixelement, production
+  def computeP(self, *args):
+    return self.probability
+  def computeProdP(self, *args):
+    return self.probability
+  def computeDecayAngles(self):
+    return (125., 91., 30., 0.1, 0.2, 0.3, 0.4, 0.5)
+  def computeVHAngles(self, process):
+    return (91., 300., 0.1, 0.2, 0.3, 0.4, 0.5)
+  def computeVBFAngles(self):
+    return (1e3, 1e3, 0.1, 0.2, 0.3, 0.4, 0.5)
+
+class MultiDimensionalCppArray(object): pass
+class SelfDParameter(object): pass
+class SelfDCoupling(object): pass
+
+def install():
+  """puts the stubs in sys.modules as mela and pythonmelautils"""
+  mela = types.ModuleType("mela")
+  mela.__file__ = __file__
+  mela.TVar = TVar
+  for _ in SimpleParticle_t, SimpleParticleCollection_t, Mela:
+    setattr(mela, _.__name__, _)
+  pythonmelautils = types.ModuleType("pythonmelautils")
+  for _ in MultiDimensionalCppArray, SelfDParameter, SelfDCoupling:
+    setattr(pythonmelautils, _.__name__, _)
+  sys.modules["mela"] = mela
+  sys.modules["pythonmelautils"] = pythonmelautils
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""
+Tests of lhe2root.py and of merging its outputs with mergeoutputs.py, run on small synthetic LHE files from benchmark.py,
+with the MELA stub from stubmela.py unless --real-mela is given.
+Example usage:
+  python testlhe2root.py
+  python testlhe2root.py TestLHE2Root.testBadKinematics
+"""
+import gzip
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--real-mela", action="store_true", help="run lhe2root with the installed mela instead of the stub")
+  parser.add_argument('unittest_args', nargs='*')
+  args = parser.parse_args()
+  if not args.real_mela:
+    import stubmela
+    stubmela.install()
+
+import pyarrow.parquet
+
+from benchmark import writesyntheticfile
+from lhefile import scanevents
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+#kills the process without any cleanup right after the checkpoint is written for the n'th time
+killatcheckpoint = """
+import os, signal
+rename = os.rename
+def killingrename(source, destination):
+  rename(source, destination)
+  if destination.endswith(".checkpoint"):
+    killingrename.n -= 1
+    if not killingrename.n: os.kill(os.getpid(), signal.SIGKILL)
+killingrename.n = {}
+os.rename = killingrename
+"""
+
+#replaces lhefile.parsechunk, which the pipeline workers call for each chunk, with one that calls chunkhook(chunk) first
+parsechunkhook = """
+import lhefile, os, time
+parsechunk = lhefile.parsechunk
+def hookedparsechunk(chunk, *args, **kwargs):
+  chunkhook(chunk)
+  return parsechunk(chunk, *args, **kwargs)
+lhefile.parsechunk = hookedparsechunk
+"""
+
+def lhe2rootcommand(outputfile, inputfiles, options, realmela=False, prelude=""):
+  """the command that runs lhe2root.py in a new process, after the python code prelude, with the MELA stub unless realmela"""
+  script = "import runpy, sys\n"
+  if not realmela: script += "import stubmela\nstubmela.install()\n"
+  script += prelude + "\nsys.argv = sys.argv[1:]\nrunpy.run_path(sys.argv[0], run_name='__main__')\n"
+  return [sys.executable, "-c", script, os.path.join(here, "lhe2root.py"), outputfile] + list(inputfiles) + list(options)
+
+def runlhe2root(outputfile, inputfiles, *options, **kwargs):
+  """
+  runs lhe2root.py, returns its return code and its output.
+  prelude (keyword only) is passed to lhe2rootcommand, and the process is killed after timeout seconds (keyword only, default 300)
+  """
+  process = subprocess.Popen(lhe2rootcommand(outputfile, inputfiles, options, args.real_mela, kwargs.get("prelude", "")), cwd=here, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  timer = threading.Timer(kwargs.get("timeout", 300), process.kill)
+  timer.start()
+  try:
+    output = process.communicate()[0]
+  finally:
+    timer.cancel()
+  return process.returncode, output
+
+def runmergeoutputs(outputfile, inputfiles, *options):
+  """runs mergeoutputs.py, returns its return code and its output"""
+  process = subprocess.Popen([sys.executable, os.path.join(here, "mergeoutputs.py"), outputfile] + list(inputfiles) + list(options), cwd=here, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  output = process.communicate()[0]
+  return process.returncode, output
+
+def readoutput(filename):
+  """the branches of a parquet output as a dict name: list"""
+  return pyarrow.parquet.read_table(filename).to_pydict()
+
+def readevents(filename):
+  with open(filename) as f:
+    return [event for offset, linenumber, event in scanevents(f)]
+
+def writeevents(filename, events):
+  with open(filename, "w") as f:
+    f.write('<LesHouchesEvents version="3.0">\n<header>\n</header>\n<init>\n2212 2212 6.5e3 6.5e3 0 0 247000 247000 3 1\n1.0e1 1.0e-2 1.0 1\n</init>\n')
+    f.write("".join(events))
+    f.write("</LesHouchesEvents>\n")
+
+def editparticles(event, edit):
+  """returns event with its particle lines replaced by edit(list of the lines), and the number of particles updated"""
+  lines = event.split("\n")
+  particles = edit(lines[2:-2])
+  fields = lines[1].split()
+  fields[0] = str(len(particles))
+  return "\n".join([lines[0], " " + " ".join(fields)] + particles + lines[-2:])
+
+if __name__ == "__main__":
+  class TestLHE2Root(unittest.TestCase):
+    def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+      return os.path.join(self.tmpdir, name)
+
+    def testBadKinematics(self):
+      #events 3 and 7 lose their last jet
+      writesyntheticfile(self.path("vbf.lhe"), "vbf", 20)
+      events = readevents(self.path("vbf.lhe"))
+      for i in 3, 7:
+        events[i] = editparticles(events[i], lambda particles: particles[:-1])
+      writeevents(self.path("bad.lhe"), events)
+      returncode, output = runlhe2root(self.path("fail.parquet"), [self.path("bad.lhe")], "--vbf")
+      self.assertNotEqual(returncode, 0)
+      #the absolute position of the event in the file, not its index in the chunk
+      self.assertIn("Event has 1 associated particles, need 2 jets: the event starting on line {} of".format(8 + 3*8), output)
+      for options in (), ("--pipeline", "--jobs", "2"), ("--jobs", "2"):
+        outputfile = self.path("skip{}.parquet".format(len(options)))
+        returncode, output = runlhe2root(outputfile, [self.path("bad.lhe")], "--vbf", "--bad-events", "quarantine", "--chunk-size", "4", *options)
+        self.assertEqual(returncode, 0, output)
+        self.assertEqual(len(readoutput(outputfile)["pzj1"]), 18)
+        self.assertEqual(readevents(self.path("skip{}.quarantine.lhe".format(len(options)))), [events[3], events[7]])
+
+    def testFailedRunRemovesQuarantine(self):
+      #a run that fails in the third chunk, after it quarantined event 3, removes the quarantine file with the output, so it can be rerun
+      writesyntheticfile(self.path("vbf.lhe"), "vbf", 20)
+      events = readevents(self.path("vbf.lhe"))
+      events[3] = editparticles(events[3], lambda particles: particles[:-1])
+      writeevents(self.path("bad.lhe"), events)
+      prelude = parsechunkhook + """
+def chunkhook(chunk):
+  if chunk[0][1] > 8 + 8*8: raise RuntimeError('chunk failure')
+"""
+      for options in (), ("--pipeline", "--jobs", "2"):
+        outputfile = self.path("out{}.parquet".format(len(options)))
+        command = [outputfile, [self.path("bad.lhe")], "--vbf", "--bad-events", "quarantine", "--chunk-size", "4"] + list(options)
+        returncode, output = runlhe2root(*command, prelude=prelude)
+        self.assertNotEqual(returncode, 0, output)
+        self.assertIn("RuntimeError: chunk failure", output)
+        self.assertFalse(os.path.exists(outputfile))
+        self.assertFalse(os.path.exists(self.path("out{}.quarantine.lhe".format(len(options)))))
+        returncode, output = runlhe2root(*command)
+        self.assertEqual(returncode, 0, output)
+        self.assertEqual(readevents(self.path("out{}.quarantine.lhe".format(len(options)))), [events[3]])
+
+    def testMissingParticlesAreZero(self):
+      #only the first event has an FSR photon, and the second one has only 3 leptons
+      writesyntheticfile(self.path("h4l.lhe"), "h4l", 3)
+      events = readevents(self.path("h4l.lhe"))
+      photon = "  22  1  1  2   0   0 +1.0000000000e+01 +2.0000000000e+01 +3.0000000000e+01 3.7416573868e+01 0.0000000000e+00 0. 9."
+      events[0] = editparticles(events[0], lambda particles: particles + [photon])
+      events[1] = editparticles(events[1], lambda particles: particles[:-1])
+      writeevents(self.path("photon.lhe"), events)
+      returncode, output = runlhe2root(self.path("photon.parquet"), [self.path("photon.lhe")], "--ggH4l")
+      self.assertEqual(returncode, 0, output)
+      result = readoutput(self.path("photon.parquet"))
+      self.assertEqual(result["pxph1"], [10, 0, 0])
+      self.assertEqual(result["Edau4"][1], 0)
+      self.assertNotEqual(result["Edau4"][2], 0)
+
+    def testCompressedJobs(self):
+      #a compressed input isn't split into shards, --jobs converts it with --pipeline
+      writesyntheticfile(self.path("h4l.lhe"), "h4l", 50)
+      with open(self.path("h4l.lhe"), "rb") as f, gzip.open(self.path("h4l.lhe.gz"), "wb") as gz:
+        shutil.copyfileobj(f, gz)
+      returncode, output = runlhe2root(self.path("serial.parquet"), [self.path("h4l.lhe")], "--ggH4l")
+      self.assertEqual(returncode, 0, output)
+      returncode, output = runlhe2root(self.path("jobs.parquet"), [self.path("h4l.lhe.gz")], "--ggH4l", "--jobs", "2", "--chunk-size", "10")
+      self.assertEqual(returncode, 0, output)
+      self.assertIn("converted with --pipeline", output)
+      self.assertEqual(readoutput(self.path("jobs.parquet")), readoutput(self.path("serial.parquet")))
+
+    def testResume(self):
+      writesyntheticfile(self.path("h4l.lhe"), "h4l", 50)
+      inputfiles = [self.path("h4l.lhe")]
+      options = "--ggH4l", "--calc_decayprob", "--checkpoint-every", "10"
+      returncode, output = runlhe2root(self.path("serial.parquet"), inputfiles, "--ggH4l", "--calc_decayprob")
+      self.assertEqual(returncode, 0, output)
+      returncode, output = runlhe2root(self.path("uninterrupted.parquet"), inputfiles, *options)
+      self.assertEqual(returncode, 0, output)
+      self.assertEqual(readoutput(self.path("uninterrupted.parquet")), readoutput(self.path("serial.parquet")))
+
+      #killed after the first checkpoint and 2 of the 5 shards
+      outputfile = self.path("resumed.parquet")
+      checkpointfile = outputfile + ".checkpoint"
+      returncode, output = runlhe2root(outputfile, inputfiles, *options, prelude=killatcheckpoint.format(3))
+      self.assertEqual(returncode, -signal.SIGKILL, output)
+      self.assertFalse(os.path.exists(outputfile))
+      with open(checkpointfile) as f:
+        checkpoint = json.load(f)
+      self.assertEqual(len(checkpoint["done"]), 2)
+
+      #resuming needs the same options, except the ones that don't change the output
+      returncode, output = runlhe2root(outputfile, inputfiles, "--resume", "--use-flavor", *options)
+      self.assertNotEqual(returncode, 0)
+      self.assertIn("the options in {} are different".format(checkpointfile), output)
+      #and a checkpoint of the same version
+      with open(checkpointfile, "w") as f:
+        json.dump(dict(checkpoint, version=1), f)
+      returncode, output = runlhe2root(outputfile, inputfiles, "--resume", *options)
+      self.assertNotEqual(returncode, 0)
+      self.assertIn("the version in {} are different".format(checkpointfile), output)
+      with open(checkpointfile, "w") as f:
+        json.dump(checkpoint, f)
+
+      returncode, output = runlhe2root(outputfile, inputfiles, "--resume", "--jobs", "2", "--chunk-size", "3", *options)
+      self.assertEqual(returncode, 0, output)
+      self.assertIn("2 of 5 shards are done", output)
+      self.assertEqual(readoutput(outputfile), readoutput(self.path("uninterrupted.parquet")))
+      self.assertEqual(sorted(os.listdir(self.tmpdir)), ["h4l.lhe", "h4l.lhe.idx", "resumed.parquet", "serial.parquet", "uninterrupted.parquet"])
+
+    def testPipelineOrder(self):
+      #the first chunk (the events have 12 lines) takes longest, so the workers finish the chunks out of order
+      writesyntheticfile(self.path("h4l.lhe"), "h4l", 60)
+      inputfiles = [self.path("h4l.lhe")]
+      returncode, output = runlhe2root(self.path("serial.parquet"), inputfiles, "--ggH4l", "--calc_decayprob")
+      self.assertEqual(returncode, 0, output)
+      log = self.path("chunks.log")
+      prelude = parsechunkhook + """
+def chunkhook(chunk):
+  if chunk[0][1] == 8: time.sleep(1)
+  with open({!r}, "a") as f:
+    f.write("{{}}\\n".format(chunk[0][1]))
+""".format(log)
+      returncode, output = runlhe2root(self.path("pipeline.parquet"), inputfiles, "--ggH4l", "--calc_decayprob", "--pipeline", "--jobs", "3", "--chunk-size", "5", prelude=prelude)
+      self.assertEqual(returncode, 0, output)
+      with open(log) as f:
+        finished = [int(_) for _ in f]
+      self.assertEqual(sorted(finished), [8 + 5*12*k for k in range(12)])
+      self.assertNotEqual(finished, sorted(finished))
+      self.assertEqual(readoutput(self.path("pipeline.parquet")), readoutput(self.path("serial.parquet")))
+
+    def testPipelineWorkerErrors(self):
+      #an exception in a worker, or a worker that dies, ends the run instead of leaving the writer waiting
+      writesyntheticfile(self.path("h4l.lhe"), "h4l", 60)
+      for failure, message in (
+        ("raise RuntimeError('worker failure')", "RuntimeError: worker failure"),
+        ("os._exit(1)", ""),
+      ):
+        prelude = parsechunkhook + """
+def chunkhook(chunk):
+  if chunk[0][1] == 8 + 5*12*5: {}
+""".format(failure)
+        outputfile = self.path("pipeline.parquet")
+        returncode, output = runlhe2root(outputfile, [self.path("h4l.lhe")], "--ggH4l", "--pipeline", "--jobs", "2", "--chunk-size", "5", prelude=prelude, timeout=120)
+        self.assertGreater(returncode, 0, output)
+        self.assertIn(message, output)
+        self.assertFalse(os.path.exists(outputfile))
+
+    def testAugmentMismatch(self):
+      #--augment refuses an existing output that isn't from the same events
+      writesyntheticfile(self.path("h4l.lhe"), "h4l", 30)
+      writesyntheticfile(self.path("other.lhe"), "h4l", 30, seed=2)
+      returncode, output = runlhe2root(self.path("existing.parquet"), [self.path("h4l.lhe")], "--ggH4l", "--skip-events", "3")
+      self.assertEqual(returncode, 0, output)
+      for n, (inputfile, options, message) in enumerate((
+        ("other.lhe", ("--skip-events", "3"), "Event 0 is different"),
+        ("h4l.lhe", ("--skip-events", "4"), "Event 0 is different"),
+        ("h4l.lhe", (), "There are more events than the 27"),
+        ("h4l.lhe", ("--skip-events", "3", "--max-events", "20"), "has more than the 20 events"),
+      )):
+        outputfile = self.path("augment{}.parquet".format(n))
+        returncode, output = runlhe2root(outputfile, [self.path(inputfile)], "--ggH4l", "--calc_decayprob", "--augment", self.path("existing.parquet"), *options)
+        self.assertNotEqual(returncode, 0, output)
+        self.assertIn(message, output)
+        self.assertFalse(os.path.exists(outputfile))
+      returncode, output = runlhe2root(self.path("augment.parquet"), [self.path("h4l.lhe")], "--ggH4l", "--calc_decayprob", "--augment", self.path("existing.parquet"), "--skip-events", "3")
+      self.assertEqual(returncode, 0, output)
+      self.assertEqual(len(readoutput(self.path("augment.parquet"))["pg1"]), 27)
+
+  class TestMergeOutputs(unittest.TestCase):
+    def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+      return os.path.join(self.tmpdir, name)
+
+    def convert(self, name, nevents, seed, *options):
+      writesyntheticfile(self.path(name+".lhe"), "h4l", nevents, seed=seed)
+      returncode, output = runlhe2root(self.path(name+".parquet"), [self.path(name+".lhe")], "--ggH4l", *options)
+      self.assertEqual(returncode, 0, output)
+      return self.path(name+".parquet")
+
+    def testMerge(self):
+      import mergeoutputs
+      inputs = [self.convert("a", 5, 1), self.convert("b", 3, 2)]
+      returncode, output = runmergeoutputs(self.path("merged.parquet"), inputs)
+      self.assertEqual(returncode, 0, output)
+      self.assertIn("Merged 8 events from 2 files", output)
+      merged = readoutput(self.path("merged.parquet"))
+      a, b = (readoutput(_) for _ in inputs)
+      self.assertEqual(sorted(merged), sorted(a))
+      for name in merged:
+        self.assertEqual(merged[name], a[name] + b[name])
+      lhemetadata = json.loads(mergeoutputs.readinfo(self.path("merged.parquet")).metadata["lhemetadata"])
+      self.assertEqual([_["filename"] for _ in lhemetadata], [self.path("a.lhe"), self.path("b.lhe")])
+
+    def testDifferentBranches(self):
+      #an output with the probabilities has more branches
+      inputs = [self.convert("a", 5, 1), self.convert("c", 2, 3, "--calc_decayprob")]
+      returncode, output = runmergeoutputs(self.path("merged.parquet"), inputs)
+      self.assertNotEqual(returncode, 0, output)
+      self.assertIn("can't be merged with", output)
+      self.assertFalse(os.path.exists(self.path("merged.parquet")))
+
+  unittest.main(argv=[sys.argv[0]]+args.unittest_args)